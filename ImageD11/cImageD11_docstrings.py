@@ -166,6 +166,13 @@ misori_tetragonal = """computes the trace of the smallest misorientation
 overlaps = """determines which of (row1,col1,labels1) and (row2,col2,labels2)
 are overlapped. 
    
+"""
+parse_float_columns = """reads lines of whitespace separated numbers
+from the text in buf (int8, must end with a newline) into the
+columns cols[ncols, nrows] starting at row row0.
+Returns the number of rows read. This stops early at the end of
+cols or at the first line which does not hold ncols numbers.
+threadsafe if each thread fills different rows
 """
 put_incr32 = """does the simple loop : data[ind] += vals
 not sure why this isn't in numpy
@@ -175,6 +182,11 @@ put_incr64 = """does the simple loop : data[ind] += vals
 not sure why this isn't in numpy
 uses 64 bit addressing
 """
+put_trilinear = """spreads each point hkl[i] over the 8 surrounding
+grid points of data[npx,npx,npx] with trilinear weights.
+Indices wrap periodically. Threaded using atomic updates.
+Returns 0, or -1 if data does not have npx**3 elements
+"""
 quickorient = """takes two g-vectors in UBI[0] and UBI[1]
 and overwrites with UBI orientation using cache in bt (from h1,h2)
 ... computes cross product 0x1 = ubi[0]xubi[1]
@@ -320,8 +332,10 @@ __all__ = [
     "misori_orthorhombic",
     "misori_tetragonal",
     "overlaps",
+    "parse_float_columns",
     "put_incr32",
     "put_incr64",
+    "put_trilinear",
     "quickorient",
     "refine_assigned",
     "reorder_f32_a32",
@@ -30,7 +30,7 @@ An equals sign "=" on a "#" line implies a parameter = value pair
 
 import warnings
 
-from ImageD11 import parameters, transform
+from ImageD11 import parameters, transform, cImageD11
 import numpy as np
 
 FLOATS = [
@@ -125,6 +125,28 @@ for f in INTS:
 for f in EXPONENTIALS:
     FORMATS[f] = "%.4e"
 
+# Parameters used by each step of columnfile.updateGeometry
+XYZ_PARS = [ "y_center", "y_size", "tilt_y", "z_center", "z_size", "tilt_z",
+             "tilt_x", "distance", "o11", "o12", "o21", "o22" ]
+TTH_ETA_PARS = [ "t_x", "t_y", "t_z", "wedge", "chi", "omegasign" ]
+GVEC_PARS = [ "wedge", "chi", "omegasign" ] # and wavelength
+
+def default_dtype( title ):
+    """
+    Compact type for a column when nothing was declared and a type has
+    to be chosen (hdf files, columnfile_writer, databases): int32 for the
+    INTS titles, float64 for everything else. Text files are read as
+    float64 unless the dtypes are declared.
+    """
+    if title in INTS:
+        return np.dtype( np.int32 )
+    return np.dtype( np.float64 )
+
+def parse_dtypes( value ):
+    """ "title:dtype title:dtype ..." from a file header to a dict """
+    return dict( [ ( t, np.dtype( d ) ) for t, d in
+                   [ item.split(":") for item in value.split() ] ] )
+
 def clean(str_lst):
     """ trim whitespace from titles """
     return [s.lstrip().rstrip() for s in str_lst]
@@ -135,13 +157,192 @@ def fillcols(lines, cols):
         for j,item in enumerate(line.split()):
             cols[j][i] = float(item)
 
+
+# Text files are read this many bytes at a time
+READ_BLOCK = 1 << 25
+
+def count_lines( f, blocksize = READ_BLOCK ):
+    """
+    Number of lines from the current position to the end of the open
+    (binary) file f. The file position is put back afterwards.
+    """
+    start = f.tell()
+    n = 0
+    last = b"\n"
+    while True:
+        b = f.read( blocksize )
+        if not b:
+            break
+        n += b.count( b"\n" )
+        last = b[-1:]
+    if last != b"\n":
+        n += 1
+    f.seek( start )
+    return n
+
+def _parse_chunk( args ):
+    text, start, end, cols, row0 = args
+    buf = np.frombuffer( text, np.int8, end - start, start )
+    return cImageD11.parse_float_columns( buf, cols, row0 )
+
+def read_float_columns( f, ncols, nthreads = None, blocksize = READ_BLOCK,
+                        dtypes = None ):
+    """
+    Reads the rest of the open (binary) file f as lines of ncols numbers
+    Returns a list of ncols columns. These are float64 or dtypes[i]
+    (integer types are only used if all the values convert exactly).
+    The file is read in blocks which are parsed by nthreads threads
+    into the preallocated output. An unfinished (short) last row is
+    skipped. Any other line without ncols numbers is an error.
+    """
+    if nthreads is None:
+        nthreads = max( 1, cImageD11.cimaged11_omp_get_max_threads() )
+    nlines = count_lines( f, blocksize )
+    if dtypes is None:
+        dtypes = [ np.float64, ] * ncols
+    dtypes = [ np.dtype( d ) for d in dtypes ]
+    typed = [ d != np.float64 for d in dtypes ]
+    direct = not any( typed )
+    if not direct:
+        # parse each block into a float64 buffer and convert
+        cols = [ np.empty( nlines, d ) for d in dtypes ]
+    else:
+        # parse straight into the output
+        allcols = np.empty( ( ncols, nlines ), float )
+    pool = None
+    if nthreads > 1:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool( nthreads )
+    row = 0
+    rest = b""
+    done = False
+    try:
+        while not done:
+            b = f.read( blocksize )
+            text = rest + b
+            if b:
+                # hold back the last line (it may be unfinished)
+                # and any blank lines which end the file
+                cut = text.rstrip().rfind( b"\n" ) + 1
+                text, rest = text[:cut], text[cut:]
+            else:
+                done = True
+                text = text.rstrip()
+                if len( text ) == 0:
+                    break
+                text += b"\n"
+            if len( text ) == 0:
+                continue
+            if not direct:
+                out = np.empty( ( ncols, text.count( b"\n" ) ), float )
+                out0 = 0
+            else:
+                out = allcols
+                out0 = row
+            # split into pieces at line ends
+            step = len( text ) // nthreads + 1
+            ends = [ text.find( b"\n", i ) + 1 for i in
+                     range( step, len( text ), step ) ] + [ len( text ), ]
+            jobs = []
+            start = 0
+            nblock = 0
+            for end in sorted( set( ends ) ):
+                if end <= start:
+                    continue
+                jobs.append( ( text, start, end, out, out0 + nblock ) )
+                nblock += text.count( b"\n", start, end )
+                start = end
+            if pool is None:
+                nread = [ _parse_chunk( job ) for job in jobs ]
+            else:
+                nread = pool.map( _parse_chunk, jobs )
+            for job, n in zip( jobs, nread ):
+                _, start, end, _, row0 = job
+                nlines = text.count( b"\n", start, end )
+                if n == nlines:
+                    continue
+                if done and end == len( text ) and n == nlines - 1:
+                    nblock -= 1 # short last row
+                    continue
+                raise Exception( "Problem interpreting your colfile"
+                                 " at data line %d"%( row + row0 - out0 + n + 1 ) )
+            if not direct:
+                for j in range( ncols ):
+                    v = out[j, :nblock]
+                    if typed[j] and dtypes[j].kind in "iu":
+                        with np.errstate( invalid='ignore' ):
+                            iv = v.astype( dtypes[j] )
+                        if not ( iv == v ).all():
+                            # not integers after all
+                            typed[j] = False
+                            cols[j] = cols[j].astype( np.float64 )
+                    cols[j][ row : row + nblock ] = v
+            row += nblock
+    finally:
+        if pool is not None:
+            pool.close()
+    if direct:
+        return list( allcols[:, :row] )
+    return [ c[:row] for c in cols ]
+
+
+class column_index(object):
+    """
+    A sorted copy of one column for range and equality lookups in
+    O(log(n) + k) instead of scanning all the rows with a mask.
+    Row numbers come back in increasing order, as for a mask.
+    Made by columnfile.index(name), which drops it on reorder, filter
+    and addcolumn or if the column is replaced. Changing the values in
+    place is not noticed.
+    """
+    def __init__(self, col):
+        self.column = col
+        # stable so that equal values stay in row order
+        self.order = np.argsort( col, kind='stable' )
+        self.values = np.asarray( col )[ self.order ]
+
+    def span(self, lo=None, hi=None, inclusive=False):
+        """ Positions in self.order for lo <= value < hi (<= if inclusive) """
+        i0 = 0
+        i1 = len( self.values )
+        if lo is not None:
+            i0 = np.searchsorted( self.values, lo, side='left' )
+        if hi is not None:
+            i1 = np.searchsorted( self.values, hi,
+                                  side= 'right' if inclusive else 'left' )
+        return i0, max( i0, i1 )
+
+    def between(self, lo=None, hi=None, inclusive=False):
+        """ Rows with lo <= value < hi (or <= hi if inclusive) """
+        i0, i1 = self.span( lo, hi, inclusive )
+        return np.sort( self.order[i0:i1] )
+
+    def equal(self, value):
+        """ Rows where the column == value """
+        i0, i1 = self.span( value, value, True )
+        return self.order[i0:i1]
+
+    def count(self, lo=None, hi=None, inclusive=False):
+        """ Number of rows with lo <= value < hi (or <= hi if inclusive) """
+        i0, i1 = self.span( lo, hi, inclusive )
+        return i1 - i0
+
+
 class columnfile(object):
     """
     Class to represent an ascii file containing multiple named columns
+    dtypes = { title : dtype } for columns which should not be float64.
+    These come from here or a "# dtypes = " line in the file header,
+    anything else is float64. Integer columns are read as float64 if
+    they turn out not to hold integers.
     """
 
-    def __init__(self, filename = None, new = False):
+    def __init__(self, filename = None, new = False, dtypes = None):
         self.filename = filename
+        if dtypes is None:
+            dtypes = {}
+        self.dtypes = dict( [ ( t, np.dtype( d ) ) for t, d in
+                              dtypes.items() ] )
         self.__data = []
         self.titles = []
         if filename is not None:
@@ -150,6 +351,8 @@ class columnfile(object):
             self.parameters = parameters.parameters()
         self.ncols = 0
         self.nrows = 0
+        self._indexes = {}
+        self._geometry = {}
         if not new:
             self.readfile(filename)
 
@@ -172,6 +375,8 @@ class columnfile(object):
         for col in ar:
             assert len(col) == nrows, "ar is not rectangular"
         self.nrows = nrows
+        self.clear_indexes()
+        self._geometry = {} # rows changed, see updateGeometry
         # use a list of arrays
         self.__bigarray = ar
         self.__data = self.__bigarray
@@ -211,7 +416,7 @@ class columnfile(object):
         """
         col = self.getcolumn( column_name )
         if tol <= 0: # integer comparisons
-            col = col.astype( np.int )
+            col = col.astype( int )
             mskfun = lambda x, val, t: x == val
         else:        # floating point
             mskfun = lambda x, val, t: np.abs( x - val ) < t
@@ -235,8 +440,47 @@ class columnfile(object):
         """
         for col in self.__data:
             col[:] = col[indices]
+        self.clear_indexes()
+        self._geometry = {} # rows changed, see updateGeometry
         self.set_attributes()
 
+    def index(self, name):
+        """
+        A column_index for fast range and equality lookups on column
+        name. It is made on first use and kept until the rows change.
+        """
+        if name not in self.titles:
+            raise KeyError("Name "+name+" not in file")
+        col = getattr( self, name )
+        if name not in self._indexes or self._indexes[name].column is not col:
+            # new, or someone replaced the column
+            self._indexes[name] = column_index( col )
+        return self._indexes[name]
+
+    def clear_indexes(self, name=None):
+        """ Drop the column_index for name (default all of them) """
+        if name is None:
+            self._indexes = {}
+        else:
+            self._indexes.pop( name, None )
+
+    def select(self, name, lo, hi=None, inclusive=False):
+        """
+        Copy of the rows with column name == lo (if hi is None) or
+        lo <= name < hi (<= hi if inclusive) using the index
+        """
+        if hi is None:
+            rows = self.index( name ).equal( lo )
+        else:
+            rows = self.index( name ).between( lo, hi, inclusive )
+        return self.copyrows( rows )
+
+    def dtype(self, title):
+        """ The declared dtype for the column title (float64 if none) """
+        if title in self.dtypes:
+            return self.dtypes[title]
+        return np.dtype( np.float64 )
+
     def writefile(self, filename):
         """
         write an ascii columned file
@@ -249,14 +493,21 @@ class columnfile(object):
         for p in parnames:
             fout.write("# %s = %s\n"%(p, str(self.parameters.get(p) ) ) )
         # self.parameters.saveparameters(filename)
+        # Declared types for reading back
+        dtypes = [ "%s:%s"%(t, np.dtype( self.dtypes[t] ).name)
+                   for t in self.titles if t in self.dtypes ]
+        if len(dtypes) > 0:
+            fout.write("# dtypes = %s\n"%(" ".join( dtypes ) ) )
         # Now titles line
         fout.write("#")
         format_str = ""
-        for title in self.titles:
+        for title, col in zip( self.titles, self.__data ):
             fout.write("  %s"%(title))
-            try:
+            if title in FORMATS:
                 format_str += "  %s" % (FORMATS[title])
-            except KeyError:
+            elif col.dtype.kind in "iu":
+                format_str += "  %d"
+            else:
                 format_str += "  %f"
         fout.write("\n")
         format_str += "\n"
@@ -264,15 +515,18 @@ class columnfile(object):
             fout.write(format_str % tuple( [col[i] for col in self.__data] ) )
         fout.close()
 
-    def readfile(self, filename):
+    def readfile(self, filename, nthreads=None):
         """
         Reads in an ascii columned file
+        nthreads = threads to parse with (default openmp max threads)
+        Column types come from self.dtypes, then a "# dtypes = " header
+        line, otherwise float64
         """
         self.titles = []
+        filedtypes = {}
         self.parameters = parameters.parameters(filename=filename)
         self.ncols = 0
         self.nrows = 0
-        i = 0
         # Check if this is a hdf file: magic number
         with open(filename,"rb") as f:
             magic = f.read(4)
@@ -281,42 +535,46 @@ class columnfile(object):
             print("Reading your columnfile in hdf format")
             colfile_from_hdf( filename, obj = self )
             return
-        with open(filename,"r") as f:
-            raw = f.readlines()
-        header = True
-        while header and i < len(raw):
-             if len(raw[i].lstrip())==0:
-                 # skip blank lines
-                 i += 1
-                 continue
-             if raw[i][0] == "#":
-                 # title line
-                 if raw[i].find("=") > -1:
-                     # key = value line
-                     name, value = clean(raw[i][1:].split("=",1))
-                     self.parameters.addpar(
-                         parameters.par( name, value ) )
-                 else:
-                     self.titles = raw[i][1:].split()
-                 i += 1
-             else:
-                 header = False
-        try:
-            row0 = [ float( v ) for v in raw[i].split() ]
-            lastrow = [ float( v ) for v in raw[-1].split() ]
-            if len(row0) == len(lastrow ):
-                nrows = len(raw)-i
-                last = len(raw)
-            else:
-                nrows = len(raw)-i-1 # skip the last row
-                last = len(raw)-1
-            cols = [ np.empty( nrows , np.float ) for _ in range(len(row0))]
-            fillcols( raw[i:last], cols )
-            self.__data=cols
-        except:
-            raise # Exception("Problem interpreting your colfile")
-        self.ncols, self.nrows = len(row0), nrows
+        with open(filename,"rb") as f:
+            while True:
+                pos = f.tell()
+                line = f.readline().decode()
+                if len(line) == 0:
+                    break
+                if len(line.lstrip())==0:
+                    # skip blank lines
+                    continue
+                if line[0] == "#":
+                    # title line
+                    if line.find("=") > -1:
+                        # key = value line
+                        name, value = clean(line[1:].split("=",1))
+                        if name == "dtypes":
+                            filedtypes = parse_dtypes( value )
+                            continue
+                        self.parameters.addpar(
+                            parameters.par( name, value ) )
+                    else:
+                        self.titles = line[1:].split()
+                else:
+                    f.seek( pos )
+                    break
+            ncols = len( line.split() )
+            if ncols == 0:
+                # no data rows
+                ncols = len( self.titles )
+            dtypes = None
+            filedtypes.update( self.dtypes )
+            self.dtypes = filedtypes
+            if ncols == len( self.titles ) and len( self.dtypes ) > 0:
+                dtypes = [ self.dtype( t ) for t in self.titles ]
+            cols = read_float_columns( f, ncols, nthreads, dtypes = dtypes )
+        self.__data = cols
+        self.ncols = len( cols )
+        self.nrows = len( cols[0] ) if len( cols ) else 0
         self.parameters.dumbtypecheck()
+        self.clear_indexes()
+        self._geometry = {} # rows changed, see updateGeometry
         self.set_attributes()
 
 
@@ -327,17 +585,19 @@ class columnfile(object):
         self.chkarray()
         if len(mask) != self.nrows:
             raise Exception("Mask is the wrong size")
-        msk = np.array( mask, dtype=np.bool )
+        msk = np.array( mask, dtype=bool )
         # back to list here
         self.__data = [col[msk] for col in self.__data]
         self.nrows = len(self.__data[0])
+        self.clear_indexes()
+        self._geometry = {} # rows changed, see updateGeometry
         self.set_attributes()
 
     def copy(self):
         """
         Returns a (deep) copy of the columnfile
         """
-        cnw = columnfile(self.filename, new = True)
+        cnw = columnfile(self.filename, new = True, dtypes = self.dtypes)
         self.chkarray()
         cnw.titles = [t for t in self.titles ]
         cnw.parameters = parameters.parameters( **self.parameters.parameters )
@@ -351,7 +611,7 @@ class columnfile(object):
         Returns a copy of select rows of the columnfile
         """
         self.chkarray()
-        cnw = columnfile(self.filename, new = True)
+        cnw = columnfile(self.filename, new = True, dtypes = self.dtypes)
         cnw.titles = [t for t in self.titles ]
         cnw.parameters = self.parameters
         cnw.bigarray = [col[rows] for col in self.__data]
@@ -371,9 +631,12 @@ class columnfile(object):
         """
         Add a new column col to the object with name "name"
         Overwrites in the case that the column already exists
+        Converted to self.dtypes[name] if that was declared
         """
         if len(col) != self.nrows:
             raise Exception("Wrong length column")
+        if name in self.dtypes:
+            col = np.asarray( col, dtype = self.dtypes[name] )
         if name in self.titles:
             idx = self.titles.index(name)
             # Make this overwrite instead of throwing an exception
@@ -387,6 +650,7 @@ class columnfile(object):
             idx = len(self.titles)-1
             self.ncols += 1
             self.__data.append( data )
+        self.clear_indexes( name )
         setattr(self, name, self.__data[idx] )
 
     # Not obvious, but might be a useful alias
@@ -407,53 +671,95 @@ class columnfile(object):
         self.parameters = pars
         self.parameters.dumbtypecheck()
 
-    def updateGeometry(self, pars=None ):
+    def _geometry_done(self, step, parnames, inputs, outputs):
+        """
+        True if step was done with the current values of parnames on
+        the same input columns and the outputs are still our columns
+        """
+        if step not in self._geometry:
+            return False
+        key, ins, outs, keep = self._geometry[step]
+        return key == [ self.parameters.parameters.get( p )
+                        for p in parnames ] and \
+            all( [ a is b for a, b in zip( ins, inputs ) ] ) and \
+            all( [ getattr( self, t, None ) is o
+                   for t, o in zip( outputs, outs ) ] )
+
+    def _geometry_save(self, step, parnames, inputs, outputs, cols,
+                       keep=None):
+        """ Adds the columns and remembers how they were made """
+        for t, c in zip( outputs, cols ):
+            self.addcolumn( c, t )
+        self._geometry[step] = (
+            [ self.parameters.parameters.get( p ) for p in parnames ],
+            inputs, [ getattr( self, t ) for t in outputs ], keep )
+
+    def updateGeometry(self, pars=None, force=False ):
         """
         changing or not the parameters it (re)-computes:
            xl,yl,zl = ImageD11.transform.compute_xyz_lab
            tth, eta = ImageD11.transform.compute_tth_eta
            gx,gy,gz = ImageD11.transform.compute_g_vectors
+        Each step is only redone when its parameters (XYZ_PARS,
+        TTH_ETA_PARS, GVEC_PARS, wavelength) or input columns have
+        changed. Columns are compared by identity, so use force=True if
+        you edited the peak positions or omega in place.
         """
         if pars is not None:
             self.setparameters( pars )
         pars = self.parameters
+        if force:
+            self._geometry = {}
         if "sc" in self.titles and "fc" in self.titles:
             pks = self.sc, self.fc
         elif "xc" in self.titles and "yc" in self.titles:
             pks = self.xc, self.yc
         else:
             raise Exception("columnfile file misses xc/yc or sc/fc")
-        xl,yl,zl = transform.compute_xyz_lab( pks,
-                                          **pars.parameters)
-        peaks_xyz = np.array((xl,yl,zl))
         assert "omega" in self.titles,"No omega column"
-        om = self.omega *  float( pars.get("omegasign") )
-        tth, eta = transform.compute_tth_eta_from_xyz(
-            peaks_xyz, om,
-            **pars.parameters)
-        gx, gy, gz = transform.compute_g_vectors(
-            tth, eta, om,
-            wvln  = pars.get("wavelength"),
-            wedge = pars.get("wedge"),
-            chi   = pars.get("chi") )
-        modg =  np.sqrt( gx * gx + gy * gy + gz * gz )
-        self.addcolumn(xl,"xl")
-        self.addcolumn(yl,"yl")
-        self.addcolumn(zl,"zl")
-        self.addcolumn(tth, "tth", )
-        self.addcolumn(eta, "eta", )
-        self.addcolumn(gx, "gx")
-        self.addcolumn(gy, "gy")
-        self.addcolumn(gz, "gz")
-        self.addcolumn(modg, "ds") # dstar
+        outputs = ( "xl", "yl", "zl" )
+        if not self._geometry_done( "xyz", XYZ_PARS, pks, outputs ):
+            # rows of peaks_xyz become the columns
+            peaks_xyz = transform.compute_xyz_lab( pks, **pars.parameters )
+            self._geometry_save( "xyz", XYZ_PARS, pks, outputs, peaks_xyz,
+                                 keep = peaks_xyz )
+        peaks_xyz = self._geometry["xyz"][3]
+        om = None
+        inputs = ( self.xl, self.yl, self.zl, self.omega )
+        outputs = ( "tth", "eta" )
+        if not self._geometry_done( "tth_eta", TTH_ETA_PARS, inputs, outputs ):
+            om = self.omega *  float( pars.get("omegasign") )
+            tth, eta = transform.compute_tth_eta_from_xyz(
+                peaks_xyz, om,
+                **pars.parameters)
+            self._geometry_save( "tth_eta", TTH_ETA_PARS, inputs, outputs,
+                                 ( tth, eta ) )
+        inputs = ( self.tth, self.eta, self.omega )
+        if not self._geometry_done( "g1", GVEC_PARS, inputs, () ):
+            # g-vectors for wavelength 1, the wavelength only scales them
+            if om is None:
+                om = self.omega *  float( pars.get("omegasign") )
+            g1 = transform.compute_g_vectors(
+                self.tth, self.eta, om,
+                wvln  = 1.0,
+                wedge = pars.get("wedge"),
+                chi   = pars.get("chi") )
+            self._geometry_save( "g1", GVEC_PARS, inputs, (), (), keep = g1 )
+        inputs = ( self._geometry["g1"][3], )
+        outputs = ( "gx", "gy", "gz", "ds" )
+        if not self._geometry_done( "g", ["wavelength"], inputs, outputs ):
+            g = inputs[0] / float( pars.get("wavelength") )
+            modg = np.sqrt( ( g * g ).sum( axis = 0 ) ) # dstar
+            self._geometry_save( "g", ["wavelength"], inputs, outputs,
+                                 ( g[0], g[1], g[2], modg ) )
 
 
 
 class newcolumnfile(columnfile):
     """ Just like a columnfile, but for creating new
     files """
-    def __init__(self, titles):
-        columnfile.__init__(self, filename=None, new=True)
+    def __init__(self, titles, dtypes=None):
+        columnfile.__init__(self, filename=None, new=True, dtypes=dtypes)
         self.titles = titles
         self.ncols = len(titles)
         
@@ -470,6 +776,401 @@ def colfile_from_dict( c ):
     return colf
 
 
+# Put titles back in the order folks might have hard wired in their
+# programs when reading hdf or npy columns
+STANDARD_ORDER = [
+    'sc', 'fc', 'omega' , 'Number_of_pixels',  'avg_intensity',
+    's_raw',  'f_raw',  'sigs',  'sigf',  'covsf' , 'sigo',  'covso',
+    'covfo',  'sum_intensity',  'sum_intensity^2',  'IMax_int',  'IMax_s',
+    'IMax_f',  'IMax_o',  'Min_s',  'Max_s',  'Min_f',  'Max_f',  'Min_o',
+    'Max_o',  'dety',  'detz',  'onfirst',  'onlast',  'spot3d_id',  'xl',
+    'yl',  'zl',  'tth',  'eta',  'gx',  'gy',  'gz']
+
+def order_titles( titles ):
+    """ Standard titles first, anything else goes in alphabetically """
+    newtitles = [ t for t in STANDARD_ORDER if t in titles ]
+    newtitles += sorted( [ t for t in titles if t not in newtitles ] )
+    return newtitles
+
+def find_peaks_group( h, name, filename ):
+    """ The group name in the open hdf file h, or the only peaks group """
+    if hasattr(h, 'listnames'):
+        groups = h.listnames()
+    else: # API changed
+        groups = list(h.keys())
+    if name is not None:
+        if name in groups:
+            return h[name]
+        print(groups)
+        raise Exception("Did not find your "+str(name)+" in "+str(filename))
+    groups = [g for g in groups
+                        if 'ImageD11_type' in h[g].attrs and
+                           h[g].attrs['ImageD11_type'] in ('peaks', b'peaks') ]
+    assert len(groups) == 1, "Your hdf file has many groups. Which one??"+str(groups)
+    return h[groups[0]]
+
+def hdf_parameters( g, pars ):
+    """ Adds the attributes of the hdf group g (see columnfile_writer) """
+    for k, v in g.attrs.items():
+        if k == 'ImageD11_type':
+            continue
+        if hasattr( v, 'decode' ):
+            v = v.decode()
+        pars.addpar( parameters.par( k, v ) )
+
+
+class hdf_columns(object):
+    """
+    Columns in a group of a hdf file, read one at a time.
+    Contiguous uncompressed datasets are memory mapped (copy on write).
+    Group attributes are added to pars if given.
+    """
+    def __init__(self, filename, name=None, pars=None):
+        import h5py
+        self.filename = filename
+        with h5py.File( filename, 'r', swmr=True ) as h:
+            g = find_peaks_group( h, name, filename )
+            self.name = g.name
+            if pars is not None:
+                hdf_parameters( g, pars )
+            self.titles = order_titles( list( g.keys() ) )
+            # columns can differ in length while a writer is busy
+            self.nrows = min( [ len( g[t] ) for t in self.titles ] ) \
+                if self.titles else 0
+
+    def read(self, title):
+        import h5py
+        with h5py.File( self.filename, 'r', swmr=True ) as h:
+            ds = h[self.name][title]
+            offset = None
+            if ds.chunks is None and ds.compression is None and ds.size > 0:
+                offset = ds.id.get_offset()
+            if offset is None:
+                return ds[:self.nrows]
+            dtype, shape = ds.dtype, ds.shape
+        return np.memmap( self.filename, mode='c', dtype=dtype, shape=shape,
+                          offset=offset )
+
+
+class npy_columns(object):
+    """
+    Columns saved as title.npy files in a directory (see colfile_to_npy)
+    Memory mapped (copy on write)
+    """
+    def __init__(self, dirname):
+        import os
+        self.filename = dirname
+        self.titles = order_titles( [ f[:-4] for f in os.listdir( dirname )
+                                      if f.endswith( ".npy" ) ] )
+        self.nrows = len( self.read( self.titles[0] ) ) if self.titles else 0
+
+    def read(self, title):
+        import os
+        fname = os.path.join( self.filename, title + ".npy" )
+        try:
+            return np.load( fname, mmap_mode='c' )
+        except ValueError: # empty arrays can not be mapped
+            return np.load( fname )
+
+
+class lazycolumnfile(columnfile):
+    """
+    A columnfile with the columns in a hdf group or directory of .npy
+    files. Columns are only read when first used. filter, copyrows and
+    reorder just remember which rows are wanted until a column is read.
+    Use this for big files where you only need a few of the columns.
+    """
+    def __init__(self, filename, name=None):
+        import os
+        columnfile.__init__( self, filename, new=True )
+        if os.path.isdir( filename ):
+            self._source = npy_columns( filename )
+            parfile = os.path.join( filename, "parameters.par" )
+            if os.path.exists( parfile ):
+                self.parameters.loadparameters( parfile )
+        else:
+            self._source = hdf_columns( filename, name, self.parameters )
+        self.titles = list( self._source.titles )
+        self.ncols = len( self.titles )
+        self.nrows = self._source.nrows
+        self._rows = None # all of them
+
+    def __getattr__(self, name):
+        # only called for columns which are not read yet
+        d = self.__dict__
+        if name.startswith( "_" ) or name not in d.get( 'titles', () ):
+            raise AttributeError( name )
+        col = self._source.read( name )
+        if self._rows is not None:
+            col = col[ self._rows ]
+        d[name] = col
+        return col
+
+    def loaded(self):
+        """ The columns which have been read already """
+        return [ t for t in self.titles if t in self.__dict__ ]
+
+    def _select(self, rows):
+        """ rows is a boolean mask or indices into the current rows """
+        rows = np.asarray( rows )
+        if rows.dtype == bool:
+            rows = np.nonzero( rows )[0]
+        for t in self.loaded():
+            self.__dict__[t] = self.__dict__[t][rows]
+        if self._rows is None:
+            self._rows = rows
+        else:
+            self._rows = self._rows[rows]
+        self.nrows = len( rows )
+        self.clear_indexes()
+        self._geometry = {} # rows changed, see updateGeometry
+
+    def filter(self, mask):
+        """
+        mask is an nrows long array of true/false
+        """
+        if len(mask) != self.nrows:
+            raise Exception("Mask is the wrong size")
+        self._select( np.array( mask, dtype=bool ) )
+
+    def reorder(self, indices):
+        """
+        Put array into the order given by indices
+        """
+        self._select( indices )
+
+    def _copy(self):
+        cnw = columnfile.__new__( lazycolumnfile )
+        cnw.__dict__.update( self.__dict__ )
+        cnw._indexes = {}
+        cnw._geometry = {}
+        cnw.titles = [ t for t in self.titles ]
+        cnw.parameters = parameters.parameters( **self.parameters.parameters )
+        return cnw
+
+    def copy(self):
+        """
+        Returns a copy which shares the (unread) file columns
+        """
+        cnw = self._copy()
+        for t in self.loaded():
+            cnw.__dict__[t] = self.__dict__[t].copy()
+        return cnw
+
+    def copyrows(self, rows):
+        """
+        Returns a copy of select rows of the columnfile
+        """
+        cnw = self._copy()
+        if isinstance( rows, slice ):
+            rows = np.arange( self.nrows )[rows]
+        cnw._select( rows )
+        return cnw
+
+    def addcolumn(self, col, name):
+        """
+        Add a new column col to the object with name "name"
+        Overwrites in the case that the column already exists
+        """
+        if len(col) != self.nrows:
+            raise Exception("Wrong length column")
+        if name not in self.titles:
+            self.titles.append( name )
+            self.ncols += 1
+        if name in self.dtypes:
+            col = np.asarray( col, dtype = self.dtypes[name] )
+        self.__dict__[name] = np.asanyarray( col )
+        self.clear_indexes( name )
+
+    setcolumn = addcolumn
+
+    def getcolumn(self, name):
+        """
+        Gets data, if column exists (reads it if needed)
+        """
+        if name in self.titles:
+            return getattr( self, name )
+        raise KeyError("Name "+name+" not in file")
+
+    def chkarray(self):
+        """
+        Reads all the columns (for writing or bigarray)
+        """
+        self._columnfile__data = [ self.getcolumn( t ) for t in self.titles ]
+
+    def get_bigarray(self):
+        self.chkarray()
+        return columnfile.get_bigarray( self )
+
+    bigarray = property(fget=get_bigarray, fset=columnfile.set_bigarray)
+
+
+class columnfile_writer(object):
+    """
+    Writes a columnfile a block of rows at a time, for peak searches
+    and other things that make more rows than you want in memory.
+
+    Filenames ending .h5 .hdf .hdf5 get resizable chunked datasets in
+    the group name, anything else gets a text file. The text header
+    (parameters given here and titles) is written on opening and the
+    hdf datasets are flushed after each block and the file is in SWMR
+    mode, so a partly written file can already be read, also by other
+    processes (the hdf readers here open files with swmr=True).
+    close() saves self.parameters (as group attributes) for hdf files.
+    dtypes = { title : dtype } for columns which should not get the
+    usual types (see columnfile_writer.dtype), these are also written
+    in the "# dtypes = " header of text files for reading back.
+
+    with columnfile_writer( "peaks.h5", ["sc","fc","omega"] ) as w:
+        for block in blocks:
+            w.write( block ) # dict or columns in titles order
+    """
+    def __init__(self, filename, titles, pars=None, name="peaks",
+                 chunksize=65536, dtypes=None):
+        self.filename = filename
+        self.titles = list( titles )
+        if dtypes is None:
+            dtypes = {}
+        self.dtypes = dict( [ ( t, np.dtype( d ) ) for t, d in
+                              dtypes.items() ] )
+        self.ncols = len( self.titles )
+        self.nrows = 0
+        if pars is None:
+            pars = parameters.parameters()
+        self.parameters = pars
+        self.hdf = str( filename ).lower().endswith( (".h5",".hdf",".hdf5") )
+        if self.hdf:
+            import h5py
+            self.h = h5py.File( filename, 'a', libver='latest' )
+            if name in self.h:
+                del self.h[name]
+            self.group = self.h.create_group( name )
+            self.group.attrs['ImageD11_type'] = 'peaks'
+            for t in self.titles:
+                self.group.create_dataset( t, shape=(0,), maxshape=(None,),
+                                           chunks=(chunksize,),
+                                           dtype=self.dtype( t ) )
+            # no new objects after this, only resize and write
+            self.h.swmr_mode = True
+        else:
+            self.fout = open( filename, "w" )
+            parnames = sorted( self.parameters.get_parameters().keys() )
+            self.fout.write( "".join( [ "# %s = %s\n"%(p,
+                                       str(self.parameters.get(p)))
+                                       for p in parnames ] ) )
+            dtypes = [ "%s:%s"%( t, self.dtypes[t].name )
+                       for t in self.titles if t in self.dtypes ]
+            if len( dtypes ) > 0:
+                self.fout.write( "# dtypes = %s\n"%( " ".join( dtypes ) ) )
+            self.fout.write( "#" + "".join( [ "  %s"%(t) for t in
+                                              self.titles ] ) + "\n" )
+            fmts = []
+            for t in self.titles:
+                if t in FORMATS:
+                    fmts.append( FORMATS[t] )
+                elif self.dtype( t ).kind in "iu":
+                    fmts.append( "%d" )
+                else:
+                    fmts.append( "%f" )
+            self.format_str = "  ".join( fmts )
+            self.fout.flush()
+
+    def dtype(self, title):
+        """
+        The declared type, else default_dtype, but with float64 saved
+        as float32 in hdf files (like colfile_to_hdf)
+        """
+        if title in self.dtypes:
+            return self.dtypes[title]
+        d = default_dtype( title )
+        if self.hdf and d == np.float64:
+            return np.dtype( np.float32 )
+        return d
+
+    def write(self, block):
+        """
+        block is a dict of title : column, a columnfile, or a list of
+        columns in the order of self.titles
+        """
+        if isinstance( block, (dict, columnfile) ):
+            cols = [ np.asarray( block[t] ) for t in self.titles ]
+        else:
+            cols = [ np.asarray( c ) for c in block ]
+        if len( cols ) != self.ncols:
+            raise Exception("Wrong number of columns")
+        n = len( cols[0] )
+        for c in cols:
+            if len( c ) != n:
+                raise Exception("Columns in block are not the same length")
+        if self.hdf:
+            for t, c in zip( self.titles, cols ):
+                ds = self.group[t]
+                ds.resize( ( self.nrows + n, ) )
+                ds[self.nrows:] = c
+            self.h.flush()
+        else:
+            ar = np.array( cols ).T
+            np.savetxt( self.fout, ar, fmt=self.format_str, delimiter="  " )
+            self.fout.flush()
+        self.nrows += n
+
+    def close(self):
+        """ Finish off the file """
+        if self.hdf:
+            if self.h:
+                pars = self.parameters.get_parameters()
+                try:
+                    for k in pars:
+                        self.group.attrs[k] = pars[k]
+                    self.h.close()
+                except (OSError, RuntimeError):
+                    # attributes not allowed in SWMR mode by this hdf5
+                    self.h.close()
+                    import h5py
+                    with h5py.File( self.filename, 'a' ) as h:
+                        for k in pars:
+                            h[self.group.name].attrs[k] = pars[k]
+                self.h = None
+        else:
+            self.fout.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def hdf_dtype( colfile, title, col ):
+    """
+    Type for saving a column in hdf. The declared type, else int32 for
+    INTS titles, float64 saved as float32 and other types kept
+    """
+    if title in colfile.dtypes:
+        return colfile.dtypes[title]
+    if title in INTS:
+        return default_dtype( title )
+    if col.dtype == np.float64:
+        return np.dtype( np.float32 )
+    return col.dtype
+
+def colfile_to_npy( colfile, dirname ):
+    """
+    Save a columnfile as a directory of title.npy files and
+    parameters.par to open with lazycolumnfile
+    """
+    import os
+    if not isinstance(colfile, columnfile):
+        colfile = columnfile( colfile )
+    if not os.path.isdir( dirname ):
+        os.makedirs( dirname )
+    for t in colfile.titles:
+        np.save( os.path.join( dirname, t + ".npy" ), colfile.getcolumn( t ) )
+    colfile.parameters.saveparameters( os.path.join( dirname,
+                                                     "parameters.par" ) )
+
+
+
 try:
     import h5py, os
     def colfile_to_hdf( colfile, hdffile, name=None, compression=None,
@@ -500,12 +1201,8 @@ try:
             g = h.create_group( name )
         g.attrs['ImageD11_type'] = 'peaks'
         for t in c.titles:
-            if t in INTS:
-                ty = np.int32
-            else:
-                ty = np.float32
-            # print "adding",t,ty
-            dat = getattr(c, t).astype( ty )
+            dat = getattr(c, t)
+            dat = dat.astype( hdf_dtype( c, t, dat ) )
             if t in list(g.keys()):
                 if g[t].shape != dat.shape:
                     g[t].resize( dat.shape )
@@ -532,65 +1229,35 @@ try:
             raise
         g.attrs['ImageD11_type'] = 'peaks'
         for t in cf.titles:
-            if t in INTS:
-                ty = np.int32
-            else:
-                ty = np.float32
-            g.create_dataset( t, data = getattr(cf, t).astype( ty ) )
+            dat = getattr(cf, t)
+            g.create_dataset( t, data = dat.astype( hdf_dtype( cf, t, dat ) ) )
         h.close()
 
-    def colfile_from_hdf( hdffile , name=None, obj=None ):
+    def colfile_from_hdf( hdffile , name=None, obj=None, lazy=False ):
         """
         Read a columnfile from a hdf file
+        lazy = True gives a lazycolumnfile which reads columns when used
         FIXME TODO - add the parameters somewhere (attributes??)
         """
-        import time
-        h = h5py.File( hdffile, 'r' )
-        if hasattr(h, 'listnames'):
-            groups = h.listnames()
-        else: # API changed
-            groups = list(h.keys())
-        if name is not None:
-            if name in groups:
-                g = h[name]
-            else:
-                print(groups)
-                raise Exception("Did not find your "+str(name)+" in "+hdffile)
-        else:
-            groups = [g for g in groups 
-                                if 'ImageD11_type' in h[g].attrs and 
-                                   h[g].attrs['ImageD11_type'] in ('peaks', b'peaks') ]
-            assert len(groups) == 1, "Your hdf file has many groups. Which one??"+str(groups)
-            g = h[groups[0]]
-            name = groups[0]
+        if lazy:
+            return lazycolumnfile( hdffile, name )
+        h = h5py.File( hdffile, 'r', swmr=True )
+        g = find_peaks_group( h, name, hdffile )
+        name = g.name.split("/")[-1]
         if hasattr(g, 'listnames'):
             titles = g.listnames()
         else: # API changed
             titles = list(g.keys())
-        otitles = [t for t in titles]
-        otitles.sort()
-        newtitles = []
-        # Put them back in the order folks might have hard wired in their
-        # programs
-        for t in ['sc', 'fc', 'omega' , 'Number_of_pixels',  'avg_intensity',
-        's_raw',  'f_raw',  'sigs',  'sigf',  'covsf' , 'sigo',  'covso',
-        'covfo',  'sum_intensity',  'sum_intensity^2',  'IMax_int',  'IMax_s',
-        'IMax_f',  'IMax_o',  'Min_s',  'Max_s',  'Min_f',  'Max_f',  'Min_o',
-        'Max_o',  'dety',  'detz',  'onfirst',  'onlast',  'spot3d_id',  'xl',
-        'yl',  'zl',  'tth',  'eta',  'gx',  'gy',  'gz']:
-            if t in otitles:
-                newtitles.append(t)
-                otitles.remove(t)
-        # Anything else goes in alphabetically
-        [newtitles.append(t) for t in otitles]
-        assert len(newtitles) == len( titles )
+        newtitles = order_titles( titles )
         if obj is None:
             col = columnfile( filename=name, new=True )
         else:
             col = obj
-        col.nrows = len( g[newtitles[0]] )
+        # columns can differ in length while a writer is busy
+        col.nrows = min( [ len( g[t] ) for t in newtitles ] )
         for name in newtitles:
-            col.addcolumn( g[name][:].copy(), name )
+            col.addcolumn( g[name][:col.nrows].copy(), name )
+        hdf_parameters( g, col.parameters )
         h.close()
         return col
 
@@ -601,7 +1268,7 @@ except ImportError:
     def colfile_to_hdf( a,b,name=None):
         hdferr()
 
-    def colfile_from_hdf( hdffile , name=None ):
+    def colfile_from_hdf( hdffile , name=None, obj=None, lazy=False ):
         hdferr()
 
     def colfileobj_to_hdf( cf, hdffile, name=None):
@@ -639,37 +1306,125 @@ import sqlite3 as database_module
 # Doubtless one does not get away with using a filename?
 
 
-def colfile2db( colfilename, dbname ):
+DB_INDEXES = [ "spot3d_id", "labels", "omega" ]
+
+def db_title( title ):
+    """ Not allowed for sql to have ^ in string """
+    return title.replace( "^", "_pow_" )
+
+def colfile2db( colfilename, dbname, table = "peaks", indexes = None,
+                batch = 100000 ):
     """
-    Read the columnfile into a database
-    Ignores parameter metadata (not used yet)
+    Read the columnfile (or a filename) into a database table
+    Integer columns are INTEGER, the others REAL. The rows go in with
+    executemany, batch rows per transaction, and then an index is made
+    for each title in indexes (default: those of DB_INDEXES in the file).
+    The parameters go in the table "<table>_parameters" (name, value).
+    An existing table of the same name is replaced.
     """
-    colf = columnfile( colfilename )
+    if isinstance( colfilename, columnfile ):
+        colf = colfilename
+    else:
+        colf = columnfile( colfilename )
+    if indexes is None:
+        indexes = [ t for t in DB_INDEXES if t in colf.titles ]
     dbo = database_module.connect( dbname )
     curs = dbo.cursor()
     # Build up columnames and types to make table
+    cols = [ colf.getcolumn( t ) for t in colf.titles ]
     tablecols = []
-    # Not allowed for sql to have ^ in string
-    colf.titles = [t.replace("^","_pow_") for t in colf.titles]
-    for name in colf.titles:
-        if name in INTS:
-            tablecols.append(name + " INTEGER")
-            continue
-        if name in FLOATS:
-            tablecols.append(name + " REAL")
-            continue
-        tablecols.append(name + " REAL")
-    curs.execute("create table peaks \n( " + \
-                 " , ".join(tablecols)     + " ) ; \n" )
+    for name, col in zip( colf.titles, cols ):
+        if col.dtype.kind in "iub":
+            tablecols.append( '"%s" INTEGER'%( db_title( name ) ) )
+        else:
+            tablecols.append( '"%s" REAL'%( db_title( name ) ) )
+    partable = table + "_parameters"
+    curs.execute( 'drop table if exists "%s"'%( table ) )
+    curs.execute( 'drop table if exists "%s"'%( partable ) )
+    curs.execute( 'create table "%s" ( '%( table ) +
+                  " , ".join( tablecols ) + " )" )
+    curs.execute( 'create table "%s" ( name TEXT PRIMARY KEY, value )'%(
+        partable ) )
+    pars = colf.parameters.get_parameters()
+    curs.executemany( 'insert into "%s" values ( ?, ? )'%( partable ),
+                      [ ( k, pars[k] ) for k in sorted( pars.keys() )
+                        if isinstance( pars[k], (int, float, str) ) ] )
+    dbo.commit()
     # Make a format string for inserting data
-    ins = "insert into peaks values ("  + \
-          ",".join(["?"]*colf.ncols)    +") ;"
-    # insert the data
-    for i in range(colf.nrows):
-        curs.execute( ins , tuple(colf.bigarray[:, i]) )
-    curs.close()
+    ins = 'insert into "%s" values ('%( table ) + \
+          ",".join( ["?"] * len( cols ) ) + ")"
+    # insert the data, tolist gives python int and float
+    for i in range( 0, colf.nrows, batch ):
+        curs.executemany( ins, zip( *[ col[i:i+batch].tolist()
+                                       for col in cols ] ) )
+        dbo.commit()
+    for name in indexes:
+        curs.execute( 'create index "%s_%s" on "%s" ( "%s" )'%(
+            table, db_title( name ), table, db_title( name ) ) )
     dbo.commit()
+    curs.close()
+    dbo.close()
+
+def colfile_from_db( dbname, where = None, args = (), table = "peaks",
+                     titles = None, batch = 100000 ):
+    """
+    Read a columnfile from a database made by colfile2db
+    where = sql condition to select rows, eg: "labels = ? and tth < ?"
+    args = values for the ? in where
+    titles = columns to read (default all of them)
+    """
+    dbo = database_module.connect( dbname )
+    curs = dbo.cursor()
+    coltypes = dict( [ ( row[1], row[2] ) for row in
+                       curs.execute( 'pragma table_info("%s")'%( table ) ) ] )
+    if len( coltypes ) == 0:
+        raise Exception( "No table %s in %s"%( table, dbname ) )
+    if titles is None:
+        names = [ row[1] for row in
+                  curs.execute( 'pragma table_info("%s")'%( table ) ) ]
+    else:
+        names = [ db_title( t ) for t in titles ]
+    sql = 'select ' + ", ".join( [ '"%s"'%( n ) for n in names ] ) + \
+          ' from "%s"'%( table )
+    if where is not None:
+        sql += " where " + where
+    curs.execute( sql, tuple( args ) )
+    blocks = []
+    while True:
+        rows = curs.fetchmany( batch )
+        if len( rows ) == 0:
+            break
+        try:
+            ar = np.array( rows, float )
+        except TypeError:
+            # NULL (nan was saved as NULL)
+            ar = np.array( [ [ np.nan if v is None else v for v in row ]
+                             for row in rows ], float )
+        blocks.append( ar.reshape( len(rows), len(names) ) )
+    if len( blocks ):
+        ar = np.concatenate( blocks ).T
+    else:
+        ar = np.zeros( ( len(names), 0 ) )
+    colf = columnfile( filename = None, new = True )
+    colf.nrows = ar.shape[1]
+    partable = table + "_parameters"
+    if curs.execute( "select name from sqlite_master where type='table'"
+                     " and name = ?", ( partable, ) ).fetchone() is not None:
+        for name, value in curs.execute( 'select name, value from "%s"'%(
+                partable ) ):
+            colf.parameters.addpar( parameters.par( name, value ) )
+    curs.close()
     dbo.close()
+    for name, col in zip( names, ar ):
+        title = name.replace( "_pow_", "^" )
+        if coltypes[name] == "INTEGER":
+            dtype = default_dtype( title )
+            if dtype.kind not in "iu":
+                dtype = np.int64
+            col = col.astype( dtype )
+        colf.addcolumn( col, title )
+    return colf
+
 
 if __name__ == "__main__":
     bench()
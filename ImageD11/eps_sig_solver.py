@@ -58,6 +58,90 @@ def write_ubi_file(filename, ubilist):
 
 
 
+EPS_SIG_TITLES = (
+    "cell__a cell__b cell__c cell_alpha cell_beta cell_gamma "
+    "u11 u12 u13 u21 u22 u23 u31 u32 u33 "
+    "eps11_c eps22_c eps33_c eps12_c eps13_c eps23_c "
+    "eps11_s eps22_s eps33_s eps12_s eps13_s eps23_s "
+    "sig11_c sig22_c sig33_c sig12_c sig13_c sig23_c "
+    "sig11_s sig22_s sig33_s sig12_s sig13_s sig23_s" ).split()
+
+# order of the tensor components in the output
+VOIGT_ORDER = [(0,0),(1,1),(2,2),(0,1),(0,2),(1,2)]
+
+
+def ubis_to_cells( ubis ):
+    """ Unit cells [N,6] for ubis [N,3,3] (as xfab.tools.ubi_to_cell) """
+    ubis = np.asarray( ubis, float )
+    g = np.matmul( ubis, np.transpose( ubis, (0,2,1) ) )
+    a, b, c = [ np.sqrt( g[:,i,i] ) for i in range(3) ]
+    alpha = np.degrees( np.arccos( g[:,1,2]/b/c ) )
+    beta  = np.degrees( np.arccos( g[:,0,2]/a/c ) )
+    gamma = np.degrees( np.arccos( g[:,0,1]/a/b ) )
+    return np.array( ( a, b, c, alpha, beta, gamma ) ).T
+
+def cells_to_B( cells ):
+    """ B matrices [N,3,3] for cells [N,6] (as xfab.tools.form_b_mat) """
+    cells = np.atleast_2d( np.asarray( cells, float ) )
+    a, b, c = cells[:,0], cells[:,1], cells[:,2]
+    calp, cbet, cgam = [ np.cos( np.radians( cells[:,i] ) ) for i in (3,4,5) ]
+    salp, sbet, sgam = [ np.sin( np.radians( cells[:,i] ) ) for i in (3,4,5) ]
+    V = a*b*c*np.sqrt( 1 - calp*calp - cbet*cbet - cgam*cgam +
+                       2*calp*cbet*cgam )
+    astar = 2*np.pi*b*c*salp/V
+    bstar = 2*np.pi*a*c*sbet/V
+    cstar = 2*np.pi*a*b*sgam/V
+    sbetstar = V/(a*b*c*salp*sgam)
+    sgamstar = V/(a*b*c*salp*sbet)
+    cbetstar = (calp*cgam-cbet)/(salp*sgam)
+    cgamstar = (calp*cbet-cgam)/(salp*sbet)
+    B = np.zeros( (len(cells), 3, 3) )
+    B[:,0,0] = astar
+    B[:,0,1] = bstar*cgamstar
+    B[:,0,2] = cstar*cbetstar
+    B[:,1,1] = bstar*sgamstar
+    B[:,1,2] = -cstar*sbetstar*calp
+    B[:,2,2] = cstar*sbetstar*salp
+    return B
+
+def ubis_to_u_and_eps( ubis, unit_cell ):
+    """
+    Vectorised xfab.tools.ubi_to_u_and_eps
+    ubis = [N,3,3] array of ubi matrices
+    unit_cell = unstrained [a,b,c,alpha,beta,gamma]
+    returns U [N,3,3] and the strain tensors [N,3,3] in the crystal frame
+    """
+    ubis = np.asarray( ubis, float )
+    B = cells_to_B( ubis_to_cells( ubis ) )
+    U = np.transpose( np.matmul( B, ubis ), (0,2,1) ) / (2*np.pi)
+    B0 = cells_to_B( unit_cell )[0]
+    T = np.matmul( B0, np.linalg.inv( B ) )
+    eps = 0.5*( T + np.transpose( T, (0,2,1) ) ) - np.eye(3)
+    return U, eps
+
+def stress_operator( C ):
+    """
+    Linear map from strain to stress, S[3,3,3,3], so that
+    sig_ij = sum_kl S_ijkl eps_kl. Found by applying strain2stress
+    (from FitAllB) to unit strains so the conventions are the same.
+    """
+    S = np.zeros( (3,3,3,3) )
+    for k in range(3):
+        for l in range(k,3):
+            e = np.zeros( (3,3) )
+            e[k,l] = e[l,k] = 1
+            sig = np.asarray( strain2stress( e, C ) )
+            if k == l:
+                S[:,:,k,l] = sig
+            else:
+                S[:,:,k,l] = S[:,:,l,k] = sig / 2
+    return S
+
+def rotate_tensors( U, t ):
+    """ U.t.U.T for stacks of [N,3,3] matrices """
+    return np.matmul( U, np.matmul( t, np.transpose( U, (0,2,1) ) ) )
+
+
 class solver:
     """
     A class for getting strain and stress tensors
@@ -186,56 +270,66 @@ class solver:
                                c66=self.c66)
           
 
+    def compute_eps_sig(self):
+        """
+        Strain and stress for all ubis at once, in crystal and sample
+        co-ordinates. Returns a columnfile with the columns of
+        EPS_SIG_TITLES. Strains are in percent. The stress columns are
+        missing if the stiffness could not be used.
+        """
+        ubis = np.array( self.ubis, float ).reshape( -1, 3, 3 )
+        U, epsC = ubis_to_u_and_eps( ubis, self.unitcell() )
+        epsS = rotate_tensors( U, epsC )
+        cols = {}
+        for t, v in zip( EPS_SIG_TITLES[:6], ubis_to_cells( ubis ).T ):
+            cols[t] = v
+        for t, v in zip( EPS_SIG_TITLES[6:15], U.reshape( -1, 9 ).T ):
+            cols[t] = v
+        for (i,j) in VOIGT_ORDER:
+            cols["eps%d%d_c"%(i+1,j+1)] = 100.*epsC[:,i,j]
+            cols["eps%d%d_s"%(i+1,j+1)] = 100.*epsS[:,i,j]
+        try:
+            S = stress_operator( self.MVStiffness() )
+        except:
+            print("couldn't compute stress! please check the crystal_symmetry parameters and elastic constants")
+            S = None
+        if S is not None:
+            sigC = np.einsum( 'ijkl,nkl->nij', S, epsC )
+            sigS = rotate_tensors( U, sigC )
+            for (i,j) in VOIGT_ORDER:
+                cols["sig%d%d_c"%(i+1,j+1)] = sigC[:,i,j]
+                cols["sig%d%d_s"%(i+1,j+1)] = sigS[:,i,j]
+        titles = [ t for t in EPS_SIG_TITLES if t in cols ]
+        colf = columnfile.newcolumnfile( titles )
+        colf.nrows = len( ubis )
+        colf.set_bigarray( [ cols[t] for t in titles ] )
+        return colf
+
     def compute_write_eps_sig(self,outputfile):
-        """    Compute strain and stress in crystal and sample co-ordinates system    """
-        
-        if self.ubis is not None:
-            
-            writestress = True
-            
-            f = open(outputfile,'w')
-            ''' the used parameters will be the header of the output file'''
-            for k,v in sorted(self.parameterobj.parameters.items()):
-                f.write(("%s %s\n")%(k,v))
-            ''' write titles'''
-            f.write("##############################################\n")
-            f.write("cell__a cell__b cell__c cell_alpha cell_beta cell_gamma u11 u12 u13 u21 u22 u23 u31 u32 u33 ")
-            f.write("eps11_c eps22_c eps33_c eps12_c eps13_c eps23_c eps11_s eps22_s eps33_s eps12_s eps13_s eps23_s ")
-            f.write("sig11_c sig22_c sig33_c sig12_c sig13_c sig23_c sig11_s sig22_s sig33_s sig12_s sig13_s sig23_s\n")
-            
-            '''this is the part where we compute strain and stress'''
-            for ubi in self.ubis:
-                U, eps = ubi_to_u_and_eps(ubi, self.unitcell())
-                #U, eps = ubi_to_u_and_eps(ubi, ubi_to_cell(self.ubis[0]))
-                epsM = [ [ eps[0], eps[1], eps[2] ],        #write the strain tensor list as a matrix
-                         [ eps[1], eps[3], eps[4] ],
-                         [ eps[2], eps[4], eps[5] ] ]
-                epsS = np.dot( U, np.dot( epsM, U.T ) )     #epsilon in sample co-ordinates
-                sigM= np.empty((3,3))
-                sigS= np.empty((3,3))
-                try:
-                    sigM = strain2stress( np.array(epsM), self.MVStiffness() )      #write the stress tensor as a symmetric matrix in crystal co-ordinates
-                    sigS = np.dot( U, np.dot( sigM, U.T ) )     #sigma in sample co-ordinates
-                except:
-                    print("couldn't compute stress! please check the crystal_symmetry parameters and elastic constants")
-                    writestress = False
-                
-                
-                ''' writing down the results'''
-                
-                f.write(("%f "*6)%tuple(ubi_to_cell(ubi)))
-                f.write(("%f "*9)%tuple(U.ravel()))
-                ligne = ""
-                for i,j in [(0,0),(1,1),(2,2),(0,1),(0,2),(1,2)]:
-                    ligne = ligne + " " + str(100.*np.array(epsM)[i,j])
-                for i,j in [(0,0),(1,1),(2,2),(0,1),(0,2),(1,2)]:
-                    ligne = ligne + " " + str(100.*epsS[i,j])
-                if writestress==True:
-                    for i,j in [(0,0),(1,1),(2,2),(0,1),(0,2),(1,2)]:
-                        ligne = ligne + " " + str(np.array(sigM)[i,j])
-                    for i,j in [(0,0),(1,1),(2,2),(0,1),(0,2),(1,2)]:
-                        ligne = ligne + " " + str(sigS[i,j])
-                
-                f.write(ligne[1:])
-                f.write("\n")
-            f.close()
+        """
+        Compute strain and stress in crystal and sample co-ordinates
+        system. Output files ending .h5/.hdf/.hdf5 get a table named
+        eps_sig, anything else is text.
+        """
+        if self.ubis is None:
+            return
+        colf = self.compute_eps_sig()
+        if outputfile.split(".")[-1] in ( "h5", "hdf", "hdf5" ):
+            columnfile.colfile_to_hdf( colf, outputfile, name = "eps_sig" )
+            return
+        f = open(outputfile,'w')
+        ''' the used parameters will be the header of the output file'''
+        for k,v in sorted(self.parameterobj.parameters.items()):
+            f.write(("%s %s\n")%(k,v))
+        ''' write titles'''
+        f.write("##############################################\n")
+        f.write("cell__a cell__b cell__c cell_alpha cell_beta cell_gamma u11 u12 u13 u21 u22 u23 u31 u32 u33 ")
+        f.write("eps11_c eps22_c eps33_c eps12_c eps13_c eps23_c eps11_s eps22_s eps33_s eps12_s eps13_s eps23_s ")
+        f.write("sig11_c sig22_c sig33_c sig12_c sig13_c sig23_c sig11_s sig22_s sig33_s sig12_s sig13_s sig23_s\n")
+        fixed = np.array( [ colf.getcolumn(t) for t in EPS_SIG_TITLES[:15] ] ).T
+        rest = np.array( [ colf.getcolumn(t) for t in colf.titles[15:] ] ).T
+        for a, b in zip( fixed, rest ):
+            f.write( ("%f "*15)%tuple(a) )
+            f.write( " ".join( [ str(x) for x in b.tolist() ] ) )
+            f.write("\n")
+        f.close()
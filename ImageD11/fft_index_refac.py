@@ -15,7 +15,13 @@ These will be real space vectors
 import logging, time, sys
 import numpy as np
 
-from ImageD11 import labelimage, cImageD11, columnfile
+from ImageD11 import cImageD11, columnfile
+
+try:
+    # threaded and keeps single precision
+    from scipy.fft import rfftn
+except ImportError:
+    from numpy.fft import rfftn
 
 def get_options(parser):
     parser.add_argument( '-n', '--ngrid',
@@ -36,6 +42,12 @@ def get_options(parser):
                        type = float,
              help = 'Number of sigma for patterson peaksearch threshold [5]',
                        default = 5)
+    parser.add_argument( '--fft_threads',
+                       action = 'store',
+                       dest = 'nthreads',
+                       type = int,
+             help = 'Number of threads for the fft (scipy only) [all]',
+                       default = -1)
     return parser
 
 
@@ -99,17 +111,25 @@ def refine_vector( v, gv, tol=0.25, ncycles=25, precision=1e-6 ):
     return vref
     
 
+# 26 neighbours of a voxel. For a plateau the first one in this order wins
+NEIGHBOURS = np.array( [ (i, j, k) for i in (-1, 0, 1)
+                                    for j in (-1, 0, 1)
+                                    for k in (-1, 0, 1)
+                                    if (i, j, k) != (0, 0, 0) ], int )
+
+
 class grid:
-    def __init__(self, npx = 128, mr = 1.0 ,nsig = 5):
+    def __init__(self, npx = 128, mr = 1.0 ,nsig = 5, nthreads = -1):
         """
         Set up the grid to use (the large unit cell)
         npx - number of points in the grid
         mr - maximum resolution limit to consider
+        nthreads - threads for the fft (-1 for all, scipy only)
         """
         self.npx = npx
         self.nsig = nsig
+        self.nthreads = nthreads
         self.grid = np.zeros((npx,npx,npx),np.float32)
-        self.old_grid = np.zeros((npx,npx,npx),np.float32)
         self.cell_size = npx * mr / 2.
         logging.info("Using an FFT unit cell of %s"%(str(self.cell_size)))
 
@@ -117,10 +137,12 @@ class grid:
         """
         Put gvectors into our grid
         gv - ImageD11.indexing gvectors
+        The grid is cleared first so the object can be re-used
         """
         # Compute hkl indices in the fft unit cell
         logging.info("Gridding data")
         self.gv = gv
+        self.grid[...] = 0
         hrkrlr = self.cell_size * gv
         hkl = np.round( hrkrlr ).astype(int)
         # Filter to have the peaks in asym unit
@@ -130,42 +152,29 @@ class grid:
         my_g = np.compress( hmx & hmn, gv, axis=0 )
         # Compute hkl indices in the fft unit cell using filtered peaks
         hrkrlr = self.cell_size * my_g
-        # Integer part of hkl (eg 1.0 from 1.9)
-        hkl = np.floor(hrkrlr).astype(int)
-        # Fractional part of indices ( eg 0.9 from 1.9)
-        remain = hrkrlr - hkl
-        grid = self.grid
         start = time.time()
-        # Loop over corners with respect to floor corner
-        ng = grid.shape[0]*grid.shape[1]*grid.shape[2]
-        flatgrid = grid.reshape( ng )
-        for cor in [ (0,0,0),   #1
-                     (1,0,0),   #2
-                     (0,1,0),   #3
-                     (0,0,1),   #4
-                     (1,1,0),   #5
-                     (1,0,1),   #6
-                     (0,1,1),   #7
-                     (1,1,1) ]: #8
-            # The corner
-            thkl = hkl + cor
-            fac = 1 - abs(remain - cor)
-            vol = abs(fac[:,0]*fac[:,1]*fac[:,2]).astype(np.float32)
-            thkl = np.where(thkl < 0, self.npx + thkl, thkl)
-            ind = thkl[:,0]*grid.shape[1]*grid.shape[2] + \
-                  thkl[:,1]*grid.shape[1] + \
-                  thkl[:,2]
-
-            cImageD11.put_incr( flatgrid , ind.astype(np.intp), vol )
+        # Each peak is shared over the 8 corners of the grid cell it
+        # falls in, with trilinear weights, wrapping negative indices
+        flatgrid = self.grid.reshape( self.npx**3 )
+        if cImageD11.put_trilinear( flatgrid, self.npx,
+                                    np.ascontiguousarray( hrkrlr, np.float64 ) ) != 0:
+            raise Exception( "put_trilinear: grid is not npx**3" )
         logging.info("Grid filling loop takes "+str(time.time()-start)+" /s")
 
-
-
     def fft(self):
-        """ Compute the Patterson """
+        """
+        Compute the Patterson
+        The grid is real so only the half with the last index
+        0 -> npx//2 is computed and stored
+        """
         start = time.time()
-        self.patty = np.ascontiguousarray(abs(np.fft.fftn(self.grid)),
-                                          np.float32)
+        try:
+            ft = rfftn( self.grid, workers = self.nthreads )
+        except TypeError:  # numpy.fft
+            ft = rfftn( self.grid )
+        self.patty = np.empty( ft.shape, np.float32 )
+        np.abs( ft, out = self.patty )
+        del ft
         logging.info("Time for fft "+str(time.time()-start))
         self.origin = self.patty[0,0,0]
         logging.info("Patterson origin height is :"+str(self.origin))
@@ -174,27 +183,90 @@ class grid:
         """ Print some properties of the Patterson """
         logging.info("Patterson info "+str(self.patty.shape)
                      +str(type(self.patty)))
-        p = np.ravel(self.patty)
-        m = np.mean(p)
+        # Planes which are not their own Friedel mate count twice
+        wt = np.full( self.patty.shape[2], 2. )
+        wt[0] = 1
+        if self.npx % 2 == 0:
+            wt[-1] = 1
+        s1 = np.dot( self.patty.sum( axis=(0,1), dtype=np.float64 ), wt )
+        s2 = np.dot( ( self.patty.astype(np.float64)**2 ).sum( axis=(0,1) ),
+                     wt )
+        n = float(self.npx)**3
+        m = s1 / n
         logging.info("Average: %f"%(m))
-        p2 = p*p
         self.mean = m
-        v = np.sqrt( (np.sum(p2) - m*m*len(p) ) /(len(p)-1) )
+        v = np.sqrt( ( s2 - m*m*n ) /(n-1) )
         logging.info("Sigma: %f"%(v))
         self.sigma = v
 
-    def peaksearch(self, peaksfile):
-        """ Peaksearch in the Patterson """
-        lio = labelimage.labelimage( (self.npx, self.npx),
-                                     peaksfile )
-        logging.info("Peaksearching at %f sigma"%(self.nsig))
+    def patterson_value(self, i, j, k):
+        """
+        Patterson at full grid indices i, j, k (arrays, any integers)
+        using the Friedel symmetry for the half which is not stored
+        """
+        n = self.npx
+        i, j, k = i % n, j % n, k % n
+        mate = k > self.patty.shape[2] - 1
+        i = np.where( mate, -i % n, i )
+        j = np.where( mate, -j % n, j )
+        k = np.where( mate, n - k, k )
+        return self.patty[ i, j, k ]
+
+    def find_peaks(self):
+        """
+        Finds local maxima above mean + nsig * sigma in the Patterson
+        Only the voxels above the threshold are compared to their
+        26 neighbours (with periodic wrapping).
+        Returns a columnfile with columns sc, fc, omega (grid position
+        refined by the centroid of the 3x3x3 box), Number_of_pixels and
+        sum_intensity, like the old labelimage output
+        """
+        start = time.time()
         thresh = self.mean + self.nsig  * self.sigma
-        for i in range(self.npx):
-            lio.peaksearch(self.patty[i],
-                           thresh,
-                           i)
-            lio.mergelast()
-        lio.finalise()
+        logging.info("Peaksearching at %f sigma"%(self.nsig))
+        i, j, k = np.nonzero( self.patty > thresh )
+        val = self.patty[ i, j, k ]
+        ismax = np.ones( len(val), bool )
+        for n, (di, dj, dk) in enumerate( NEIGHBOURS ):
+            other = self.patterson_value( i + di, j + dj, k + dk )
+            if n < len(NEIGHBOURS)//2:
+                ismax &= val > other
+            else:
+                ismax &= val >= other
+        i, j, k = i[ismax], j[ismax], k[ismax]
+        # centroid and sum of the 3x3x3 box above threshold
+        box = [ (0, 0, 0) ] + [ tuple(d) for d in NEIGHBOURS ]
+        sI = np.zeros( len(i), np.float64 )
+        sx = np.zeros( ( 3, len(i) ), np.float64 )
+        npx = np.zeros( len(i), int )
+        for d in box:
+            w = self.patterson_value( i + d[0], j + d[1], k + d[2] ) - thresh
+            w = np.where( w > 0, w, 0 )
+            npx += w > 0
+            sI += w
+            sx += np.outer( d, w )
+        pos = np.array( (i, j, k), float ) + sx / sI
+        self.peaks = columnfile.colfile_from_dict( {
+            'sc' : pos[1],
+            'fc' : pos[2],
+            'omega' : pos[0],
+            'Number_of_pixels' : npx.astype(float),
+            'sum_intensity' : sI + npx * thresh } )
+        logging.info("Found %d peaks in %f /s"%(len(i), time.time()-start))
+        return self.peaks
+
+    def peaksearch(self, peaksfile = None):
+        """
+        Peaksearch in the Patterson
+        peaksfile : optional name or open file to save the peaks
+        """
+        self.find_peaks()
+        if peaksfile is None:
+            return
+        if hasattr( peaksfile, "name" ):
+            peaksfile.close()
+            peaksfile = peaksfile.name
+        self.peaks.writefile( peaksfile )
 
     def pv(self, v):
         """ print vector """
@@ -203,10 +275,16 @@ class grid:
     def reduce(self, vecs):
         raise Exception("You want lattice_reduction instead")
 
-    def read_peaks(self, peaksfile):
-        """ Read in the peaks from a peaksearch """
+    def read_peaks(self, peaksfile = None):
+        """
+        Read in the peaks from a peaksearch
+        peaksfile : file to read, otherwise the peaks from the last search
+        """
         start = time.time()
-        colf = columnfile.columnfile(peaksfile)
+        if peaksfile is None:
+            colf = self.peaks
+        else:
+            colf = columnfile.columnfile(peaksfile)
         logging.info("reading file %f/s"%(time.time()-start))
         # hmm - is this the right way around?
         self.rlgrid = 1.0*self.cell_size/self.npx
@@ -353,13 +431,6 @@ def test(options):
     sys.exit()
 
 
-    go.gv_to_grid_old(io.gv)
-
-    diff = np.ravel(go.grid - go.old_grid)
-    print("All OK if this is zero",np.add.reduce(diff))
-    print("error at",np.argmax(diff),diff.max(),np.argmin(diff),diff.min())
-
-
 
 
 
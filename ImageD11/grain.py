@@ -195,38 +195,291 @@ class grain:
         E = self.eps_sample_matrix( dzero_cell, m )
         return symm_to_e6( E )
 
-        
 
 
-    
+def _readonly( ar ):
+    """ cached arrays are handed out without copying, so lock them """
+    ar.flags.writeable = False
+    return ar
+
+
+class GrainCollection(object):
+    """
+    Many grains held as arrays:
+       ubi[N,3,3], translation[N,3] (nan where not known)
+    and any per grain columns (npks, name, ...) as arrays of length N.
+
+    UB, U, B, Rod, mt, rmt and unitcell are the same as for the grain
+    class, but are computed for all grains at once when first used.
+    The arrays returned are cached and read only.
+    """
+
+    def __init__(self, ubi, translation=None, **columns):
+        self.ubi = np.array( ubi, float ).reshape( -1, 3, 3 )
+        n = len( self.ubi )
+        if translation is None:
+            self.translation = np.full( (n, 3), np.nan )
+        else:
+            self.translation = np.array( translation, float ).reshape( n, 3 )
+        self.columns = {}
+        for name, values in columns.items():
+            self.addcolumn( values, name )
+        self.clear_cache()
+
+    def __len__(self):
+        return len( self.ubi )
+
+    def addcolumn(self, values, name):
+        """ Adds or replaces a per grain column """
+        values = np.asarray( values )
+        if len( values ) != len( self ):
+            raise ValueError( "Column %s has the wrong length"%( name ) )
+        self.columns[name] = values
+
+    def __getattr__(self, name):
+        # only called when normal lookup fails
+        columns = self.__dict__.get( 'columns', {} )
+        if name in columns:
+            return columns[name]
+        raise AttributeError( name )
+
+    def clear_cache(self):
+        """ Call this if you change ubi in place """
+        self._cache = {}
+
+    def _cached(self, name, func):
+        if name not in self._cache:
+            self._cache[name] = _readonly( func() )
+        return self._cache[name]
+
+    @property
+    def UB(self):
+        """ The UB matrices from Busing and Levy """
+        return self._cached( 'UB', lambda : np.linalg.inv( self.ubi ) )
+
+    @property
+    def mt(self):
+        """ Metric tensors """
+        return self._cached( 'mt', lambda : np.matmul(
+            self.ubi, np.transpose( self.ubi, (0,2,1) ) ) )
+
+    @property
+    def rmt(self):
+        """ Reciprocal metric tensors """
+        return self._cached( 'rmt', lambda : np.linalg.inv( self.mt ) )
+
+    @property
+    def unitcell(self):
+        """ a,b,c,alpha,beta,gamma as [N,6] """
+        def cells():
+            G = self.mt
+            a, b, c = [ np.sqrt( G[:,i,i] ) for i in range(3) ]
+            al = np.degrees( np.arccos( G[:,1,2]/b/c ) )
+            be = np.degrees( np.arccos( G[:,0,2]/a/c ) )
+            ga = np.degrees( np.arccos( G[:,0,1]/a/b ) )
+            return np.array( (a,b,c,al,be,ga) ).T.copy()
+        return self._cached( 'unitcell', cells )
+
+    @property
+    def B(self):
+        """ B matrices from Busing and Levy
+        These are the upper triangular factors of the reciprocal metric
+        """
+        return self._cached( 'B', lambda : np.transpose(
+            np.linalg.cholesky( self.rmt ), (0,2,1) ).copy() )
+
+    @property
+    def U(self):
+        """ The orientation matrices (U) from Busing and Levy """
+        return self._cached( 'U', lambda : np.transpose(
+            np.matmul( self.B, self.ubi ), (0,2,1) ).copy() )
+
+    @property
+    def Rod(self):
+        """ Rodriguez vectors [N,3] (as xfab.tools.u_to_rod) """
+        def rod():
+            U = self.U
+            a = 1 / ( 1 + U[:,0,0] + U[:,1,1] + U[:,2,2] )
+            return np.array( ( ( U[:,1,2] - U[:,2,1] )*a,
+                               ( U[:,2,0] - U[:,0,2] )*a,
+                               ( U[:,0,1] - U[:,1,0] )*a ) ).T.copy()
+        return self._cached( 'Rod', rod )
+
+    def _strain(self, dzero_cell, m, frame):
+        """ Seth-Hill strain tensors [N,3,3], see grain.eps_grain_matrix """
+        key = ( 'eps', frame, m, tuple( np.ravel( getattr( dzero_cell, 'UB',
+                                                           dzero_cell ) ) ) )
+        if key in self._cache:
+            return self._cache[key]
+        if hasattr( dzero_cell, "UB" ):
+            B = dzero_cell.UB
+        else:
+            B = ImageD11.unitcell.unitcell( dzero_cell ).B
+        m2 = int(round(m*2))
+        assert np.allclose( m2 * 0.5, m )
+        # F = dot( ubi.T, ub0.T ) as in finite_strain
+        F = np.matmul( np.transpose( self.ubi, (0,2,1) ), B.T )
+        Ft = np.transpose( F, (0,2,1) )
+        if (m2 % 2) == 0 and m2 != 0:
+            if frame == 'ref':
+                C = np.matmul( Ft, F )
+            else:
+                C = np.matmul( F, Ft )
+            E = ( np.linalg.matrix_power( C, m2//2 ) - np.eye(3) ) / m2
+        else:
+            w, s, vh = np.linalg.svd( F )
+            if frame == 'ref':
+                v = np.transpose( vh, (0,2,1) )
+            else:
+                v = w
+            if m2 == 0:
+                d = np.log( s )
+                half = 0.5
+            else:
+                d = s
+                half = 1.
+            # v.diag(d).vT is S (ref) or V (lab)
+            S = np.matmul( v * d[:,np.newaxis,:], np.transpose( v, (0,2,1) ) )
+            if m2 == 0:
+                E = S * half
+            else:
+                E = ( np.linalg.matrix_power( S, m2 ) - np.eye(3) ) / m2
+        self._cache[key] = _readonly( E )
+        return E
+
+    def eps_grain_matrix(self, dzero_cell, m=0.5):
+        """ Strain tensors [N,3,3] in the grain reference system
+        dzero_cell can be a grain or cell parameters (see grain)
+        """
+        return self._strain( dzero_cell, m, 'ref' )
+
+    def eps_grain(self, dzero_cell, m=0.5):
+        """ e11 e12 e13 e22 e23 e33 [N,6] in the grain reference system """
+        E = self.eps_grain_matrix( dzero_cell, m )
+        return E[:, [0,0,0,1,1,2], [0,1,2,1,2,2] ]
+
+    def eps_sample_matrix(self, dzero_cell, m=0.5):
+        """ Strain tensors [N,3,3] in the sample system
+        dzero_cell can be a grain or cell parameters (see grain)
+        """
+        return self._strain( dzero_cell, m, 'lab' )
+
+    def eps_sample(self, dzero_cell, m=0.5):
+        """ e11 e12 e13 e22 e23 e33 [N,6] in the sample system """
+        E = self.eps_sample_matrix( dzero_cell, m )
+        return E[:, [0,0,0,1,1,2], [0,1,2,1,2,2] ]
+
+    def __getitem__(self, item):
+        """ An integer gives a grain, anything else a GrainCollection """
+        if isinstance( item, (int, np.integer) ):
+            return self.to_grains( [item] )[0]
+        cols = dict( [ (k, v[item]) for k, v in self.columns.items() ] )
+        return GrainCollection( self.ubi[item], self.translation[item],
+                                **cols )
+
+    @classmethod
+    def from_grains(cls, grains, columns=None):
+        """
+        Collect a list of grain objects. By default all the public
+        attributes found on the grains become columns. Grains which
+        do not have one get None (an object column).
+        """
+        grains = list( grains )
+        ubi = [ g.ubi for g in grains ]
+        translation = [ ( np.nan, np.nan, np.nan ) if g.translation is None
+                        else g.translation for g in grains ]
+        if columns is None:
+            columns = []
+            for g in grains:
+                for k in vars( g ):
+                    if k in ( 'ubi', 'translation' ) or k.startswith( '_' ):
+                        continue
+                    if k not in columns:
+                        columns.append( k )
+        cols = {}
+        for k in columns:
+            vals = [ getattr( g, k, None ) for g in grains ]
+            ar = None
+            if all( v is not None for v in vals ):
+                try:
+                    ar = np.array( vals )
+                except ValueError:
+                    ar = None
+            if ar is None or ar.dtype == object or ar.shape[:1] != (len(vals),):
+                ar = np.empty( len( vals ), object )
+                ar[:] = vals
+            cols[k] = ar
+        return cls( ubi, translation, **cols )
+
+    def to_grains(self, indices=None):
+        """ A list of grain objects (for indices, default all) """
+        if indices is None:
+            indices = range( len( self ) )
+        gl = []
+        for i in indices:
+            t = self.translation[i]
+            g = grain( self.ubi[i], None if np.isnan( t ).any() else t )
+            for k, v in self.columns.items():
+                if v[i] is not None:
+                    setattr( g, k, v[i] )
+            gl.append( g )
+        return gl
+
+
+# Grain files ending like this are written as hdf
+HDF_EXTENSIONS = ( ".h5", ".hdf", ".hdf5" )
+HDF_SIGNATURE = b"\x89HDF\r\n\x1a\n"
+
+def is_hdf_file( filename ):
+    """ True if filename is an hdf5 file (checks the signature) """
+    try:
+        with open( filename, "rb" ) as f:
+            return f.read( len( HDF_SIGNATURE ) ) == HDF_SIGNATURE
+    except (IOError, OSError, TypeError):
+        return False
+
+
 def write_grain_file(filename, list_of_grains):
-    f = open(filename, "w")
+    """
+    Writes a list of grains (or a GrainCollection) into filename.
+    Names ending in .h5 .hdf .hdf5 get the binary format
+    (see write_grain_file_h5), otherwise the text format.
+    """
+    if str( filename ).lower().endswith( HDF_EXTENSIONS ):
+        return write_grain_file_h5( filename, list_of_grains )
+    if isinstance( list_of_grains, GrainCollection ):
+        list_of_grains = list_of_grains.to_grains()
+    lines = []
     for g in list_of_grains:
         t = g.translation
-        f.write("#translation: %g %g %g\n"%(t[0],t[1],t[2]))
+        lines.append("#translation: %g %g %g\n"%(t[0],t[1],t[2]))
         if hasattr(g,"name"):
-            f.write("#name %s\n"%(g.name.rstrip()))
+            lines.append("#name %s\n"%(g.name.rstrip()))
         if hasattr(g,"intensity_info"):
-            f.write("#intensity_info %s\n"%(g.intensity_info.rstrip()))
+            lines.append("#intensity_info %s\n"%(g.intensity_info.rstrip()))
         if hasattr(g,"npks"):
-            f.write("#npks %d\n"%(int(g.npks)))
+            lines.append("#npks %d\n"%(int(g.npks)))
         if hasattr(g,"nuniq"):
-            f.write("#nuniq %d\n"%(int(g.nuniq)))
+            lines.append("#nuniq %d\n"%(int(g.nuniq)))
         if hasattr(g,"Rod"):
             try:
-                f.write("#Rod %f %f %f\n"%tuple([float(r) for r in g.Rod]))
+                lines.append("#Rod %f %f %f\n"%tuple([float(r) for r in g.Rod]))
             except:
-                f.write("#Rod %s"%(g.Rod))
-        f.write("#UBI:\n")
+                lines.append("#Rod %s"%(g.Rod))
+        lines.append("#UBI:\n")
         u = g.ubi
         # More than float32 precision
-        f.write("%.9g %.9g %.9g\n"  %(u[0,0],u[0,1],u[0,2]))
-        f.write("%.9g %.9g %.9g\n"  %(u[1,0],u[1,1],u[1,2]))
-        f.write("%.9g %.9g %.9g\n\n"%(u[2,0],u[2,1],u[2,2]))
+        lines.append("%.9g %.9g %.9g\n"  %(u[0,0],u[0,1],u[0,2]))
+        lines.append("%.9g %.9g %.9g\n"  %(u[1,0],u[1,1],u[1,2]))
+        lines.append("%.9g %.9g %.9g\n\n"%(u[2,0],u[2,1],u[2,2]))
+    f = open(filename, "w")
+    f.write( "".join( lines ) )
     f.close()
 
 def read_grain_file(filename):
     """read ubifile and return a list of ubi arrays """
+    if is_hdf_file( filename ):
+        return read_grain_file_h5( filename ).to_grains()
     f = open(filename, "r")
     grainsread = []
     u = []
@@ -256,3 +509,119 @@ def read_grain_file(filename):
             t = None
     f.close()
     return grainsread
+
+
+# Columns saved in hdf files by default
+GRAIN_COLUMNS = ( "npks", "nuniq", "name", "intensity_info" )
+
+def write_grain_file_h5( filename, grains, name="grains" ):
+    """
+    Writes grains (a list or a GrainCollection) as columns in the hdf
+    group name : ubi[N,3,3], translation[N,3] and the numeric or string
+    per grain columns. Datasets are contiguous and uncompressed so
+    they can be memory mapped when reading.
+    """
+    import h5py
+    if not isinstance( grains, GrainCollection ):
+        grains = GrainCollection.from_grains( grains, columns = [
+            k for k in GRAIN_COLUMNS if all( hasattr( g, k ) for g in grains ) ] )
+    with h5py.File( filename, "w" ) as h:
+        grp = h.create_group( name )
+        grp.attrs['ImageD11_type'] = 'grains'
+        grp.create_dataset( "ubi", data = grains.ubi )
+        grp.create_dataset( "translation", data = grains.translation )
+        for k, v in grains.columns.items():
+            if k in ( "npks", "nuniq" ):
+                v = np.array( [ int(x) for x in v ], np.int64 )
+            if v.dtype.kind in "biuf":
+                grp.create_dataset( k, data = v )
+            elif all( isinstance( x, str ) or hasattr( x, "decode" )
+                      for x in v ):
+                grp.create_dataset( k, data = [ _tostr( x ).rstrip()
+                                                for x in v ],
+                                    dtype = h5py.special_dtype( vlen = str ) )
+            else:
+                print("Not saving grain column",k)
+
+def _tostr( x ):
+    if hasattr( x, "decode" ):
+        return x.decode()
+    return str( x )
+
+def _read_rows( ds, rows ):
+    """ Reads rows (None, a slice, an index or boolean array) of ds """
+    if rows is None:
+        return ds[()]
+    if isinstance( rows, slice ):
+        return ds[rows]
+    idx = np.asarray( rows )
+    if idx.dtype == bool:
+        idx = np.nonzero( idx )[0]
+    # hdf selections must be increasing
+    u, inv = np.unique( idx, return_inverse = True )
+    if len( u ) == 0:
+        return ds[0:0]
+    return ds[ u ][ inv ]
+
+def read_grain_file_h5( filename, rows=None, mmap=False, name="grains" ):
+    """
+    Reads a file from write_grain_file_h5 into a GrainCollection
+    rows = None for all grains, or a slice, indices or boolean mask
+    mmap = memory map the numeric columns instead of reading them
+    """
+    import h5py
+    cols = {}
+    with h5py.File( filename, "r" ) as h:
+        grp = h[name]
+        for k in grp.keys():
+            ds = grp[k]
+            offset = None
+            if mmap and ds.dtype.kind in "biuf":
+                offset = ds.id.get_offset()
+            if offset is not None:
+                ar = np.memmap( filename, mode = "r", dtype = ds.dtype,
+                                shape = ds.shape, offset = offset )
+                if rows is not None:
+                    ar = ar[rows]
+            else:
+                ar = _read_rows( ds, rows )
+            if ar.dtype.kind == "O":
+                ar = np.array( [ _tostr( x ) for x in ar ] )
+            cols[k] = ar
+    ubi = cols.pop( "ubi" )
+    translation = cols.pop( "translation" )
+    gc = GrainCollection( ubi, translation, **cols )
+    if mmap:
+        # keep the memory maps instead of the copies made by __init__
+        gc.ubi = ubi
+        gc.translation = translation
+    return gc
+
+def iter_grain_file_h5( filename, chunksize=100000, name="grains" ):
+    """ Yields GrainCollections of chunksize grains at a time """
+    import h5py
+    with h5py.File( filename, "r" ) as h:
+        n = len( h[name]["ubi"] )
+    for start in range( 0, n, chunksize ):
+        yield read_grain_file_h5( filename, slice( start, start + chunksize ),
+                                  name = name )
+
+def read_grain_collection( filename, rows=None, mmap=False ):
+    """
+    A GrainCollection from either kind of grain file. Text files are
+    read in full and npks/nuniq become integers.
+    """
+    if is_hdf_file( filename ):
+        return read_grain_file_h5( filename, rows, mmap )
+    gl = read_grain_file( filename )
+    columns = [ k for k in GRAIN_COLUMNS if all( hasattr( g, k ) for g in gl ) ]
+    gc = GrainCollection.from_grains( gl, columns = columns )
+    for k in ( "npks", "nuniq" ):
+        if k in gc.columns:
+            gc.addcolumn( np.array( [ int(x) for x in gc.columns[k] ] ), k )
+    for k in ( "name", "intensity_info" ):
+        if k in gc.columns:
+            gc.addcolumn( np.array( [ x.rstrip() for x in gc.columns[k] ] ), k )
+    if rows is not None:
+        gc = gc[rows]
+    return gc
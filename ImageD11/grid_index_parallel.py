@@ -1,8 +1,8 @@
 
 
 from __future__ import print_function
-from ImageD11 import peakmerge, indexing, transformer, cImageD11
-from ImageD11 import grain, unitcell, refinegrains, sym_u
+from ImageD11 import peakmerge, indexing, transformer, transform, cImageD11
+from ImageD11 import grain, unitcell, refinegrains, sym_u, columnfile
 import xfab.tools
 import sys, os, numpy as np, time, random
 import multiprocessing, traceback
@@ -14,6 +14,11 @@ if sys.version_info[0] < 3:
 else:
     import queue as Queue
 
+try:
+    from multiprocessing import shared_memory
+except ImportError:   # python < 3.8 : fall back to a memory mapped file
+    shared_memory = None
+
 if "win" in sys.platform:
     nulfile = "NUL"
 else:
@@ -41,11 +46,14 @@ def domap(  pars,
     if gridpars['NUL']:
         NUL = open(nulfile,"w")
         sys.stdout = NUL
+    # grains keeping the same peaks are not refined again
+    refine_cache = {}
     for tol in gridpars['TOLSEQ']:
         o = refinegrains.refinegrains( OmFloat = OmFloat, OmSlop = OmSlop,
                                        tolerance = tol,
                                        intensity_tth_range = (0,180),
                                        )
+        o.refine_cache = refine_cache
         o.parameterobj = pars
         # o.loadfiltered ...
         o.scannames = ["internal"]
@@ -146,8 +154,14 @@ def test_many_points( args ):
     s += "%s %s"%(colfile, parameters)
     print(s)
     mytransformer = transformer.transformer()
-    mytransformer.loadfiltered( colfile )
-    mytransformer.loadfileparameters(  parameters )
+    if isinstance( colfile, sharedpeaks ):
+        # attach to the peaks in shared memory, no file reading
+        mytransformer.colfile = colfile.attach()
+        mytransformer.setxyomcols( "sc", "fc", "omega" )
+        mytransformer.parameterobj.set_parameters( colfile.pars )
+    else:
+        mytransformer.loadfiltered( colfile )
+        mytransformer.loadfileparameters(  parameters )
     w =  mytransformer.parameterobj.get("wavelength")
     first=True
     ni = len(translations)/100.0
@@ -170,10 +184,10 @@ def test_many_points( args ):
                             grains,
                             gridpars)
             nk = len(grains)
-            if len(grains) > 0:
-                test_many_points.q.put( grains, False ) # do not wait
         else:
             nk = 0
+        # Always report back so the parent can record the progress
+        test_many_points.q.put( ((t_x, t_y, t_z), grains, ng), False ) # do not wait
         sys.stderr.write("         % 6.2f%% Position %d %d %d"%(i/ni,t_x, t_y, t_z)+
                          " grains found %d kept %d\n"%(ng, nk))
 
@@ -181,46 +195,155 @@ def test_many_points( args ):
 class uniq_grain_list(object):
     """
     Cope with finding the same grain over and over...
+
+    Grains are bucketed on a grid of translations with a cell size of
+    toldist so that each new grain is only compared to the grains in
+    the neighbouring cells.
     """
     def __init__(self, symmetry, toldist, tolangle, grains=None):
         self.grp = getattr( sym_u, symmetry )()
         self.dt2 = toldist*toldist
         self.tar  = np.radians(tolangle)
+        self.cellsize = max( toldist, 1e-6 )
+        self.cells = {}
         self.uniqgrains = []
         if grains is not None:
             self.add( grains )
-            
+
+    def cell(self, t):
+        """ grid bucket holding translation t """
+        return tuple( np.floor( np.asarray(t) / self.cellsize ).astype(int) )
+
+    def neighbours(self, t):
+        """
+        Indices in self.uniqgrains of grains in the 27 cells around t
+        Returned in the order they were added
+        """
+        cx, cy, cz = self.cell( t )
+        idx = []
+        for i in (-1, 0, 1):
+            for j in (-1, 0, 1):
+                for k in (-1, 0, 1):
+                    idx += self.cells.get( (cx+i, cy+j, cz+k), [] )
+        idx.sort()
+        return np.array( idx, int )
+
     def add(self, grains):
         for i,gnew in enumerate(grains):
             newgrain = True
-            for gold in self.uniqgrains:
-                dt = gnew.translation - gold.translation
-                dt2  =np.dot(dt,dt)
-                if dt2 > self.dt2:
-                    continue
-                aumis = np.dot(gold.asymusT, gnew.U)
-                arg = (aumis[:,0,0]+aumis[:,1,1]+aumis[:,2,2] - 1. )/2.
-                angle = np.arccos(np.clip(arg, -1, 1)).min()
-                if angle < self.tar:
-                    # too close in angle and space
-                    print( "           matched",i,np.degrees(angle),np.sqrt(dt2) )
+            idx = self.neighbours( gnew.translation )
+            if len(idx) > 0:
+                tr = np.array( [ self.uniqgrains[j].translation for j in idx ] )
+                dt = tr - gnew.translation
+                dt2 = (dt*dt).sum( axis = 1 )
+                close = dt2 <= self.dt2
+                idx, dt2 = idx[close], dt2[close]
+            if len(idx) > 0:
+                asymusT = np.array( [ self.uniqgrains[j].asymusT for j in idx ] )
+                aumis = np.matmul( asymusT, gnew.U )
+                arg = (aumis[...,0,0]+aumis[...,1,1]+aumis[...,2,2] - 1. )/2.
+                angle = np.arccos(np.clip(arg, -1, 1)).min( axis = 1 )
+                hits = np.nonzero( angle < self.tar )[0]
+                if len(hits) > 0:
+                    # too close in angle and space : first one added wins
+                    j = hits[0]
+                    gold = self.uniqgrains[ idx[j] ]
+                    print( "           matched",i,np.degrees(angle[j]),np.sqrt(dt2[j]) )
                     gold.nfound += 1
                     newgrain = False
-                    break
             if newgrain:
                 self.append_uniq( gnew )
-                
+
     def append_uniq( self, g ):
         symubis = [np.dot(o, g.ubi) for o in self.grp.group]
         g.asymusT   = np.array([xfab.tools.ubi_to_u_b(ubi)[0].T for ubi in symubis])
         g.nfound = 1
+        self.cells.setdefault( self.cell( g.translation ), [] ).append(
+            len(self.uniqgrains) )
         self.uniqgrains.append( g )
 
-        
+
+class sharedpeaks(object):
+    """
+    Holds the columns of a columnfile in a single block of shared
+    memory (or a memory mapped file for older pythons). Only the
+    name, titles and parameters are pickled for the worker processes,
+    which attach to the data without copying or parsing anything.
+    """
+    def __init__(self, colfile, pars, tmp):
+        self.titles = list( colfile.titles )
+        self.nrows = colfile.nrows
+        self.pars = dict( pars.get_parameters() )
+        shape = ( len(self.titles), self.nrows )
+        if shared_memory is not None:
+            self._shm = shared_memory.SharedMemory(
+                create = True, size = max( 1, 8 * shape[0] * shape[1] ) )
+            self.name = self._shm.name
+            ar = np.ndarray( shape, np.float64, buffer = self._shm.buf )
+        else:
+            self._shm = None
+            self.name = "%s_peaks.npy"%(tmp)
+            ar = np.lib.format.open_memmap( self.name, mode = 'w+',
+                                            dtype = np.float64, shape = shape )
+        for i, t in enumerate( self.titles ):
+            ar[i] = colfile.getcolumn( t )
+        self._data = ar
+
+    def __getstate__(self):
+        # Only the description goes to the workers
+        d = self.__dict__.copy()
+        d['_shm'] = None
+        d['_data'] = None
+        return d
+
+    def __str__(self):
+        return "sharedpeaks(%s, %d rows)"%(self.name, self.nrows)
+
+    def attach(self):
+        """
+        Attaches to the shared block and returns a columnfile.
+        Call from the worker processes.
+        """
+        if shared_memory is not None:
+            # Keep a reference or the buffer disappears
+            self._shm = shared_memory.SharedMemory( name = self.name )
+            self._data = np.ndarray( ( len(self.titles), self.nrows ),
+                                     np.float64, buffer = self._shm.buf )
+        else:
+            self._data = np.load( self.name, mmap_mode = 'r' )
+        return self.colfile()
+
+    def colfile(self):
+        """
+        Returns a columnfile with read-only columns pointing into the
+        shared block
+        """
+        ar = self._data
+        ar.flags.writeable = False
+        c = columnfile.newcolumnfile( self.titles )
+        c.parameters.set_parameters( self.pars )
+        c.nrows = self.nrows
+        c.set_bigarray( [ ar[i] for i in range(len(self.titles)) ] )
+        return c
+
+    def close(self):
+        """
+        Removes the shared block. Call from the parent when finished.
+        """
+        self._data = None
+        if self._shm is not None:
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+        elif os.path.exists( self.name ):
+            os.remove( self.name )
+
+
 def initgrid( fltfile, parfile, tmp, gridpars ):
     """
     Sets up a grid indexing by preparing the unitcell for indexing
     and checking the columns we want are in the colfile
+    Returns gridpars and the peaks placed in shared memory
     """
     mytransformer = transformer.transformer()
     mytransformer.loadfiltered( fltfile )
@@ -239,8 +362,8 @@ def initgrid( fltfile, parfile, tmp, gridpars ):
     if not "fc" in col.titles:
         assert "yc" in col.titles
         col.addcolumn( col.yc.copy(), "fc")
-    mytransformer.colfile.writefile( "%s.flt"%(tmp))
-    return gridpars
+    peaks = sharedpeaks( col, mytransformer.parameterobj, tmp )
+    return gridpars, peaks
 
 
 # Debugging multiprocessing - print the exceptions
@@ -263,20 +386,50 @@ def wrap_test_many_points_init(q):
     test_many_points.q = q
 
 
-def grid_index_parallel( fltfile, parfile, tmp, gridpars, translations ):
-    """
-    fltfile containing peaks
-    parfile containing instrument geometry and unit cell
-    tmp - base name for scratch files and results
-    gridpars : dictionary of control parameters (rings to use, etc)
-    translations : list of translation positions to try
+def translation_key( t ):
+    """ String used to record a finished translation in the progress file """
+    return "%.6f %.6f %.6f"%tuple( t )
 
-    Runs a grid index algorithm using pythons multiprocessing module
-    splits workload over processes (blocks of translations to each process)
-    This thread should catch results via a queue
+
+def save_grains( fname, grains ):
+    """ Write to a scratch file and rename so a crash cannot corrupt fname """
+    grain.write_grain_file( fname + ".tmp", grains )
+    if hasattr( os, "replace" ):
+        os.replace( fname + ".tmp", fname )
+    else:
+        if os.path.exists( fname ) and sys.platform == "win32":
+            os.remove( fname )
+        os.rename( fname + ".tmp", fname )
+
+
+def load_progress( tmp, ul ):
     """
-    gridpars = initgrid( fltfile, parfile, tmp, gridpars )
-    print( "Done init" )
+    Reads back the grains and the finished translations from a previous
+    run using the same tmp name, so that the run can be resumed.
+    Returns a dict of finished translation keys : number of grains the
+    indexer found there
+    """
+    done = {}
+    donefile = "%s_done.txt"%(tmp)
+    mapfile = "all%s.map"%(tmp)
+    if not os.path.exists( donefile ):
+        return done
+    with open( donefile, "r" ) as f:
+        for line in f:
+            v = line.split()
+            if len( v ) >= 3:
+                key = translation_key( [ float(x) for x in v[:3] ] )
+                done[ key ] = int( v[3] ) if len( v ) > 3 else 0
+    if os.path.exists( mapfile ):
+        for g in grain.read_grain_file( mapfile ):
+            ul.append_uniq( g )
+    print( "Resuming %s: %d translations done, %d grains"%(
+        tmp, len(done), len(ul.uniqgrains) ) )
+    return done
+
+
+def set_nproc( gridpars ):
+    """ Number of processes to use and threads per process """
     if 'NPROC' not in gridpars or gridpars['NPROC'] is None:
         NPR =  multiprocessing.cpu_count() - 1
         cImageD11.cimaged11_omp_set_num_threads(2) # assume hyperthreading is useful?
@@ -286,40 +439,177 @@ def grid_index_parallel( fltfile, parfile, tmp, gridpars, translations ):
         cImageD11.cimaged11_omp_set_num_threads(int(gridpars['NTHREAD']))
     elif NPR > 1:
         cImageD11.cimaged11_omp_set_num_threads(1)
+    return NPR
+
+
+def start_progress( tmp, gridpars, ul ):
+    """ Resume from tmp_done.txt unless gridpars['RESUME'] is False """
+    donefile = "%s_done.txt"%(tmp)
+    if gridpars.get( 'RESUME', True ):
+        return load_progress( tmp, ul )
+    if os.path.exists( donefile ):
+        os.remove( donefile )
+    return {}
+
+
+def run_translations( peaks, parfile, tmp, gridpars, translations, ul, NPR ):
+    """
+    Runs the translations over a pool of NPR processes and adds the
+    grains to ul as they arrive.
+    Returns a dict of translation keys : number of grains indexed
+    """
+    found = {}
+    if len(translations) == 0:
+        return found
+    donefile = "%s_done.txt"%(tmp)
     tsplit = [ translations[i::NPR] for i in range(NPR) ]
-    args = [("%s.flt"%(tmp), parfile, t, gridpars) for i,t in enumerate(tsplit) ]
+    args = [(peaks, parfile, t, gridpars) for i,t in enumerate(tsplit) ]
     q = PQueue()
     p = Pool(processes=NPR, initializer=wrap_test_many_points_init, initargs=[q])
     print( "Using a pool of",NPR,"processes" )
     pa = p.map_async( wrap_test_many_points, args )
-    ul = uniq_grain_list( gridpars['SYMMETRY'],
-                          gridpars['toldist'],
-                          gridpars['tolangle'] )
-    lastsave = 0
-
+    lastsave = len( ul.uniqgrains )
+    progress = open( donefile, "a" )
     while True:
-        # If we go more than 30 seconds without something, die
+        # Wait for results until the pool is finished and the queue drained
         try:
-            grs = q.get(True, 10)
-            gb4 = len(ul.uniqgrains)
-            ul.add( grs )
-            gnow =  len(ul.uniqgrains)
-            print( "Got % 5d new %d from %d"%(gnow, gnow-gb4, len(grs) ) )
+            t, grs, ng = q.get(True, 1 if pa.ready() else 10)
+            if len(grs) > 0:
+                gb4 = len(ul.uniqgrains)
+                ul.add( grs )
+                gnow =  len(ul.uniqgrains)
+                print( "Got % 5d new %d from %d"%(gnow, gnow-gb4, len(grs) ) )
             if len(ul.uniqgrains) > lastsave:
                 lastsave = len( ul.uniqgrains )
-                grain.write_grain_file( "all"+tmp+".map", ul.uniqgrains )
-            if pa._number_left == 0:
-                break
+                save_grains( "all"+tmp+".map", ul.uniqgrains )
+            # only now is this translation safely finished
+            key = translation_key( t )
+            progress.write( "%s %d\n"%( key, ng ) )
+            progress.flush()
+            found[ key ] = ng
         except Queue.Empty:
-            sys.stderr.write(" Caught queue empty exception\n")
-            if pa._number_left == 0:
+            if pa.ready():
                 break
+            sys.stderr.write(" Caught queue empty exception\n")
         except KeyboardInterrupt:
             break
+    progress.close()
     # write here to be on the safe side .... 
-    grain.write_grain_file( "all"+tmp+".map", ul.uniqgrains )
+    save_grains( "all"+tmp+".map", ul.uniqgrains )
     p.close()
     p.join()
+    return found
+
+
+def grid_index_parallel( fltfile, parfile, tmp, gridpars, translations ):
+    """
+    fltfile containing peaks
+    parfile containing instrument geometry and unit cell
+    tmp - base name for scratch files and results
+    gridpars : dictionary of control parameters (rings to use, etc)
+    translations : list of translation positions to try
+
+    Runs a grid index algorithm using pythons multiprocessing module
+    splits workload over processes (blocks of translations to each process)
+    This thread should catch results via a queue
+
+    Finished translations are appended to tmp_done.txt after the grains
+    are saved in alltmp.map. Running again with the same tmp continues
+    from where it stopped, unless gridpars['RESUME'] is False.
+    """
+    gridpars, peaks = initgrid( fltfile, parfile, tmp, gridpars )
+    print( "Done init" )
+    NPR = set_nproc( gridpars )
+    ul = uniq_grain_list( gridpars['SYMMETRY'],
+                          gridpars['toldist'],
+                          gridpars['tolangle'] )
+    done = start_progress( tmp, gridpars, ul )
+    translations = [ t for t in translations
+                     if translation_key( t ) not in done ]
+    print( "Translations to do", len(translations) )
+    run_translations( peaks, parfile, tmp, gridpars, translations, ul, NPR )
+    peaks.close()
+
+
+def unindexed_peaks( colfile, pars, grains, tol ):
+    """
+    Returns a mask which is True for the peaks in colfile that are not
+    indexed within tol by any of the grains (at their own translations)
+    """
+    peaks_xyz = transform.compute_xyz_lab( [ colfile.sc, colfile.fc ],
+                                           **pars ).T.copy()
+    omega = np.ascontiguousarray( colfile.omega, np.float64 )
+    gv = np.zeros( ( colfile.nrows, 3 ), float )
+    drlv2 = np.ones( colfile.nrows, float )
+    labels = np.zeros( colfile.nrows, np.int32 ) - 1
+    for i, g in enumerate( grains ):
+        cImageD11.compute_gv( peaks_xyz, omega,
+                              pars.get( 'omegasign', 1.0 ),
+                              pars['wavelength'], pars['wedge'], pars['chi'],
+                              g.translation, gv )
+        cImageD11.score_and_assign( g.ubi, gv, tol, drlv2, labels, i )
+    return labels < 0
+
+
+def finer_translations( hits, step ):
+    """
+    The 26 points around each of the hits on a grid with spacing step
+    """
+    pts = {}
+    for t in hits:
+        for i in (-1, 0, 1):
+            for j in (-1, 0, 1):
+                for k in (-1, 0, 1):
+                    if i == j == k == 0:
+                        continue
+                    tn = ( t[0] + i*step, t[1] + j*step, t[2] + k*step )
+                    pts[ translation_key( tn ) ] = tn
+    return [ pts[k] for k in sorted( pts.keys() ) ]
+
+
+def grid_index_adaptive( fltfile, parfile, tmp, gridpars, translations, step ):
+    """
+    Coarse to fine version of grid_index_parallel
+    translations : a coarse grid of translations with spacing step
+    gridpars['NLEVELS'] : number of times to halve the step (default 2)
+
+    After each pass the step is halved and only the neighbours of
+    translations where the indexer found something are tried. Peaks
+    indexed by the grains accepted so far (within TOLSEQ[-1]) are
+    removed before the next pass.
+    """
+    gridpars, peaks = initgrid( fltfile, parfile, tmp, gridpars )
+    print( "Done init" )
+    NPR = set_nproc( gridpars )
+    ul = uniq_grain_list( gridpars['SYMMETRY'],
+                          gridpars['toldist'],
+                          gridpars['tolangle'] )
+    done = start_progress( tmp, gridpars, ul )
+    level = 0
+    while True:
+        todo = [ t for t in translations if translation_key( t ) not in done ]
+        print( "Level %d step %f translations %d to do %d"%(
+            level, step, len(translations), len(todo) ) )
+        done.update( run_translations( peaks, parfile, tmp, gridpars, todo,
+                                       ul, NPR ) )
+        hits = [ t for t in translations if done.get( translation_key(t), 0 ) > 0 ]
+        level += 1
+        if level > gridpars.get( 'NLEVELS', 2 ) or len(hits) == 0:
+            break
+        step = step / 2.
+        translations = finer_translations( hits, step )
+        # Remove the peaks we already explain
+        col = peaks.colfile()
+        msk = unindexed_peaks( col, col.parameters.parameters,
+                               ul.uniqgrains, gridpars['TOLSEQ'][-1] )
+        print( "Masking %d indexed peaks, %d left"%( (~msk).sum(), msk.sum() ) )
+        col.filter( msk )
+        # new name: the memmap fallback would overwrite the file in use
+        newpeaks = sharedpeaks( col, col.parameters, "%s_%d"%( tmp, level ) )
+        del col
+        peaks.close()
+        peaks = newpeaks
+    peaks.close()
 
 
 if __name__=="__main__":
@@ -77,6 +77,9 @@ def myhistogram(data, bins):
 
 def readubis(ubifile):
     """read ubifile and return a list of ubi arrays """
+    from ImageD11 import grain
+    if grain.is_hdf_file( ubifile ):
+        return list( grain.read_grain_file_h5( ubifile ).ubi )
     f = open(ubifile, "r")
     ubisread = []
     u = []
@@ -258,6 +261,42 @@ def refine(UBI, gv, tol, quiet=True):
     #      print "Mean drlv old",sum(sqrt(drlv2_old))/drlv2_old.shape[0]
     return UBIo
 
+def friedel_pairs( tth, eta, omega, tth_tol=0.1, eta_tol=1.0, omega_tol=1.0 ):
+    """
+    Find Friedel pairs of peaks. The mate of (tth, eta, omega) is at
+    (tth, 180-eta, omega+180) for a single vertical axis (wedge=chi=0).
+    The angles are scaled by the tolerances (degrees) and matched in a
+    KD-tree, wrapping around in eta and omega. Only pairs where each
+    peak is the closest match of the other are returned.
+
+    returns i, j : index arrays of the pairs with i < j
+    """
+    from scipy.spatial import cKDTree
+    tth = np.asarray( tth, float )
+    box = np.array( ( 720. / tth_tol, 360. / eta_tol, 360. / omega_tol ) )
+    def scaled( t, e, o ):
+        x = np.array( ( t / tth_tol, np.mod( e, 360 ) / eta_tol,
+                        np.mod( o, 360 ) / omega_tol ) ).T
+        return np.where( x >= box, x - box, x )
+    tree = cKDTree( scaled( tth, eta, omega ), boxsize=box )
+    mates = scaled( tth, 180. - np.asarray( eta, float ),
+                    np.asarray( omega, float ) + 180. )
+    try:
+        d, j = tree.query( mates, k=1, distance_upper_bound=1.0, workers=-1 )
+    except TypeError:   # older scipy
+        d, j = tree.query( mates, k=1, distance_upper_bound=1.0 )
+    n = len( tth )
+    i = np.arange( n )
+    found = j < n
+    i = i[found]
+    j = j[found]
+    # the best match for j must also be i
+    back = np.full( n + 1, n )
+    back[i] = j
+    keep = ( back[j] == i ) & ( i < j )
+    return i[keep], j[keep]
+
+
 def indexer_from_colfile( colfile, **kwds ):
     uc = unitcell.unitcell_from_parameters( colfile.parameters )
     w = float( colfile.parameters.get("wavelength") )
@@ -296,7 +335,7 @@ class indexer:
         if gv is not None: # do init
             logging.info('gv: %s %s %s'%( str(gv), str(gv.shape), str(gv.dtype)))
             assert gv.shape[1] == 3
-            self.gv = gv.astype( np.float )
+            self.gv = gv.astype( float )
             self.ds = np.sqrt( (gv*gv).sum(axis=1) )
             self.ga = np.zeros(len(self.ds),np.int32)-1 # Grain assignments
             self.gvflat=np.ascontiguousarray(gv, float)
@@ -437,42 +476,44 @@ class indexer:
         self.gvflat=np.ascontiguousarray(self.gvr, float) # Makes it contiguous
         # in memory, hkl fast index
 
-    def friedelpairs(self,filename):
+    def friedelpairs(self, filename, tth_tol=0.1, eta_tol=1.0, omega_tol=1.0):
         """
         Attempt to identify Freidel pairs
 
         Peaks must be assigned to the same powder ring
-        Peaks will be the closest thing to being 180 degrees apart
+        Pairs are found by friedel_pairs using the angular tolerances
+        (degrees) and are kept in self.friedel_pairs as two index arrays
         """
+        if self.ra is None:
+            self.assigntorings()
+        i, j = friedel_pairs( self.tth, self.eta, self.omega,
+                              tth_tol, eta_tol, omega_tol )
+        same = (self.ra[i] == self.ra[j]) & (self.ra[i] >= 0)
+        i = i[same]
+        j = j[same]
+        self.friedel_pairs = i, j
+        sg = self.gv[i] + self.gv[j]
+        scor = np.sqrt( (sg*sg).sum(axis=1) )
         out = open(filename,"w")
         dsr=self.unitcell.ringds
         nring = len(dsr)
-        for j in range( nring ):
-            ind = np.compress(np.equal(self.ra,j), np.arange(self.ra.shape[0]))
-            # ind is the indices of the ring assigment array - eg which hkl is this gv
-            #
-            if len(ind)==0:
+        for r in range( nring ):
+            npks = (self.ra == r).sum()
+            if npks == 0:
                 continue
-            thesepeaks = self.gv[ind]
-            #
-            h=self.unitcell.ringhkls[dsr[j]][0]
-            #
+            h=self.unitcell.ringhkls[dsr[r]][0]
             out.write("\n\n\n# h = %d \n"%(h[0]))
             out.write("# k = %d \n"%(h[1]))
             out.write("# l = %d \n"%(h[2]))
-            out.write("# npks = %d \n"%(thesepeaks.shape[0]))
+            out.write("# npks = %d \n"%(npks))
             out.write("# score eta1 omega1 tth1 gv1_x gv1_y gv1_z eta2 omega2 tth2 gv2_x gv2_y gv2_z\n")
-            for k in range(thesepeaks.shape[0]):
-                nearlyzero = thesepeaks + thesepeaks[k]
-                mag = np.sum(nearlyzero*nearlyzero,1)
-                best = np.argmin(mag)
-                if best > k:
-                    a = ind[k]
-                    out.write("%f "%( np.sqrt(mag[best]) ) )
+            for k in np.arange( len(i) )[ self.ra[i] == r ]:
+                out.write("%f "%( scor[k] ) )
+                for a in (i[k], j[k]):
                     out.write("%f %f %f %f %f %f    "%(self.eta[a],self.omega[a],self.tth[a],self.gv[a][0],self.gv[a][1],self.gv[a][2]))
-                    a = ind[best]
-                    out.write("%f %f %f %f %f %f    "%(self.eta[a],self.omega[a],self.tth[a],self.gv[a][0],self.gv[a][1],self.gv[a][2]))
-                    out.write("\n")
+                out.write("\n")
+        out.close()
+        return i, j
 
     def score_all_pairs(self, n=None):
         """
@@ -718,6 +759,65 @@ class indexer:
         else:
             logging.info("Try again, either with larger tolerance or fewer minimum peaks")
 
+    def votethem(self, symmetry="triclinic", ang_step=1.0, minvotes=None):
+        """
+        Alternative to find + scorethem using votes in orientation space
+        (see ImageD11.vote_indexer). Costs scale with the number of peaks
+        instead of with the number of pairs of peaks.
+
+        symmetry = sym_u group name for the fundamental zone
+        ang_step = orientation sampling step in degrees
+        minvotes = votes needed for a bin to be tested (default minpks)
+        """
+        from ImageD11 import vote_indexer, sym_u
+        if self.ra is None:
+            self.assigntorings()
+        start = time.time()
+        B = self.unitcell.B
+        symq = vote_indexer.symmetry_quaternions(
+            sym_u.getgroup(symmetry)(), B )
+        todo = (self.ra >= 0) & (self.ga == -1)
+        ringhkls = [ self.unitcell.ringhkls[ds] for ds in self.unitcell.ringds ]
+        votes = vote_indexer.vote( self.gv[todo], self.ra[todo], ringhkls, B,
+                                   symq, ang_step )
+        if minvotes is None:
+            minvotes = self.minpks
+        self.votes = votes
+        keys, counts = votes.best( minvotes )
+        logging.info("Voting on %d peaks took %.3f/s, %d bins to test"%(
+            todo.sum(), time.time()-start, len(keys)))
+        tol = float(self.hkl_tol)
+        drlv2tmp = np.empty( len(self.gv), float )
+        labelstmp = np.empty( len(self.gv), np.int32 )
+        # bins close to grains already found are not tested again
+        claimed = set()
+        ng = 0
+        for key, nv in zip( keys, counts ):
+            if ng >= self.max_grains or self.stop:
+                break
+            if key in claimed:
+                continue
+            claimed.add( key )
+            UBI, npk = vote_indexer.refine_candidate( votes.centre( key ), B,
+                                                      self.gvflat, tol )
+            if npk <= self.minpks:
+                continue
+            ind = self.getind( UBI, drlv2tmp=drlv2tmp, labelstmp=labelstmp )
+            ga = self.ga[ind]
+            uniqueness = np.sum(np.where(ga==-1,1,0))*1.0/ga.shape[0]
+            if uniqueness > self.uniqueness:
+                self.ga[ind] = len(self.scores)+1
+                self.ubis.append(UBI)
+                self.scores.append(npk)
+                ubistr = (" %.6f"*9)%tuple(UBI.ravel())
+                logging.info("new grain %d pks, %d votes UBI %s"%(npk,nv,ubistr))
+                ng = ng + 1
+                qz = vote_indexer.fundamental_zone(
+                    vote_indexer.ubi_to_quat( UBI, B )[np.newaxis], symq )
+                claimed.update( votes.neighbours( votes.key( qz )[0] ) )
+        logging.info("Found %d grains from votes"%(ng))
+        logging.info("Time taken %.3f/s"%(time.time()-start))
+
     def fight_over_peaks(self):
         """
         Get the best ubis from those proposed
@@ -27,6 +27,7 @@ blobs in images.
 
 
 from ImageD11 import blobcorrector, cImageD11
+from ImageD11.columnfile import columnfile_writer
 # Names of property columns in array
 from ImageD11.cImageD11 import s_1, s_I, s_I2,\
     s_fI, s_ffI, s_sI, s_ssI, s_sfI, s_oI, s_ooI, s_foI, s_soI, \
@@ -99,6 +100,12 @@ class labelimage:
     format += "  %d  %d  %d"
     titles += "\n"
     format += "\n"
+    # blob properties for the titles up to detz
+    columns = ( s_cen, f_cen, o_raw, s_1, avg_i, s_raw, f_raw,
+                m_ss, m_ff, m_sf, m_oo, m_so, m_fo, s_I, s_I2,
+                mx_I, mx_I_s, mx_I_f, mx_I_o,
+                bb_mn_s, bb_mx_s, bb_mn_f, bb_mx_f, bb_mn_o, bb_mx_o,
+                dety, detz )
 
 
     def __init__(self,
@@ -110,6 +117,7 @@ class labelimage:
         """
         Shape - image dimensions
         fileout - writeable stream for merged peaks
+                  or a filename (.h5 .hdf .hdf5 gives a hdf file)
         spatial - correction of of peak positions
         """
         self.shape = shape  # Array shape
@@ -135,12 +143,15 @@ class labelimage:
         self.verbose = 0    # For debugging
 
 
+        self.spot3d_id = 0 # counter for printing
+        if str(fileout).lower().endswith( (".h5", ".hdf", ".hdf5") ):
+            self.outfile = columnfile_writer( fileout, self.titles[1:].split() )
+            return
         if hasattr(fileout,"write"):
             self.outfile = fileout
         else:
             self.outfile = open(fileout,"w")
 
-        self.spot3d_id = 0 # counter for printing
         try:
             self.outfile.write(self.titles)
         except:
@@ -245,6 +256,8 @@ class labelimage:
         """
         Peaks are in Numeric arrays nowadays
         """
+        if isinstance( self.outfile, columnfile_writer ):
+            return self.writepeaks( peaks )
         for i in peaks:
             if i[s_1] < 0.1:
                 # Merged with another
@@ -272,6 +285,26 @@ class labelimage:
 
 
 
+    def writepeaks(self, peaks):
+        """
+        Same as outputpeaks for a columnfile_writer, one block per frame
+        """
+        keep = peaks[:, s_1] >= 0.1 # others merged with another
+        for j in keep.nonzero()[0]:
+            p = peaks[j]
+            # Spline correction
+            p[s_cen], p[f_cen] = self.corrector.correct(p[s_raw], p[f_raw])
+            p[dety], p[detz] = self.fs2yz(p[f_raw], p[s_raw])
+        pks = peaks[keep]
+        n = len(pks)
+        block = [ pks[:, c] for c in self.columns ]
+        block += [ np.full( n, self.onfirst ), np.full( n, self.onlast ),
+                   np.arange( self.spot3d_id, self.spot3d_id + n ) ]
+        self.outfile.write( block )
+        self.spot3d_id += n
+        if self.onfirst > 0:
+            self.onfirst = 0
+
     def finalise(self):
         """
         Write out the last frame
@@ -280,6 +313,8 @@ class labelimage:
         if self.lastres is not None:
             cImageD11.blob_moments(self.lastres)
             self.outputpeaks(self.lastres)
+        if isinstance( self.outfile, columnfile_writer ):
+            self.outfile.close()
         #if hasattr(self.sptfile, "close"):
         #    self.sptfile.close()
         #     wonder what that does to stdout
@@ -3,10 +3,11 @@ from __future__ import print_function
 
 from .rc_array import rc_array
 
-from numpy import dot, round_, array, float, allclose, asarray, fabs,\
+from numpy import dot, round_, array, allclose, asarray, fabs,\
     argmin, argmax, sqrt, argsort, take, sum, where, ndarray, eye,\
     zeros, cross, pi, arccos, floor
 from numpy.linalg import inv, LinAlgError
+import numpy as np
 
 import logging
 
@@ -30,6 +31,9 @@ DEBUG = False
 # Some sort of round off
 MIN_VEC2 = 1e-9*1e-9
 
+# Number of (lattice, vector) pairs to score at once in find_lattice
+BATCH_SIZE = 1000000
+
 
 
 def fparl(x, y):
@@ -123,6 +127,45 @@ def reduce(v1, v2, v3, min_vec2=MIN_VEC2):
     return vn
 
 
+def reduce_many(vl, min_vec2=MIN_VEC2):
+    """
+    Vectorised version of reduce for a stack of bases
+    vl[n,3,3] holds vector j of basis i in vl[i,j]
+    Returns ( reduced bases, mask of the bases which reduced ok )
+    Bases with a volume below min_vec2**1.5 are rejected before
+    doing any work on them (they would give BadVectors)
+    """
+    vl = np.array(vl, float)
+    ok = fabs( np.linalg.det( vl ) ) > pow(min_vec2, 1.5)
+    vn = vl[ok]
+    done = np.zeros( len(vn), bool )
+    for i in range(12):
+        vo = vn.copy()
+        # same sweep as rsweep
+        for a in range(3):
+            va = vn[:,a]
+            la = (va*va).sum(axis=1)
+            big = la > 1e-9
+            for b in range(a+1, a+3):
+                c = b%3
+                # round(fparl) as in mod, zero for short or finished
+                n = np.round( (vn[:,c]*va).sum(axis=1) / where( big, la, 1 ) )
+                n[ ~big | done ] = 0
+                vn[:,c] -= n[:,np.newaxis] * va
+        done |= np.isclose( vn, vo ).all(axis=(1,2))
+        if done.all():
+            break
+    # failing to converge is an "Algorithmic flaw" in reduce
+    good = ok.copy()
+    good[ok] = done
+    # choose the "bigger" compared to -v : sign of first non-zero
+    first = argmax( vn != 0, axis=2 )
+    sgn = np.take_along_axis( vn, first[...,np.newaxis], axis=2 )
+    vn = where( sgn < 0, -vn, vn )
+    out = vl.copy()
+    out[ok] = vn
+    return out, good
+
 class lattice(object):
     """
     Represents a 3D crystal lattice built from 3 vectors
@@ -281,6 +324,44 @@ class lattice(object):
         return s
 
 
+def index_matrices(bases, lattice_direction, vec_direction):
+    """
+    The matrices which lattice.matrix( vec_direction ) would give
+    for a stack of reduced bases[n,3,3] (as from reduce_many)
+    """
+    if lattice_direction == 'row':
+        c2r = np.transpose( bases, (0, 2, 1) )
+        if vec_direction == 'col':
+            return c2r
+        return np.linalg.inv( c2r )
+    if lattice_direction == 'col':
+        if vec_direction == 'row':
+            return bases
+        return np.linalg.inv( bases )
+    raise Exception("Direction must be row or col "+str(lattice_direction))
+
+
+def score_many(bases, vecs, tol=0.1, direction=None):
+    """
+    Vectorised version of lattice.score for a stack of reduced
+    bases[n,3,3] made from vectors in "direction".
+    Returns the number of vecs indexed by each basis
+    """
+    assert vecs.check()
+    if direction is None:
+        direction = vecs.direction
+    mats = index_matrices( bases, direction, vecs.direction )
+    if vecs.direction == 'row':
+        v = asarray( vecs ).T
+    else:
+        v = asarray( vecs )
+    # One multiply for all the peaks with all of the bases
+    h = np.matmul( mats, v )
+    h -= np.round( h )
+    r2 = ( h * h ).sum( axis=1 )
+    return ( r2 < tol * tol ).sum( axis=1 )
+
+
 def iter3d_old(n):
     """
     Generate all possible unordered combinations of vectors i,j,k
@@ -307,6 +388,17 @@ def iter3d(n):
             for i in range(j):
                 yield i,j,k
 
+def iter3d_batches(n, nbatch):
+    """
+    Same sequence as iter3d, but as arrays of [m,3] indices i,j,k
+    with up to nbatch triplets in each
+    """
+    for k in range(2,n):
+        j, i = np.tril_indices( k, -1 )
+        for start in range( 0, len(i), nbatch ):
+            sl = slice( start, start + nbatch )
+            yield np.array( ( i[sl], j[sl], np.full( len(i[sl]), k ) ) ).T
+
 #t1 = [ l for l in iter3d_old(10) ]
 #t2 = [ l for l in iter3d(10) ]
 #print t1
@@ -346,53 +438,41 @@ def find_lattice(vecs,
             if i > n_try:
                 break
         print("min_vec2",min_vec2)
-    for i,j,k in iter3d(n_try):
-        # if (i,j,k) == (0,1,6):
-        #    print vecs[i],vecs[j],vecs[k]
-        #    print gen_dir, min_vec2
+    if gen_dir == 'row':
+        allv = asarray( vecs )[:n_try]
+    elif gen_dir == 'col':
+        allv = asarray( vecs ).T[:n_try]
+    else:
+        raise Exception("Logical impossibility")
+    # Vectors which are too short are never used
+    usable = np.arange( len(allv) )[ (allv * allv).sum( axis=1 ) >= min_vec2 ]
+    # Number of lattices to score at once, limits the memory used
+    nbatch = max( 16, BATCH_SIZE // max( 1, test_vecs.nvectors() ) )
+    for ijk in iter3d_batches( len(usable), nbatch ):
+        ijk = usable[ ijk ]
+        bases, ok = reduce_many( allv[ ijk ], min_vec2 )
+        if not ok.any():
+            continue
+        ijk = ijk[ok]
+        scores = score_many( bases[ok], test_vecs, tol, direction=gen_dir )
+        frac = 1.0 * scores / test_vecs.nvectors()
         if noisy:
-            print("Try",i,j,k, end=' ')
-        try:
-            if gen_dir == 'row':
-                if dot(vecs[i], vecs[i]) < min_vec2: continue
-                if dot(vecs[j], vecs[j]) < min_vec2: continue
-                if dot(vecs[k], vecs[k]) < min_vec2: continue
-                print(i,j,k, end=' ')
-                l = lattice(vecs[i], vecs[j], vecs[k], 
-                            direction = gen_dir,
-                            min_vec2 = min_vec2)
-            elif gen_dir == 'col':
-                try:
-                    if dot(vecs[:,i], vecs[:,i]) < min_vec2: continue
-                    if dot(vecs[:,j], vecs[:,j]) < min_vec2: continue
-                    if dot(vecs[:,k], vecs[:,k]) < min_vec2: continue
-                    # print i,j,k,dot(vecs[:,i], vecs[:,i]),dot(vecs[:,j], vecs[:,j]),dot(vecs[:,k], vecs[:,k])
-                    l = lattice(vecs[:,i], vecs[:,j], vecs[:,k], 
-                            direction = gen_dir,
-                            min_vec2 = min_vec2)
-                except IndexError:
-                    print(i,j,k,n_try,vecs.shape)
-                    raise
-                    
-            else:
-                raise Exception("Logical impossibility")
-            # First test on vecs
-            
-            scor = l.score( vecs, tol )
-            frac = 1.0 * scor / vecs.nvectors()
-            if noisy:
-                print("Score on vecs",scor,frac, end=' ')
-            
+            for t, f in zip( ijk, frac ):
+                print("Try", t, "score on test_vecs", f)
+        for t in np.nonzero( frac > fraction_indexed )[0]:
+            # Build the lattice in the usual way and confirm the score
+            i, j, k = ijk[t]
+            try:
+                l = lattice( allv[i], allv[j], allv[k],
+                             direction = gen_dir,
+                             min_vec2 = min_vec2 )
+            except BadVectors:
+                continue
             scor = l.score( test_vecs, tol )
-            frac = 1.0 * scor / test_vecs.nvectors()
-            if noisy:
-                print("score on test_vecs",scor,frac)
-            if frac > fraction_indexed:
+            if 1.0 * scor / test_vecs.nvectors() > fraction_indexed:
                 if noisy:
                     print("Returning")
                 return l
-        except BadVectors:
-            pass
     return None
 
 
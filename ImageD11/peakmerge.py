@@ -564,15 +564,25 @@ class peakmerger:
         """
         # Write out minimal information
         # list of xcorr,ycorr,omega, try to keep intensity now
+        # filenames ending .h5 .hdf .hdf5 give a hdf file
         """
-        f=open(filename,"w")
-        f.write(
-          "# xc yc omega npixels avg_intensity x_raw y_raw sigx sigy covxy\n")
+        titles = ["xc", "yc", "omega", "npixels", "avg_intensity",
+                  "x_raw", "y_raw", "sigx", "sigy", "covxy"]
         p =  self.finalpeaks
-        for i in range(p.shape[1]):
-            for j in range(p.shape[0]):
-                f.write("%f "%(p[j,i]))
-            f.write("\n")
+        if str( filename ).lower().endswith( (".h5",".hdf",".hdf5") ):
+            from ImageD11.columnfile import columnfile_writer
+            with columnfile_writer( filename, titles ) as w:
+                if len( p ):
+                    w.write( p )
+            return
+        # text files as always, %f for everything
+        f=open(filename,"w")
+        f.write( "# " + " ".join( titles ) + "\n" )
+        if len( p ):
+            for i in range(p.shape[1]):
+                for j in range(p.shape[0]):
+                    f.write("%f "%(p[j,i]))
+                f.write("\n")
         f.close()
 
 
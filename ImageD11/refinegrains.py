@@ -132,6 +132,98 @@ def get_options(parser):
     return parser
 
 
+# Each thread in assign_best_grain has its own gv, drlv2 and labels,
+# 36 bytes per peak. The default number of threads keeps these below
+# ASSIGN_MEMORY bytes with at least ASSIGN_MIN_GRAINS grains per thread.
+ASSIGN_MEMORY = 1 << 30
+ASSIGN_MIN_GRAINS = 4
+
+def assign_threads( npks, ngrains, memory = ASSIGN_MEMORY ):
+    """
+    Default number of threads for assign_best_grain : the openmp max
+    threads, capped by the memory for the per thread arrays and the
+    number of grains
+    """
+    n = min( cImageD11.cimaged11_omp_get_max_threads(),
+             ngrains // ASSIGN_MIN_GRAINS,
+             memory // ( 36 * max( npks, 1 ) ) )
+    return max( 1, int( n ) )
+
+
+def _assign_block( args ):
+    """
+    Serial compute_gv + score_and_assign for a block of grains
+    using private gv, drlv2 and labels arrays
+    """
+    peaks_xyz, omega, pars, tol, block = args
+    omegasign, wvln, wedge, chi = pars
+    nr = len(omega)
+    gv = numpy.zeros( (nr, 3), float )
+    drlv2 = numpy.ones( nr, float )
+    labels = numpy.zeros( nr, numpy.int32 ) - 1
+    for label, translation, ubi in block:
+        cImageD11.compute_gv( peaks_xyz, omega, omegasign, wvln, wedge, chi,
+                              translation, gv )
+        cImageD11.score_and_assign( ubi, gv, tol, drlv2, labels, label )
+    return drlv2, labels, gv
+
+
+def _refine_position( args ):
+    """
+    Worker for refinegrains.refinepositions : o is a refinegrains
+    holding a single grain (see grain_subset)
+    """
+    o, key, maxiters, method = args
+    # progress output from many processes would be interleaved
+    o.refineposition( key, maxiters, monitor=0, method=method )
+    g = o.grains[key]
+    o.refine( g.ubi )
+    return key, g.translation, g.ubi, o.npks, o.avg_drlv2
+
+
+def assign_best_grain( peaks_xyz, omega, pars, tol, grains, nthreads=1 ):
+    """
+    Assigns each peak to the grain which indexes it best
+    peaks_xyz = [npks,3] spot positions in the lab
+    omega = [npks] rotation angles
+    pars = omegasign, wavelength, wedge, chi
+    grains = list of (label, translation, ubi)
+    nthreads = grains are split into this many blocks scored in parallel
+               each thread allocates gv, drlv2 and labels for all
+               the peaks (36 bytes per peak), see assign_threads
+
+    The blocks are merged in order and a later block only wins for a
+    strictly smaller drlv2, so ties go to the first grain as they do
+    when all grains are scored serially. The result does not depend on
+    nthreads.
+    Returns drlv2, labels and the gv computed for the last grain
+    """
+    peaks_xyz = numpy.ascontiguousarray( peaks_xyz, float )
+    omega = numpy.ascontiguousarray( omega, float )
+    nthreads = max( 1, min( nthreads, len(grains) ) )
+    if nthreads == 1:
+        return _assign_block( ( peaks_xyz, omega, pars, tol, grains ) )
+    bounds = numpy.linspace( 0, len(grains), nthreads + 1 ).astype(int)
+    jobs = [ ( peaks_xyz, omega, pars, tol, grains[i0:i1] )
+             for i0, i1 in zip( bounds[:-1], bounds[1:] ) ]
+    from multiprocessing.pool import ThreadPool
+    # Parallel over grains : one openmp thread in each worker
+    pool = ThreadPool( nthreads,
+                       initializer = cImageD11.cimaged11_omp_set_num_threads,
+                       initargs = (1,) )
+    try:
+        results = pool.map( _assign_block, jobs )
+    finally:
+        pool.close()
+        pool.join()
+    drlv2, labels, gv = results[0]
+    for d, l, gv in results[1:]:
+        better = d < drlv2
+        drlv2[better] = d[better]
+        labels[better] = l[better]
+    return drlv2, labels, gv
+
+
 class refinegrains:
 
     """
@@ -216,6 +308,8 @@ class refinegrains:
         self.parameterobj = parameters.parameters(**self.pars)
         self.intensity_tth_range = intensity_tth_range
         self.recompute_xlylzl = False
+        # fingerprint -> result of refineposition
+        self.refine_cache = {}
         for k,s in list(self.stepsizes.items()):
             self.parameterobj.stepsizes[k]=s
 
@@ -308,10 +402,10 @@ class refinegrains:
         self.scannames.append(filename)
         self.scantitles[filename] = col.titles
         if not "drlv2" in col.titles:
-            col.addcolumn( numpy.ones(col.nrows, numpy.float),
+            col.addcolumn( numpy.ones(col.nrows, float),
                            "drlv2" )
         if not "labels" in col.titles:
-            col.addcolumn( numpy.ones(col.nrows, numpy.float)-2,
+            col.addcolumn( numpy.ones(col.nrows, float)-2,
                            "labels" )
         if not "sc" in col.titles:
             assert "xc" in col.titles
@@ -633,31 +727,238 @@ class refinegrains:
         self.parameterobj.parameters['t_z'] = self.grains[(gr,sc)].translation[2]
 
 
-    def refinepositions(self, quiet=True, maxiters=100):
+    def refinepositions(self, quiet=True, maxiters=100, nproc=1,
+                        method="simplex"):
+        """
+        Refines the translation of each grain in turn, with the peak
+        assignments fixed by assignlabels
+        nproc = number of processes. Grains are independent so each
+        worker gets a copy holding the peaks of one grain only.
+        method = "simplex" or "lsq" (see refineposition)
+        Grains found in self.refine_cache are not refined again
+        (see fingerprint and cached_position).
+        """
         self.assignlabels()
         ks  = list(self.grains.keys())
         ks.sort()
         # assignments are now fixed
         tolcache = self.tolerance
         self.tolerance = 1.0
+        todo = []
         for key in ks:
-            g = key[0]
-            self.grains_to_refine = [key]
+            fp = self.fingerprint( key, method, maxiters )
+            c = self.cached_position( key, fp )
+            if c is None:
+                todo.append( ( key, fp, self.ubisread[key[0]].copy(),
+                               numpy.array( self.grains[key].translation,
+                                            float ) ) )
+                continue
+            self.grains[key].translation[:] = c['translation']
+            self.grains[key].set_ubi( c['ubi'] )
+            self.npks, self.avg_drlv2 = c['npks'], c['drlv2']
+            print(key,self.grains[key].translation, end=' ')
+            print("%-8d %.6f cached"%(self.npks, numpy.sqrt(self.avg_drlv2)))
+        if nproc is None:
+            import multiprocessing
+            nproc = multiprocessing.cpu_count()
+        if nproc > 1 and len(todo) > 1:
+            import multiprocessing
+            jobs = ( (self.grain_subset( key ), key, maxiters, method)
+                     for key, fp, ubi0, t0 in todo )
+            pool = multiprocessing.Pool( processes = nproc,
+                        initializer = cImageD11.cimaged11_omp_set_num_threads,
+                        initargs = (1,) )
+            try:
+                for ( key, translation, ubi, npks, drlv2 ), job in zip(
+                        pool.imap( _refine_position, jobs ), todo ):
+                    self.grains[key].translation[:] = translation
+                    self.grains[key].set_ubi( ubi )
+                    print(key,self.grains[key].translation, end=' ')
+                    self.npks, self.avg_drlv2 = npks, drlv2
+                    print("%-8d %.6f"%(npks, numpy.sqrt(drlv2)))
+                    self.cache_position( *job )
+            finally:
+                pool.close()
+                pool.join()
+            # leave the object as the serial loop does
+            self.grains_to_refine = [ks[-1]]
             self.parameterobj.varylist = [ 't_x', 't_y', 't_z' ]
-            self.set_translation(key[0],key[1])
-            guess = self.parameterobj.get_variable_values()
-            inc =   self.parameterobj.get_variable_stepsizes()
+            self.set_translation(ks[-1][0], ks[-1][1])
+        else:
+            for job in todo:
+                key = job[0]
+                self.refineposition( key, maxiters, method=method )
+                print(key,self.grains[key].translation, end=' ')
+                self.refine(self.grains[key].ubi,quiet=False)
+                self.cache_position( *job )
+        self.tolerance = tolcache
 
-            s =     simplex.Simplex(self.gof, guess, inc)
+    def fingerprint(self, key, method="simplex", maxiters=100):
+        """
+        Hash of what refineposition depends on, apart from the starting
+        ubi and translation: the peaks assigned to grain key, the
+        geometry (except t_x, t_y, t_z) and the fit settings
+        """
+        import hashlib
+        g = self.grains[key]
+        h = hashlib.sha1()
+        for ar in ( g.sc, g.fc, g.om ):
+            h.update( numpy.ascontiguousarray( ar, float ).tobytes() )
+        pars = self.parameterobj.parameters
+        geometry = [ (k, pars[k]) for k in sorted( pars.keys() )
+                     if k not in ( 't_x', 't_y', 't_z' ) ]
+        steps = sorted( self.parameterobj.stepsizes.items() )
+        settings = ( geometry, steps, self.OMEGA_FLOAT, self.slop,
+                     self.latticesymmetry.__name__, method, maxiters )
+        h.update( repr( settings ).encode() )
+        return h.hexdigest()
+
+    def cached_position(self, key, fp):
+        """
+        Cached result for grain key with fingerprint fp, or None.
+        The starting ubi and translation must match the ones which were
+        refined before, or the result of that refinement (so a grain
+        which has converged is not refined again). The tolerances
+        allow for the precision of the ubi files.
+        """
+        c = self.refine_cache.get( fp )
+        if c is None:
+            return None
+        ubi = self.ubisread[key[0]]
+        t = self.grains[key].translation
+        for ubic, tc in ( ( c['ubi_in'], c['translation_in'] ),
+                          ( c['ubi'], c['translation'] ) ):
+            if numpy.allclose( ubi, ubic, rtol=1e-6, atol=1e-9 ) and \
+               numpy.allclose( t, tc, rtol=1e-5, atol=1e-4 ):
+                return c
+        return None
+
+    def cache_position(self, key, fp, ubi_in, translation_in):
+        """ Records the refined grain key in self.refine_cache """
+        g = self.grains[key]
+        self.refine_cache[fp] = {
+            'ubi_in' : ubi_in,
+            'translation_in' : translation_in,
+            'ubi' : numpy.array( g.ubi, float ),
+            'translation' : numpy.array( g.translation, float ),
+            'npks' : self.npks,
+            'drlv2' : self.avg_drlv2 }
+
+    def save_refine_cache(self, filename):
+        """ Writes self.refine_cache to a numpy .npz file """
+        fps = sorted( self.refine_cache.keys() )
+        cols = {}
+        for name in ( 'ubi_in', 'translation_in', 'ubi', 'translation',
+                      'npks', 'drlv2' ):
+            cols[name] = numpy.array( [ self.refine_cache[fp][name]
+                                        for fp in fps ] )
+        numpy.savez( filename, fingerprint = numpy.array( fps ), **cols )
+
+    def load_refine_cache(self, filename):
+        """ Adds the entries in a file from save_refine_cache """
+        with numpy.load( filename ) as f:
+            names = [ n for n in f.files if n != 'fingerprint' ]
+            cols = dict( [ ( n, f[n] ) for n in names ] )
+            for i, fp in enumerate( f['fingerprint'] ):
+                self.refine_cache[ str(fp) ] = dict(
+                    [ ( n, cols[n][i] ) for n in names ] )
+
+    def refineposition(self, key, maxiters=100, monitor=1, method="simplex"):
+        """
+        Fit of the translation of grain key = (grainname, scanname)
+        method = "simplex" : minimise gof, refitting the ubi at each step
+                 "lsq" : least squares for ubi and translation together
+        """
+        if method == "lsq":
+            return self.refineposition_lsq( key )
+        if method != "simplex":
+            raise ValueError("Unknown refinement method "+str(method))
+        self.grains_to_refine = [key]
+        self.parameterobj.varylist = [ 't_x', 't_y', 't_z' ]
+        self.set_translation(key[0],key[1])
+        guess = self.parameterobj.get_variable_values()
+        inc =   self.parameterobj.get_variable_stepsizes()
 
-            newguess, error, iter = s.minimize(maxiters=maxiters,monitor=1)
+        s =     simplex.Simplex(self.gof, guess, inc)
 
-            self.grains[key].translation[0] = self.parameterobj.parameters['t_x']
-            self.grains[key].translation[1] = self.parameterobj.parameters['t_y']
-            self.grains[key].translation[2] = self.parameterobj.parameters['t_z']
-            print(key,self.grains[key].translation, end=' ')
-            self.refine(self.grains[key].ubi,quiet=False)
-        self.tolerance = tolcache
+        newguess, error, iter = s.minimize(maxiters=maxiters,monitor=monitor)
+
+        self.grains[key].translation[0] = self.parameterobj.parameters['t_x']
+        self.grains[key].translation[1] = self.parameterobj.parameters['t_y']
+        self.grains[key].translation[2] = self.parameterobj.parameters['t_z']
+
+    def refineposition_lsq(self, key, ncycles=5):
+        """
+        Fits the UB matrix and translation of grain key together by
+        Gauss-Newton least squares on the g-vectors, using the analytic
+        derivatives in rotdex. The hkl are assigned once with the
+        ubi that was read in. Each cycle is one linear solve.
+        With OMEGA_FLOAT the omegas are the ones from compute_gv (the
+        observed omega moved by up to slop towards the computed one)
+        for the current translation, and the fit is done twice so
+        they follow the new translation.
+        The ubi is then finished with refine, as in gof.
+        """
+        from ImageD11 import rotdex
+        g = self.grains[key]
+        pars = self.parameterobj.parameters
+        sign = pars.get('omegasign', 1.0)
+        wvln = float(pars['wavelength'])
+        ubi = self.ubisread[key[0]]
+        t = numpy.array( g.translation, float )
+        hkl = None
+        for npass in range( 2 if self.OMEGA_FLOAT else 1 ):
+            if self.OMEGA_FLOAT:
+                g.translation[:] = t
+                self.set_translation( key[0], key[1] )
+                self.compute_gv( g )
+                om = g.omega_calc
+            else:
+                om = g.om * sign
+            # spot positions and beam in the rotating crystal frame
+            peaks_Cxyz = transform.compute_g_from_k( g.peaks_xyz.T, om,
+                                                     wedge = pars['wedge'],
+                                                     chi = pars['chi'] )
+            beam = numpy.zeros( peaks_Cxyz.shape )
+            beam[0] = 1.0 / wvln
+            beam_Cxyz = transform.compute_g_from_k( beam, om,
+                                                    wedge = pars['wedge'],
+                                                    chi = pars['chi'] )
+            if hkl is None:
+                hkl = numpy.round( numpy.dot( ubi, rotdex.compute_Cgve(
+                    t, peaks_Cxyz, beam_Cxyz, wvln ) ) )
+            # 12 parameters, 3 observations per peak
+            if g.npks > 4:
+                try:
+                    ub, t = rotdex.fit_ub_t( numpy.linalg.inv( ubi ), t, hkl,
+                                             peaks_Cxyz, beam_Cxyz, wvln,
+                                             ncycles = ncycles, tol = 1e-3 )
+                    ubi = numpy.linalg.inv( ub )
+                except numpy.linalg.LinAlgError:
+                    print("Singular least squares for grain",key)
+                    t = numpy.array( g.translation, float )
+                    break
+        g.translation[:] = t
+        self.grains_to_refine = [key]
+        self.set_translation( key[0], key[1] )
+        self.compute_gv( g )
+        g.set_ubi( self.refine( ubi ) )
+
+    def grain_subset(self, key):
+        """
+        A copy of self holding only what is needed to refine grain key,
+        to be sent to another process
+        """
+        import copy
+        new = copy.copy( self )
+        for name in ( 'gv', 'tth', 'eta' ):
+            new.__dict__.pop( name, None )
+        new.scandata = {}
+        new.refine_cache = {}
+        new.grains = { key : self.grains[key] }
+        new.ubisread = { key[0] : self.ubisread[key[0]] }
+        new.parameterobj = copy.deepcopy( self.parameterobj )
+        return new
 
 
     def refineubis(self, quiet=True, scoreonly=False):
@@ -681,9 +982,12 @@ class refinegrains:
                 g.set_ubi( res )
 
 
-    def assignlabels(self, quiet=False):
+    def assignlabels(self, quiet=False, nthreads=None):
         """
         Fill out the appropriate labels for the spots
+        nthreads = number of threads scoring grains (default from
+        assign_threads, which limits the memory used as each thread
+        needs 36 bytes per peak). The labels do not depend on it.
         """
         if not quiet:
 	        print("Assigning labels with XLYLZL")
@@ -691,7 +995,7 @@ class refinegrains:
         start = time.time()
         for s in self.scannames:
             self.scandata[s].labels = self.scandata[s].labels*0 - 2 # == -1
-            drlv2 = numpy.zeros(len(self.scandata[s].drlv2), numpy.float)+1
+            drlv2 = numpy.zeros(len(self.scandata[s].drlv2), float)+1
             nr = self.scandata[s].nrows
             sc = self.scandata[s].sc
             fc = self.scandata[s].fc
@@ -707,31 +1011,26 @@ class refinegrains:
             if not quiet:
             	print("Start first grain loop",time.time()-start)
             start = time.time()
-            gv = numpy.zeros((nr,3),numpy.float )
+            gv = numpy.zeros((nr,3),float )
             wedge = self.parameterobj.parameters['wedge']
             omegasign = self.parameterobj.parameters['omegasign']
             chi   = self.parameterobj.parameters['chi']
             wvln  = self.parameterobj.parameters['wavelength']
             first_loop = time.time()
-            drlv2 = (self.scandata[s].drlv2*0 + 1).astype(float)  # == 1
-            int_tmp = numpy.zeros(nr , numpy.int32 )-1
-            for ig, g in enumerate(self.grainnames):
-                gr = self.grains[ ( g, s) ]
-                self.set_translation( g, s)
-                cImageD11.compute_gv( peaks_xyz,
+            grains = [ ( int(g), self.grains[(g, s)].translation,
+                         self.grains[(g, s)].ubi ) for g in self.grainnames ]
+            nt = nthreads
+            if nt is None:
+                nt = assign_threads( nr, len(grains) )
+            drlv2, int_tmp, gv = assign_best_grain( peaks_xyz,
                     self.scandata[s].omega,
-                    omegasign,
-                    wvln,
-                    wedge,
-                    chi,
-                    gr.translation,
-                    gv)
-                cImageD11.score_and_assign( gr.ubi,
-                                            gv,
-                                            self.tolerance,
-                                            drlv2,
-                                            int_tmp,
-                                            int(g))
+                    ( omegasign, wvln, wedge, chi ),
+                    self.tolerance,
+                    grains,
+                    nt )
+            if len(self.grainnames):
+                # as for the serial loop, translation of the last grain
+                self.set_translation( self.grainnames[-1], s )
             if not quiet:
             	print(time.time()-first_loop,"First loop")
 
@@ -775,11 +1074,11 @@ class refinegrains:
             start = time.time()
 
             # We have the labels set in self.scandata!!!
+            labels_index = self.scandata[s].index( "labels" )
             for g in self.grainnames:
                 gr = self.grains[ ( g, s) ]
 
-                ind = numpy.compress(int_tmp == g,
-                                     numpy.arange(nr) )
+                ind = labels_index.equal( g )
                 #print 'x',gr.x[:10]
                 #print 'ind',ind[:10]
                 gr.ind = ind # use this to push back h,k,l later
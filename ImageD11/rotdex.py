@@ -86,11 +86,12 @@ def compute_dgdt( txyz, peaks_Cxyz, beam_Cxyz, wavelength):
     return r, drdT
 
 
-def fit_ub_t( ub, translation, hkl, peaks_Cxyz, beam_Cxyz, wavelength):
+def fit_ub_t( ub, translation, hkl, peaks_Cxyz, beam_Cxyz, wavelength,
+              ncycles=2, tol=None ):
     """
     Fits the ub and grain origin to a list of assigned peaks
     All unit cell and orientations parameters are free
-    Runs 2 cycles (empirically this converges)
+    Runs 2 cycles by default (empirically this converges)
     
     ub = (3,3) input UB matrix (so that h ~= UB.g)
     translation = (3,) grain origin
@@ -98,6 +99,8 @@ def fit_ub_t( ub, translation, hkl, peaks_Cxyz, beam_Cxyz, wavelength):
     peaks_Cxyz = (3,n) spot positions in crystal frame (getCxyz)
     beam_Cxyz = (3,n) beam directions in crystal frame (getCxyz)
     wavelength = float, radiation, normalises length
+    ncycles = maximum number of Gauss-Newton cycles
+    tol = stop when the translation shifts are all smaller than this
     returns fitted UB and translation
     """
     npk = len(hkl[0])
@@ -130,7 +133,7 @@ def fit_ub_t( ub, translation, hkl, peaks_Cxyz, beam_Cxyz, wavelength):
     ubnew = ub.copy()
     # empirically it converges to 3 decimal places in 1 cycle
     # ...since: dgobsdt seems to depend on t we run a couple of cycles
-    for _ in range(2):
+    for _ in range(ncycles):
         gobs, dgobsdt = compute_dgdt( tnew, peaks_Cxyz, beam_Cxyz, wavelength )
         # Note dgdub=h does not change here
         for i in range(3):
@@ -146,6 +149,8 @@ def fit_ub_t( ub, translation, hkl, peaks_Cxyz, beam_Cxyz, wavelength):
         dg.shape =  (12,3,npk) 
         ubnew = ubnew  - np.reshape(shifts[:9],(3,3))
         tnew  = tnew - shifts[9:]
+        if tol is not None and (abs(shifts[9:]) < tol).all():
+            break
     return ubnew, tnew
 
 def fitagrain( gr, pars ):
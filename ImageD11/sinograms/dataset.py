@@ -1,7 +1,7 @@
 
 from __future__ import print_function, division
 
-import os, h5py, numpy as np
+import os, sys, h5py, numpy as np
 import fast_histogram
 import logging
     
@@ -21,6 +21,126 @@ TO DO:
 
 """
     
+def read_scan_metadata( args ):
+    """
+    args = ( masterfile, scans, detector, omegamotor, dtymotor )
+    Reads what import_imagefiles (if detector is not None) and
+    import_motors_from_master (if the motors are not None) need for
+    some scans. This is a function so it can run in a worker process
+    (h5py is not thread safe).
+    Returns a list with a dict for each scan.
+    """
+    masterfile, scans, detector, omegamotor, dtymotor = args
+    result = []
+    with h5py.File( masterfile, 'r' ) as hin:
+        for scan in scans:
+            meta = { 'scan' : scan, 'npts' : None, 'imageshape' : None,
+                     'imagefiles' : [], 'frames_per_file' : [],
+                     'limapaths' : [] }
+            if detector is not None and ('measurement' in hin[scan]) and \
+               (detector in hin[scan]['measurement']):
+                frames = hin[scan]['measurement'][detector]
+                meta['npts'] = len(frames)
+                meta['imageshape'] = frames.shape[1:]
+                for vsrc in frames.virtual_sources():
+                    meta['imagefiles'].append( vsrc.file_name )
+                    meta['frames_per_file'].append( vsrc.src_space.shape[0] ) # not sure about this
+                    meta['limapaths'].append( vsrc.dset_name )
+            if omegamotor is not None:
+                # Should always be there, if not, filter scans before you get to here
+                meta['omega'] = hin[scan][ 'measurement' ][ omegamotor ][()]
+                meta['dty'] = hin[scan][ 'instrument/positioners' ][ dtymotor ][()]
+            result.append( meta )
+    return result
+
+
+def ring_labels( tthimage, tthbounds ):
+    """
+    Image of ring numbers for DataSet.sparse_sinogram
+    tthimage = two theta for each detector pixel
+    tthbounds = [ (low, high), ... ] for each ring
+    Pixels which are in no ring get -1
+    """
+    labels = np.full( tthimage.shape, -1, np.int32 )
+    for i, ( lo, hi ) in enumerate( tthbounds ):
+        labels[ ( tthimage >= lo ) & ( tthimage < hi ) ] = i
+    return labels
+
+
+SINO_SHARED = None  # arguments common to all the files, set once per process
+
+def sparse_sinogram_init( shared ):
+    """
+    Pool initializer for sparse_sinogram_job, so that the things which are
+    the same for every file (including a large image_labels) are sent to
+    each process only once
+    shared = ( limapath, bins, rng, weights, image_labels, pixel_labels,
+               nlabels, chunksize )
+    """
+    global SINO_SHARED
+    SINO_SHARED = shared
+
+
+def sparse_sinogram_job( args ):
+    """
+    Bins the pixels of one sparse file onto the sinogram grid
+    args = ( sparsefile, omega, dty )
+    omega, dty = motor positions for the frames in this file
+    The rest comes from sparse_sinogram_init.
+    Reads nnz and then only the pixel columns which are needed,
+    chunksize pixels at a time. Returns histo[nlabels, nomega, ny]
+    """
+    sparsefile, omega, dty = args
+    ( limapath, bins, rng, weights, image_labels, pixel_labels, nlabels,
+      chunksize ) = SINO_SHARED
+    with h5py.File( sparsefile, 'r' ) as hin:
+        grp = hin[limapath]
+        nnz = grp['nnz'][:].astype( np.int64 )
+        nframes = len( nnz )
+        if nframes != len( omega ):
+            raise Exception( 'nnz does not match the frames in %s'%( sparsefile ) )
+        if weights is None and image_labels is None and pixel_labels is None:
+            # pixel counts, no need to read the pixels
+            sums = nnz[np.newaxis, :].astype( float )
+        else:
+            ipt = np.concatenate( ( (0,), np.cumsum( nnz ) ) )
+            sums = np.zeros( nlabels * nframes, float )
+            for p0 in range( 0, ipt[-1], chunksize ):
+                p1 = min( p0 + chunksize, ipt[-1] )
+                # frame number for each pixel in the chunk
+                f0 = np.searchsorted( ipt, p0, side = 'right' ) - 1
+                f1 = np.searchsorted( ipt, p1, side = 'left' )
+                counts = np.clip( ipt[f0+1:f1+1], p0, p1 ) - np.clip( ipt[f0:f1], p0, p1 )
+                key = np.repeat( np.arange( f0, f1 ), counts )
+                if weights is None:
+                    wt = None
+                else:
+                    wt = grp[weights][p0:p1].astype( float )
+                if image_labels is not None:
+                    lab = image_labels[ grp['row'][p0:p1], grp['col'][p0:p1] ]
+                elif pixel_labels is not None:
+                    lab = grp[pixel_labels][p0:p1]
+                else:
+                    lab = None
+                if lab is not None:
+                    use = ( lab >= 0 ) & ( lab < nlabels )
+                    key = key[use] + lab[use].astype( np.int64 ) * nframes
+                    if wt is not None:
+                        wt = wt[use]
+                sums += np.bincount( key, weights = wt, minlength = len( sums ) )
+            sums = sums.reshape( nlabels, nframes )
+    # Same binning as fast_histogram : [lo, hi)
+    io = np.floor( ( omega - rng[0][0] ) * bins[0] / ( rng[0][1] - rng[0][0] ) ).astype( np.int64 )
+    iy = np.floor( ( dty - rng[1][0] ) * bins[1] / ( rng[1][1] - rng[1][0] ) ).astype( np.int64 )
+    ok = ( io >= 0 ) & ( io < bins[0] ) & ( iy >= 0 ) & ( iy < bins[1] )
+    ib = io[ok] * bins[1] + iy[ok]
+    histo = np.empty( ( len( sums ), bins[0], bins[1] ), float )
+    for i, frame_sums in enumerate( sums ):
+        histo[i] = np.bincount( ib, weights = frame_sums[ok],
+                                minlength = bins[0] * bins[1] ).reshape( bins )
+    return histo
+
+
 def guess_chunks(name, shape):
     if name == 'omega':
         return ( shape[0], 1 )
@@ -39,6 +159,9 @@ class DataSet:
     STRINGLISTS = ( "scans", "imagefiles", "sparsefiles" )
     # sinograms
     NDNAMES = ( "omega", "dty", "nnz", "frames_per_file" )
+    # what load_cache restores, the paths stay as they are
+    CACHENAMES = ( "scans", "imagefiles", "frames_per_file", "limapath",
+                   "shape", "omega", "dty" )
 
     def __init__(self,
                  dataroot = ".",
@@ -125,13 +248,18 @@ class DataSet:
         print("# Segmented %d missing %d"%(self.check_sparse()))
 
     
-    def import_all(self):
-        # collect the data
-        self.import_scans()
-        # lima frames
-        self.import_imagefiles()
-        # motor positions
-        self.import_motors_from_master()
+    def import_all(self, nproc=None, cache=True):
+        """
+        nproc = worker processes for reading the scans (default cpu_count)
+        cache = reuse or write the metadata cache file (see cachefile)
+        """
+        if not ( cache and self.load_cache() ):
+            # collect the data
+            self.import_scans()
+            # lima frames and motor positions
+            self.import_metadata( nproc )
+            if cache:
+                self.save_cache()
         # pixels per frame
         try:
             self.import_nnz()
@@ -153,26 +281,32 @@ class DataSet:
     
     def import_imagefiles(self):
         """ Get the Lima file names from the bliss master file, also scan_npoints """
+        self.set_imagefiles( read_scan_metadata( ( self.masterfile, self.scans,
+                                                   self.detector, None, None ) ) )
+
+
+    def set_imagefiles(self, metas):
+        """ Fills in the lima files from the read_scan_metadata results """
         npts = None
+        imageshape = (0, 0)
         self.imagefiles = []
         self.frames_per_file = []
-        with h5py.File( self.masterfile, 'r' ) as hin:
-            for i, scan in enumerate( self.scans ):
-                if ('measurement' not in hin[scan]) or (self.detector not in hin[scan]['measurement']):
-                    continue
-                frames = hin[scan]['measurement'][self.detector]
-                imageshape = frames.shape[1:]
-                if npts is None:
-                    npts = len(frames)
-                else:
-                    assert len(frames) == npts, 'scan is not regular %d %s :: %s'%(npts, self.masterfile, scan)
-                for vsrc in frames.virtual_sources():
-                    self.imagefiles.append( vsrc.file_name )
-                    self.frames_per_file.append( vsrc.src_space.shape[0] ) # not sure about this
-                    # check limapath
-                    if self.limapath is None:
-                        self.limapath = vsrc.dset_name
-                    assert self.limapath == vsrc.dset_name
+        for meta in metas:
+            if meta['npts'] is None:
+                continue
+            if npts is None:
+                npts = meta['npts']
+                imageshape = meta['imageshape']
+            else:
+                assert meta['npts'] == npts, 'scan is not regular %d %s :: %s'%(
+                    npts, self.masterfile, meta['scan'])
+            self.imagefiles += meta['imagefiles']
+            self.frames_per_file += meta['frames_per_file']
+            for limapath in meta['limapaths']:
+                # check limapath
+                if self.limapath is None:
+                    self.limapath = limapath
+                assert self.limapath == limapath
         self.frames_per_file = np.array( self.frames_per_file, int )
         self.sparsefiles = [ name.replace( '/', '_' ).replace( '.h5', '_sparse.h5' ) for name in 
                              self.imagefiles ]
@@ -182,18 +316,118 @@ class DataSet:
             self.shape[0], self.shape[1], imageshape[0], imageshape[1] ) )
                      
             
+    def import_metadata(self, nproc=None, scans_per_job=8):
+        """
+        Does import_imagefiles and import_motors_from_master at once,
+        reading the scans in nproc worker processes
+        """
+        args = [ ( self.masterfile, self.scans[i:i+scans_per_job], self.detector,
+                   self.omegamotor, self.dtymotor )
+                 for i in range( 0, len(self.scans), scans_per_job ) ]
+        import multiprocessing
+        if nproc is None:
+            nproc = multiprocessing.cpu_count()
+        if nproc > 1 and len(args) > 1:
+            mypool = multiprocessing.Pool( nproc )
+            try:
+                metas = mypool.map( read_scan_metadata, args )
+            finally:
+                mypool.close()
+                mypool.join()
+        else:
+            metas = [ read_scan_metadata( a ) for a in args ]
+        metas = [ meta for block in metas for meta in block ]
+        self.set_imagefiles( metas )
+        self.set_motors( metas )
+
+
+    @property
+    def cachefile(self):
+        """ Where import_all saves the metadata from the master file """
+        return os.path.join( self.analysispath, self.dsname + '_metadata.h5' )
+
+
+    def cachekey(self):
+        """ Things which must match to use the cachefile """
+        st = os.stat( self.masterfile )
+        return { 'master_mtime' : st.st_mtime, 'master_size' : st.st_size,
+                 'detector' : self.detector, 'omegamotor' : self.omegamotor,
+                 'dtymotor' : self.dtymotor }
+
+
+    def load_cache(self):
+        """ Reads the cachefile if it is there and up to date """
+        if not ( os.path.exists( self.cachefile ) and os.path.exists( self.masterfile ) ):
+            return False
+        key = self.cachekey()
+        try:
+            with h5py.File( self.cachefile, 'r' ) as hin:
+                for name in key:
+                    if hin.attrs.get( 'cache_' + name ) != key[name]:
+                        logging.info( 'cache is out of date %s'%(name) )
+                        return False
+                cached = {}
+                for name in self.CACHENAMES:
+                    if name in hin.attrs:
+                        cached[name] = hin.attrs[name]
+                    elif name in self.STRINGLISTS:
+                        cached[name] = [ v.decode() if isinstance( v, bytes ) else v
+                                         for v in hin[name][()] ]
+                    else:
+                        cached[name] = hin[name][()]
+        except (OSError, KeyError):
+            logging.info( 'could not read cache %s'%(self.cachefile) )
+            return False
+        for name in self.CACHENAMES:
+            setattr( self, name, cached[name] )
+        self.shape = tuple( self.shape )
+        self.sparsefiles = [ name.replace( '/', '_' ).replace( '.h5', '_sparse.h5' ) for name in 
+                             self.imagefiles ]
+        self.guessbins()
+        logging.info( 'imported metadata from %s'%(self.cachefile) )
+        return True
+
+
+    def save_cache(self):
+        """ Writes the metadata for load_cache (best effort) """
+        tmpname = self.cachefile + '.%d.tmp'%( os.getpid() )
+        try:
+            if not os.path.exists( self.analysispath ):
+                os.makedirs( self.analysispath )
+            if os.path.exists( tmpname ):
+                os.remove( tmpname )
+            self.save( tmpname )
+            with h5py.File( tmpname, 'a' ) as hout:
+                for name, value in self.cachekey().items():
+                    hout.attrs[ 'cache_' + name ] = value
+            if hasattr( os, "replace" ):
+                os.replace( tmpname, self.cachefile )
+            else: # python 2
+                if os.path.exists( self.cachefile ) and sys.platform == "win32":
+                    os.remove( self.cachefile )
+                os.rename( tmpname, self.cachefile )
+        except OSError:
+            logging.info( 'could not write cache %s'%(self.cachefile) )
+            return False
+        return True
+
+
     def import_motors_from_master(self):  #  could also get these from sparse files if saved
         """ read the motors from the lima file
         you need to import the imagefiles first
         these will be the motor positions to accompany the images
         """
+        self.set_motors( read_scan_metadata( ( self.masterfile, self.scans, None,
+                                               self.omegamotor, self.dtymotor ) ) )
+
+
+    def set_motors(self, metas):
+        """ Fills in omega and dty from the read_scan_metadata results """
         self.omega = np.zeros( self.shape, float )  # list of counters for monitor?
         self.dty   = np.zeros( self.shape, float )
-        with h5py.File( self.masterfile, 'r' ) as hin:
-            for i, scan in enumerate( self.scans ):
-                # Should always be there, if not, filter scans before you get to here
-                self.omega[i] =  hin[scan][ 'measurement' ][ self.omegamotor ][()]
-                self.dty[i]   =  hin[scan][ 'instrument/positioners' ][ self.dtymotor ][()]
+        for i, meta in enumerate( metas ):
+            self.omega[i] = meta['omega']
+            self.dty[i]   = meta['dty']
         logging.info( 'imported omega/dty' )
         self.guessbins()
 
@@ -234,6 +468,62 @@ class DataSet:
         return histo
 
     
+    def sparse_sinogram(self, weights='intensity', image_labels=None,
+                        pixel_labels=None, nlabels=None, nproc=None,
+                        chunksize=1<<22):
+        """
+        Bins the pixels in the sparse files onto the sinogram grid of
+        guessbins, reading chunksize pixels at a time, with the files
+        spread over nproc processes.
+        weights = 'intensity' to sum intensities or None to count pixels
+        image_labels = label image, eg tth rings from ring_labels
+        pixel_labels = name of a label for each pixel in the sparse files
+        nlabels = number of labels (default image_labels.max()+1)
+        Labels < 0 are skipped. Returns histo[nlabels, nomega, ny], or
+        histo[nomega, ny] without labels (like sinohist)
+        """
+        bins = len(self.obincens), len(self.ybincens)
+        rng  = ( (self.obinedges[0], self.obinedges[-1]),
+                 (self.ybinedges[0], self.ybinedges[-1]) )
+        if image_labels is not None:
+            image_labels = np.asarray( image_labels )
+            if nlabels is None:
+                nlabels = int( image_labels.max() ) + 1
+        elif pixel_labels is not None:
+            if nlabels is None:
+                raise Exception( 'Need nlabels for pixel_labels' )
+        else:
+            nlabels = 1
+        omega = self.omega.ravel()
+        dty = self.dty.ravel()
+        starts = np.concatenate( ( (0,), np.cumsum( self.frames_per_file ) ) )
+        shared = ( self.limapath, bins, rng, weights, image_labels, pixel_labels,
+                   nlabels, chunksize )
+        args = [ ( os.path.join( self.analysispath, spname ),
+                   omega[ starts[i] : starts[i+1] ], dty[ starts[i] : starts[i+1] ] )
+                 for i, spname in enumerate( self.sparsefiles ) ]
+        histo = np.zeros( ( nlabels, bins[0], bins[1] ), float )
+        import multiprocessing
+        if nproc is None:
+            nproc = multiprocessing.cpu_count()
+        if nproc > 1 and len(args) > 1:
+            mypool = multiprocessing.Pool( nproc, initializer=sparse_sinogram_init,
+                                           initargs=( shared, ) )
+            try:
+                for h in mypool.imap( sparse_sinogram_job, args ):
+                    histo += h
+            finally:
+                mypool.close()
+                mypool.join()
+        else:
+            sparse_sinogram_init( shared )
+            for a in args:
+                histo += sparse_sinogram_job( a )
+        if image_labels is None and pixel_labels is None:
+            return histo[0]
+        return histo
+
+
     def import_nnz(self):
         """ Read the nnz arrays from the scans """
         nnz = []
@@ -320,7 +610,8 @@ class DataSet:
                     setattr( self, name, data )      
             for name in self.STRINGLISTS:
                 if name in grp:
-                    data = list( grp[name][()] )
+                    data = [ v.decode() if isinstance( v, bytes ) else v
+                             for v in grp[name][()] ]
                     setattr( self, name, data )
         self.guessbins()
         return self
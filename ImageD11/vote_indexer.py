@@ -0,0 +1,241 @@
+"""
+Orientation space voting for indexing.
+
+Each ring assigned g-vector is compatible with a one dimensional set
+of orientations (a rotation about g of the orientation bringing B.h
+parallel to g). These are sampled, reduced to the fundamental zone of
+the crystal symmetry and histogrammed in quaternion space. Grains show
+up as bins which collect votes from many peaks. The cost is linear in
+the number of peaks, which is what you want for samples with very
+many grains.
+
+Quaternions are stored as [..., 4] arrays with the scalar part first.
+"""
+
+from __future__ import print_function, division
+
+import numpy as np
+from ImageD11 import cImageD11
+
+
+def qmul( a, b ):
+    """ Quaternion products of a[...,4] and b[...,4] """
+    aw, ax, ay, az = [ a[...,i] for i in range(4) ]
+    bw, bx, by, bz = [ b[...,i] for i in range(4) ]
+    return np.stack( ( aw*bw - ax*bx - ay*by - az*bz,
+                       aw*bx + ax*bw + ay*bz - az*by,
+                       aw*by - ax*bz + ay*bw + az*bx,
+                       aw*bz + ax*by - ay*bx + az*bw ), axis=-1 )
+
+def quat_to_matrix( q ):
+    """ Rotation matrices [...,3,3] from unit quaternions q[...,4] """
+    w, x, y, z = [ q[...,i] for i in range(4) ]
+    return np.stack( (
+        np.stack( ( 1-2*(y*y+z*z), 2*(x*y-w*z), 2*(x*z+w*y) ), axis=-1 ),
+        np.stack( ( 2*(x*y+w*z), 1-2*(x*x+z*z), 2*(y*z-w*x) ), axis=-1 ),
+        np.stack( ( 2*(x*z-w*y), 2*(y*z+w*x), 1-2*(x*x+y*y) ), axis=-1 ) ),
+                     axis=-2 )
+
+def matrix_to_quat( m ):
+    """ Unit quaternion for a single rotation matrix m[3,3] """
+    m = np.asarray( m, float )
+    t = np.trace( m )
+    if t > 0:
+        s = 2 * np.sqrt( 1 + t )
+        q = [ s/4, (m[2,1]-m[1,2])/s, (m[0,2]-m[2,0])/s, (m[1,0]-m[0,1])/s ]
+    elif m[0,0] >= m[1,1] and m[0,0] >= m[2,2]:
+        s = 2 * np.sqrt( 1 + m[0,0] - m[1,1] - m[2,2] )
+        q = [ (m[2,1]-m[1,2])/s, s/4, (m[0,1]+m[1,0])/s, (m[0,2]+m[2,0])/s ]
+    elif m[1,1] >= m[2,2]:
+        s = 2 * np.sqrt( 1 + m[1,1] - m[0,0] - m[2,2] )
+        q = [ (m[0,2]-m[2,0])/s, (m[0,1]+m[1,0])/s, s/4, (m[1,2]+m[2,1])/s ]
+    else:
+        s = 2 * np.sqrt( 1 + m[2,2] - m[0,0] - m[1,1] )
+        q = [ (m[1,0]-m[0,1])/s, (m[0,2]+m[2,0])/s, (m[1,2]+m[2,1])/s, s/4 ]
+    q = np.array( q, float )
+    return q / np.sqrt( ( q*q ).sum() )
+
+def symmetry_quaternions( grp, B ):
+    """
+    Quaternions for the operators of a sym_u.group, converted to the
+    cartesian crystal frame of B (the unitcell B matrix)
+    """
+    BI = np.linalg.inv( B )
+    qs = []
+    for o in grp.group:
+        # the operators act on hkl indices
+        r = np.dot( B, np.dot( o, BI ) )
+        if not np.allclose( np.dot( r, r.T ), np.eye(3), atol=1e-5 ):
+            raise Exception("Symmetry operator is not a rotation for this cell")
+        qs.append( matrix_to_quat( r ) )
+    return np.array( qs )
+
+def fundamental_zone( q, symq ):
+    """
+    Reduce quaternions q[n,4] to the symmetry equivalent with the
+    smallest rotation angle and a positive scalar part
+    """
+    # scalar part of q * s for all s at once
+    conj = symq * np.array( [ 1, -1, -1, -1 ] )
+    w = np.dot( q, conj.T )
+    best = np.argmax( abs( w ), axis=1 )
+    qr = qmul( q, symq[ best ] )
+    return np.where( qr[:,:1] < 0, -qr, qr )
+
+def fibre( b, g, psi ):
+    """
+    Orientations taking the crystal direction b[3] onto the
+    laboratory directions g[n,3] with rotation psi[m] about g
+    Returns quaternions [n,m,4]
+    """
+    b = b / np.sqrt( ( b*b ).sum() )
+    g = g / np.sqrt( ( g*g ).sum( axis=1 ) )[:,np.newaxis]
+    # shortest rotation from b to each g
+    c = np.dot( g, b )
+    axis = np.cross( np.broadcast_to( b, g.shape ), g )
+    q0 = np.concatenate( ( ( 1 + c )[:,np.newaxis], axis ), axis=1 )
+    flip = c < -1 + 1e-9
+    if flip.any():
+        # antiparallel : any perpendicular axis will do
+        p = np.cross( b, [ 1., 0, 0 ] )
+        if np.dot( p, p ) < 1e-6:
+            p = np.cross( b, [ 0, 1., 0 ] )
+        q0[flip] = [ 0, p[0], p[1], p[2] ]
+    q0 /= np.sqrt( ( q0*q0 ).sum( axis=1 ) )[:,np.newaxis]
+    h = 0.5 * np.asarray( psi )
+    qpsi = np.concatenate( ( np.cos( h )[np.newaxis,:,np.newaxis] *
+                             np.ones( ( len(g), 1, 1 ) ),
+                             np.sin( h )[np.newaxis,:,np.newaxis] *
+                             g[:,np.newaxis,:] ), axis=2 )
+    return qmul( qpsi, q0[:,np.newaxis,:] )
+
+def ring_directions( hkls, B, symq ):
+    """
+    One crystal direction B.h for each group of hkls in a ring which
+    are symmetry equivalent. Returns an array [n,3]
+    """
+    dirs = []
+    mats = quat_to_matrix( symq )
+    for h in hkls:
+        v = np.dot( B, h )
+        if not any( np.allclose( np.dot( m, v ), d, atol=1e-6 )
+                    for d in dirs for m in mats ):
+            dirs.append( v )
+    return np.array( dirs )
+
+
+class orientation_votes(object):
+    """
+    Sparse histogram of votes in the quaternion cube [-1,1]^3
+    Bin size is binsize in quaternion units (about angle/2 radians)
+    """
+
+    def __init__( self, binsize ):
+        self.binsize = binsize
+        self.nb = int( np.ceil( 2. / binsize ) ) + 1
+        self.keys = np.zeros( 0, np.int64 )
+        self.counts = np.zeros( 0, np.int64 )
+
+    def key( self, q ):
+        """ bin numbers for fundamental zone quaternions q[...,4] """
+        i = np.floor( ( q[...,1:] + 1 ) / self.binsize ).astype( np.int64 )
+        return ( i[...,0] * self.nb + i[...,1] ) * self.nb + i[...,2]
+
+    def centre( self, key ):
+        """ Quaternion at the centre of the bin key """
+        k = np.asarray( key, np.int64 )
+        i = np.stack( ( k // (self.nb*self.nb), ( k // self.nb ) % self.nb,
+                        k % self.nb ), axis=-1 )
+        v = ( i + 0.5 ) * self.binsize - 1
+        w = np.sqrt( np.clip( 1 - ( v*v ).sum( axis=-1 ), 0, 1 ) )
+        q = np.concatenate( ( w[...,np.newaxis], v ), axis=-1 )
+        return q / np.sqrt( ( q*q ).sum( axis=-1 ) )[...,np.newaxis]
+
+    def add( self, keys ):
+        """
+        keys[npeaks, nsamples] are the bins along each peak fibre.
+        Each peak votes once per bin it passes through.
+        """
+        keep = np.ones( keys.shape, bool )
+        keep[:,1:] = keys[:,1:] != keys[:,:-1]
+        uk, cnt = np.unique( keys[keep], return_counts=True )
+        allk = np.concatenate( ( self.keys, uk ) )
+        allc = np.concatenate( ( self.counts, cnt ) )
+        self.keys, inv = np.unique( allk, return_inverse=True )
+        self.counts = np.bincount( inv, weights=allc ).astype( np.int64 )
+
+    def neighbours( self, key ):
+        """ The 27 bins around and including key """
+        d = np.arange( -1, 2 )
+        off = ( d[:,None,None] * self.nb + d[None,:,None] ) * self.nb + \
+            d[None,None,:]
+        return key + off.ravel()
+
+    def best( self, minvotes ):
+        """
+        Bins with at least minvotes which are local maxima compared to
+        their neighbours, with the most votes first
+        """
+        sel = self.counts >= minvotes
+        keys = self.keys[sel]
+        counts = self.counts[sel]
+        peak = np.ones( len(keys), bool )
+        for off in self.neighbours( 0 ):
+            if off == 0:
+                continue
+            # self.keys is sorted by np.unique
+            j = np.searchsorted( self.keys, keys + off )
+            j = np.minimum( j, len(self.keys) - 1 )
+            there = self.keys[j] == keys + off
+            peak &= ~( there & ( self.counts[j] > counts ) )
+        keys = keys[peak]
+        counts = counts[peak]
+        order = np.argsort( -counts, kind='stable' )
+        return keys[order], counts[order]
+
+
+def vote( gv, ra, ringhkls, B, symq, ang_step=1.0, chunk=256 ):
+    """
+    gv = g-vectors [n,3]
+    ra = ring assignments for gv (list of ring numbers)
+    ringhkls = hkls for each ring number
+    B = unitcell B matrix
+    symq = quaternions of the symmetry operators (symmetry_quaternions)
+    ang_step = sampling step in degrees
+    Returns an orientation_votes
+    """
+    step = np.radians( ang_step )
+    psi = np.arange( 0, 2*np.pi, step )
+    votes = orientation_votes( step / 2 )
+    for r in sorted( set( ra ) ):
+        if r < 0:
+            continue
+        gr = gv[ ra == r ]
+        for b in ring_directions( ringhkls[r], B, symq ):
+            for i in range( 0, len(gr), chunk ):
+                q = fibre( b, gr[i:i+chunk], psi )
+                n, m = q.shape[:2]
+                qz = fundamental_zone( q.reshape( n*m, 4 ), symq )
+                votes.add( votes.key( qz ).reshape( n, m ) )
+    return votes
+
+
+def refine_candidate( q, B, gv, tol, ncycles=3 ):
+    """
+    UBI for orientation q refined against gv with score_and_refine
+    The bin centre can be a fraction of a degree away from the grain,
+    so the tolerance starts wide and is then reduced to tol
+    """
+    UBI = np.ascontiguousarray( np.linalg.inv(
+        np.dot( quat_to_matrix( q ), B ) ) )
+    npk = 0
+    for t in [ 4*tol, 2*tol ] + [ tol, ] * ncycles:
+        npk, drlv2 = cImageD11.score_and_refine( UBI, gv, t )
+    return UBI, npk
+
+
+def ubi_to_quat( UBI, B ):
+    """ Quaternion of the rotation nearest to U = inv(UBI.B) """
+    U = np.dot( np.linalg.inv( UBI ), np.linalg.inv( B ) )
+    u, s, vt = np.linalg.svd( U )
+    return matrix_to_quat( np.dot( u, vt ) )
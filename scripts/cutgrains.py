@@ -7,19 +7,17 @@ Removes grains from a grain file if they have less than
 npks peaks
 
 Usage : cutgrains.py   ubi_in  ubi_out  npks
+
+Either file can be text or hdf (.h5 .hdf .hdf5)
 """
 
-from ImageD11.grain import read_grain_file, write_grain_file
+from ImageD11.grain import read_grain_collection, write_grain_file
 import sys
 try:
-    GRAINS = read_grain_file(sys.argv[1])
+    GRAINS = read_grain_collection(sys.argv[1])
     NPKS = int(sys.argv[3])
-    KEEP = []
-    for g in GRAINS:
-        if int(g.npks) >= NPKS:
-            KEEP.append(g)
+    KEEP = GRAINS[ GRAINS.npks >= NPKS ]
     write_grain_file( sys.argv[2], KEEP)
 except:
     print(__doc__)
     raise
-            
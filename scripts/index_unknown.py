@@ -119,12 +119,13 @@ if __name__=="__main__":
                 # do fft
                 g = grid( npx = options.npx,
                           mr = options.mr,
-                          nsig = options.nsig)
+                          nsig = options.nsig,
+                          nthreads = options.nthreads)
                 g.gv_to_grid_new(cur_gvecs)
                 g.fft()
                 g.props()
-                g.peaksearch(open("eu.patterson_pks","w"))
-                g.read_peaks("eu.patterson_pks")
+                g.peaksearch()
+                g.read_peaks()
                 vecs = rc_array.rc_array(g.UBIALL.T , direction='col')
                 assert vecs.shape == (3, len(g.UBIALL))
                 order = np.argsort( g.colfile.sum_intensity )[::-1]
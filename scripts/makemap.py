@@ -43,7 +43,11 @@ def makemap(options):
     print("Refining posi too")
     # o.refineubis(quiet = False , scoreonly = True)
     print("Refining positions too")
-    o.refinepositions()
+    if options.cache is not None and os.path.exists(options.cache):
+        o.load_refine_cache(options.cache)
+    o.refinepositions(nproc = options.nproc, method = options.refine_method)
+    if options.cache is not None:
+        o.save_refine_cache(options.cache)
     print("Done refining positions too")    
     # o.refineubis(quiet = False , scoreonly = True)
     o.savegrains(options.newubifile, sort_npks = options.sort_npks)
@@ -68,6 +72,19 @@ def get_options(parser):
                       dest = "tthrange", type=float,
                       default = None,
                       help= "Two theta range for getting median intensity")
+    parser.add_argument( "--nproc", action="store",
+                      dest = "nproc", type=int,
+                      default = 1,
+                      help= "Number of processes for refining grain positions")
+    parser.add_argument( "--refine_method", action="store",
+                      dest = "refine_method", default = "simplex",
+                      choices = [ "simplex", "lsq" ],
+                      help= "Grain position fit: simplex or least squares "+
+                      "for ubi and translation together")
+    parser.add_argument( "--cache", action="store",
+                      dest = "cache", default = None,
+                      help= "File (.npz) of grain refinements to reuse when "+
+                      "the peaks of a grain have not changed")
     return parser
 
 
@@ -209,6 +209,37 @@ static int int_from_pyobj(int* v,PyObject *obj,const char *errmess) {
     return 0;
 }
 
+static int long_long_from_pyobj(long_long* v,PyObject *obj,const char *errmess) {
+    PyObject* tmp = NULL;
+    if (PyLong_Check(obj)) {
+        *v = PyLong_AsLongLong(obj);
+        return !(*v == -1 && PyErr_Occurred());
+    }
+    tmp = PyNumber_Long(obj);
+    if (tmp) {
+        *v = PyLong_AsLongLong(tmp);
+        Py_DECREF(tmp);
+        return !(*v == -1 && PyErr_Occurred());
+    }
+    if (PyComplex_Check(obj))
+        tmp = PyObject_GetAttrString(obj,"real");
+    else if (PyString_Check(obj) || PyUnicode_Check(obj))
+        /*pass*/;
+    else if (PySequence_Check(obj))
+        tmp = PySequence_GetItem(obj,0);
+    if (tmp) {
+        PyErr_Clear();
+        if (long_long_from_pyobj(v,tmp,errmess)) {Py_DECREF(tmp); return 1;}
+        Py_DECREF(tmp);
+    }
+    {
+        PyObject* err = PyErr_Occurred();
+        if (err==NULL) err = _cImageD11_error;
+        PyErr_SetString(err,errmess);
+    }
+    return 0;
+}
+
 static int float_from_pyobj(float* v,PyObject *obj,const char *errmess) {
     double d=0.0;
     if (double_from_pyobj(&d,obj,errmess)) {
@@ -235,6 +266,7 @@ extern void compute_xlylzl(double*,double*,double*,double*,double*,double*,int);
 extern void quickorient(double*,double*);
 extern void cimaged11_omp_set_num_threads(int);
 extern int cimaged11_omp_get_max_threads(void);
+extern int parse_float_columns(signed_char*,int,double*,int,long_long,long_long);
 extern void uint16_to_float_darksub(float*,float*,unsigned_short*,int);
 extern void uint16_to_float_darkflm(float*,float*,float*,unsigned_short*,int);
 extern void frelon_lines(float*,int,int,float);
@@ -258,6 +290,7 @@ extern int score_and_assign(double*,double*,double,double*,int*,int,int);
 extern void refine_assigned(double*,double*,int*,int,int*,double*,int);
 extern void put_incr64(float*,long_long*,float*,int,int,int);
 extern void put_incr32(float*,int*,float*,int,int,int);
+extern int put_trilinear(float*,int,double*,int,int);
 extern void cluster1d(double*,int,int*,double,int*,int*,double*);
 extern void score_gvec_z(double*,double*,double*,double*,double*,double*,double*,int,int);
 extern double misori_cubic(double*,double*);
@@ -421,7 +454,9 @@ f2py_start_clock();
 f2py_start_call_clock();
 #endif
 /*callfortranroutine*/
+      Py_BEGIN_ALLOW_THREADS
         (*f2py_func)(xlylzl,omega,omegasign,wvln,wedge,chi,t,gv,ng);
+      Py_END_ALLOW_THREADS
 if (PyErr_Occurred())
   f2py_success = 0;
 #ifdef F2PY_REPORT_ATEXIT
@@ -902,6 +937,133 @@ f2py_stop_clock();
 }
 /******************** end of cimaged11_omp_get_max_threads ********************/
 
+/**************************** parse_float_columns ****************************/
+static char doc_f2py_rout__cImageD11_parse_float_columns[] = "\
+parse_float_columns = parse_float_columns(buf,cols,row0)\n\nWrapper for ``parse_float_columns``.\
+\n\nParameters\n----------\n"
+"buf : input rank-1 array('b') with bounds (nb)\n"
+"cols : in/output rank-2 array('d') with bounds (ncols,nrows)\n"
+"row0 : input long\n"
+"\nReturns\n-------\n"
+"parse_float_columns : int";
+/* extern int parse_float_columns(signed_char*,int,double*,int,long_long,long_long); */
+static PyObject *f2py_rout__cImageD11_parse_float_columns(const PyObject *capi_self,
+                           PyObject *capi_args,
+                           PyObject *capi_keywds,
+                           int (*f2py_func)(signed_char*,int,double*,int,long_long,long_long)) {
+  PyObject * volatile capi_buildvalue = NULL;
+  volatile int f2py_success = 1;
+/*decl*/
+
+  int parse_float_columns_return_value=0;
+  signed_char *buf = NULL;
+  npy_intp buf_Dims[1] = {-1};
+  const int buf_Rank = 1;
+  PyArrayObject *capi_buf_tmp = NULL;
+  int capi_buf_intent = 0;
+  PyObject *buf_capi = Py_None;
+  int nb = 0;
+  double *cols = NULL;
+  npy_intp cols_Dims[2] = {-1, -1};
+  const int cols_Rank = 2;
+  PyArrayObject *capi_cols_tmp = NULL;
+  int capi_cols_intent = 0;
+  PyObject *cols_capi = Py_None;
+  int ncols = 0;
+  long_long nrows = 0;
+  long_long row0 = 0;
+  PyObject *row0_capi = Py_None;
+  static char *capi_kwlist[] = {"buf","cols","row0",NULL};
+
+/*routdebugenter*/
+#ifdef F2PY_REPORT_ATEXIT
+f2py_start_clock();
+#endif
+  if (!PyArg_ParseTupleAndKeywords(capi_args,capi_keywds,\
+    "OOO:_cImageD11.parse_float_columns",\
+    capi_kwlist,&buf_capi,&cols_capi,&row0_capi))
+    return NULL;
+/*frompyobj*/
+  /* Processing variable buf */
+  ;
+  capi_buf_intent |= F2PY_INTENT_IN|F2PY_INTENT_C;
+  capi_buf_tmp = array_from_pyobj(NPY_BYTE,buf_Dims,buf_Rank,capi_buf_intent,buf_capi);
+  if (capi_buf_tmp == NULL) {
+    if (!PyErr_Occurred())
+      PyErr_SetString(_cImageD11_error,"failed in converting 1st argument `buf' of _cImageD11.parse_float_columns to C/Fortran array" );
+  } else {
+    buf = (signed_char *)(PyArray_DATA(capi_buf_tmp));
+
+  /* Processing variable cols */
+  ;
+  capi_cols_intent |= F2PY_INTENT_INOUT|F2PY_INTENT_C;
+  capi_cols_tmp = array_from_pyobj(NPY_DOUBLE,cols_Dims,cols_Rank,capi_cols_intent,cols_capi);
+  if (capi_cols_tmp == NULL) {
+    if (!PyErr_Occurred())
+      PyErr_SetString(_cImageD11_error,"failed in converting 2nd argument `cols' of _cImageD11.parse_float_columns to C/Fortran array" );
+  } else {
+    cols = (double *)(PyArray_DATA(capi_cols_tmp));
+
+  /* Processing variable row0 */
+    f2py_success = long_long_from_pyobj(&row0,row0_capi,"_cImageD11.parse_float_columns() 3rd argument (row0) can't be converted to long_long");
+  if (f2py_success) {
+  /* Processing variable nb */
+  nb = shape(buf,0);
+  /* Processing variable ncols */
+  ncols = shape(cols,0);
+  /* Processing variable nrows */
+  nrows = shape(cols,1);
+/*end of frompyobj*/
+#ifdef F2PY_REPORT_ATEXIT
+f2py_start_call_clock();
+#endif
+/*callfortranroutine*/
+  Py_BEGIN_ALLOW_THREADS
+  parse_float_columns_return_value = (*f2py_func)(buf,nb,cols,ncols,nrows,row0);
+  Py_END_ALLOW_THREADS
+if (PyErr_Occurred())
+  f2py_success = 0;
+#ifdef F2PY_REPORT_ATEXIT
+f2py_stop_call_clock();
+#endif
+/*end of callfortranroutine*/
+    if (f2py_success) {
+/*pyobjfrom*/
+/*end of pyobjfrom*/
+    CFUNCSMESS("Building return value.\n");
+    capi_buildvalue = Py_BuildValue("i",parse_float_columns_return_value);
+/*closepyobjfrom*/
+/*end of closepyobjfrom*/
+    } /*if (f2py_success) after callfortranroutine*/
+/*cleanupfrompyobj*/
+  /* End of cleaning variable nrows */
+  /* End of cleaning variable ncols */
+  /* End of cleaning variable nb */
+  } /*if (f2py_success) of row0*/
+  /* End of cleaning variable row0 */
+  if((PyObject *)capi_cols_tmp!=cols_capi) {
+    Py_XDECREF(capi_cols_tmp); }
+  }  /*if (capi_cols_tmp == NULL) ... else of cols*/
+  /* End of cleaning variable cols */
+  if((PyObject *)capi_buf_tmp!=buf_capi) {
+    Py_XDECREF(capi_buf_tmp); }
+  }  /*if (capi_buf_tmp == NULL) ... else of buf*/
+  /* End of cleaning variable buf */
+/*end of cleanupfrompyobj*/
+  if (capi_buildvalue == NULL) {
+/*routdebugfailure*/
+  } else {
+/*routdebugleave*/
+  }
+  CFUNCSMESS("Freeing memory.\n");
+/*freemem*/
+#ifdef F2PY_REPORT_ATEXIT
+f2py_stop_clock();
+#endif
+  return capi_buildvalue;
+}
+/************************* end of parse_float_columns *************************/
+
 /************************** uint16_to_float_darksub **************************/
 static char doc_f2py_rout__cImageD11_uint16_to_float_darksub[] = "\
 uint16_to_float_darksub(img,drk,data)\n\nWrapper for ``uint16_to_float_darksub``.\
@@ -3382,7 +3544,9 @@ f2py_start_clock();
 f2py_start_call_clock();
 #endif
 /*callfortranroutine*/
+  Py_BEGIN_ALLOW_THREADS
   score_and_assign_return_value = (*f2py_func)(ubi,gv,tol,drlv2,labels,label,ng);
+  Py_END_ALLOW_THREADS
 if (PyErr_Occurred())
   f2py_success = 0;
 #ifdef F2PY_REPORT_ATEXIT
@@ -3873,6 +4037,133 @@ f2py_stop_clock();
 }
 /***************************** end of put_incr32 *****************************/
 
+/******************************** put_trilinear ********************************/
+static char doc_f2py_rout__cImageD11_put_trilinear[] = "\
+put_trilinear = put_trilinear(data,npx,hkl)\n\nWrapper for ``put_trilinear``.\
+\n\nParameters\n----------\n"
+"data : in/output rank-1 array('f') with bounds (m)\n"
+"npx : input int\n"
+"hkl : input rank-2 array('d') with bounds (n,3)\n"
+"\nReturns\n-------\n"
+"put_trilinear : int";
+/* extern int put_trilinear(float*,int,double*,int,int); */
+static PyObject *f2py_rout__cImageD11_put_trilinear(const PyObject *capi_self,
+                           PyObject *capi_args,
+                           PyObject *capi_keywds,
+                           int (*f2py_func)(float*,int,double*,int,int)) {
+  PyObject * volatile capi_buildvalue = NULL;
+  volatile int f2py_success = 1;
+/*decl*/
+
+  int put_trilinear_return_value=0;
+  float *data = NULL;
+  npy_intp data_Dims[1] = {-1};
+  const int data_Rank = 1;
+  PyArrayObject *capi_data_tmp = NULL;
+  int capi_data_intent = 0;
+  PyObject *data_capi = Py_None;
+  int npx = 0;
+  PyObject *npx_capi = Py_None;
+  double *hkl = NULL;
+  npy_intp hkl_Dims[2] = {-1, -1};
+  const int hkl_Rank = 2;
+  PyArrayObject *capi_hkl_tmp = NULL;
+  int capi_hkl_intent = 0;
+  PyObject *hkl_capi = Py_None;
+  int n = 0;
+  int m = 0;
+  static char *capi_kwlist[] = {"data","npx","hkl",NULL};
+
+/*routdebugenter*/
+#ifdef F2PY_REPORT_ATEXIT
+f2py_start_clock();
+#endif
+  if (!PyArg_ParseTupleAndKeywords(capi_args,capi_keywds,\
+    "OOO:_cImageD11.put_trilinear",\
+    capi_kwlist,&data_capi,&npx_capi,&hkl_capi))
+    return NULL;
+/*frompyobj*/
+  /* Processing variable data */
+  ;
+  capi_data_intent |= F2PY_INTENT_INOUT|F2PY_INTENT_C;
+  capi_data_tmp = array_from_pyobj(NPY_FLOAT,data_Dims,data_Rank,capi_data_intent,data_capi);
+  if (capi_data_tmp == NULL) {
+    if (!PyErr_Occurred())
+      PyErr_SetString(_cImageD11_error,"failed in converting 1st argument `data' of _cImageD11.put_trilinear to C/Fortran array" );
+  } else {
+    data = (float *)(PyArray_DATA(capi_data_tmp));
+
+  /* Processing variable npx */
+    f2py_success = int_from_pyobj(&npx,npx_capi,"_cImageD11.put_trilinear() 2nd argument (npx) can't be converted to int");
+  if (f2py_success) {
+  /* Processing variable hkl */
+  hkl_Dims[1]=3;
+  capi_hkl_intent |= F2PY_INTENT_IN|F2PY_INTENT_C;
+  capi_hkl_tmp = array_from_pyobj(NPY_DOUBLE,hkl_Dims,hkl_Rank,capi_hkl_intent,hkl_capi);
+  if (capi_hkl_tmp == NULL) {
+    if (!PyErr_Occurred())
+      PyErr_SetString(_cImageD11_error,"failed in converting 3rd argument `hkl' of _cImageD11.put_trilinear to C/Fortran array" );
+  } else {
+    hkl = (double *)(PyArray_DATA(capi_hkl_tmp));
+
+  /* Processing variable m */
+  m = len(data);
+  CHECKSCALAR(len(data)>=m,"len(data)>=m","hidden m","put_trilinear:m=%d",m) {
+  /* Processing variable n */
+  n = shape(hkl,0);
+  CHECKSCALAR(shape(hkl,0)==n,"shape(hkl,0)==n","hidden n","put_trilinear:n=%d",n) {
+/*end of frompyobj*/
+#ifdef F2PY_REPORT_ATEXIT
+f2py_start_call_clock();
+#endif
+/*callfortranroutine*/
+  Py_BEGIN_ALLOW_THREADS
+  put_trilinear_return_value = (*f2py_func)(data,npx,hkl,n,m);
+  Py_END_ALLOW_THREADS
+if (PyErr_Occurred())
+  f2py_success = 0;
+#ifdef F2PY_REPORT_ATEXIT
+f2py_stop_call_clock();
+#endif
+/*end of callfortranroutine*/
+    if (f2py_success) {
+/*pyobjfrom*/
+/*end of pyobjfrom*/
+    CFUNCSMESS("Building return value.\n");
+    capi_buildvalue = Py_BuildValue("i",put_trilinear_return_value);
+/*closepyobjfrom*/
+/*end of closepyobjfrom*/
+    } /*if (f2py_success) after callfortranroutine*/
+/*cleanupfrompyobj*/
+  } /*CHECKSCALAR(shape(hkl,0)==n)*/
+  /* End of cleaning variable n */
+  } /*CHECKSCALAR(len(data)>=m)*/
+  /* End of cleaning variable m */
+  if((PyObject *)capi_hkl_tmp!=hkl_capi) {
+    Py_XDECREF(capi_hkl_tmp); }
+  }  /*if (capi_hkl_tmp == NULL) ... else of hkl*/
+  /* End of cleaning variable hkl */
+  } /*if (f2py_success) of npx*/
+  /* End of cleaning variable npx */
+  if((PyObject *)capi_data_tmp!=data_capi) {
+    Py_XDECREF(capi_data_tmp); }
+  }  /*if (capi_data_tmp == NULL) ... else of data*/
+  /* End of cleaning variable data */
+/*end of cleanupfrompyobj*/
+  if (capi_buildvalue == NULL) {
+/*routdebugfailure*/
+  } else {
+/*routdebugleave*/
+  }
+  CFUNCSMESS("Freeing memory.\n");
+/*freemem*/
+#ifdef F2PY_REPORT_ATEXIT
+f2py_stop_clock();
+#endif
+  return capi_buildvalue;
+}
+/**************************** end of put_trilinear ****************************/
+
 /********************************* cluster1d *********************************/
 static char doc_f2py_rout__cImageD11_cluster1d[] = "\
 nclusters = cluster1d(ar,order,tol,ids,avgs)\n\nWrapper for ``cluster1d``.\
@@ -8198,6 +8489,7 @@ static FortranDataDef f2py_routine_defs[] = {
   {"quickorient",-1,{{-1}},0,(char *)quickorient,(f2py_init_func)f2py_rout__cImageD11_quickorient,doc_f2py_rout__cImageD11_quickorient},
   {"cimaged11_omp_set_num_threads",-1,{{-1}},0,(char *)cimaged11_omp_set_num_threads,(f2py_init_func)f2py_rout__cImageD11_cimaged11_omp_set_num_threads,doc_f2py_rout__cImageD11_cimaged11_omp_set_num_threads},
   {"cimaged11_omp_get_max_threads",-1,{{-1}},0,(char *)cimaged11_omp_get_max_threads,(f2py_init_func)f2py_rout__cImageD11_cimaged11_omp_get_max_threads,doc_f2py_rout__cImageD11_cimaged11_omp_get_max_threads},
+  {"parse_float_columns",-1,{{-1}},0,(char *)parse_float_columns,(f2py_init_func)f2py_rout__cImageD11_parse_float_columns,doc_f2py_rout__cImageD11_parse_float_columns},
   {"uint16_to_float_darksub",-1,{{-1}},0,(char *)uint16_to_float_darksub,(f2py_init_func)f2py_rout__cImageD11_uint16_to_float_darksub,doc_f2py_rout__cImageD11_uint16_to_float_darksub},
   {"uint16_to_float_darkflm",-1,{{-1}},0,(char *)uint16_to_float_darkflm,(f2py_init_func)f2py_rout__cImageD11_uint16_to_float_darkflm,doc_f2py_rout__cImageD11_uint16_to_float_darkflm},
   {"frelon_lines",-1,{{-1}},0,(char *)frelon_lines,(f2py_init_func)f2py_rout__cImageD11_frelon_lines,doc_f2py_rout__cImageD11_frelon_lines},
@@ -8221,6 +8513,7 @@ static FortranDataDef f2py_routine_defs[] = {
   {"refine_assigned",-1,{{-1}},0,(char *)refine_assigned,(f2py_init_func)f2py_rout__cImageD11_refine_assigned,doc_f2py_rout__cImageD11_refine_assigned},
   {"put_incr64",-1,{{-1}},0,(char *)put_incr64,(f2py_init_func)f2py_rout__cImageD11_put_incr64,doc_f2py_rout__cImageD11_put_incr64},
   {"put_incr32",-1,{{-1}},0,(char *)put_incr32,(f2py_init_func)f2py_rout__cImageD11_put_incr32,doc_f2py_rout__cImageD11_put_incr32},
+  {"put_trilinear",-1,{{-1}},0,(char *)put_trilinear,(f2py_init_func)f2py_rout__cImageD11_put_trilinear,doc_f2py_rout__cImageD11_put_trilinear},
   {"cluster1d",-1,{{-1}},0,(char *)cluster1d,(f2py_init_func)f2py_rout__cImageD11_cluster1d,doc_f2py_rout__cImageD11_cluster1d},
   {"score_gvec_z",-1,{{-1}},0,(char *)score_gvec_z,(f2py_init_func)f2py_rout__cImageD11_score_gvec_z,doc_f2py_rout__cImageD11_score_gvec_z},
   {"misori_cubic",-1,{{-1}},0,(char *)misori_cubic,(f2py_init_func)f2py_rout__cImageD11_misori_cubic,doc_f2py_rout__cImageD11_misori_cubic},
@@ -8305,6 +8598,7 @@ PyMODINIT_FUNC init_cImageD11(void) {
 "  quickorient(ubi,bt)\n"
 "  cimaged11_omp_set_num_threads(n)\n"
 "  cimaged11_omp_get_max_threads = cimaged11_omp_get_max_threads()\n"
+"  parse_float_columns = parse_float_columns(buf,cols,row0)\n"
 "  uint16_to_float_darksub(img,drk,data)\n"
 "  uint16_to_float_darkflm(img,drk,flm,data)\n"
 "  frelon_lines(img,cut)\n"
@@ -8328,6 +8622,7 @@ PyMODINIT_FUNC init_cImageD11(void) {
 "  npk,drlv2 = refine_assigned(ubi,gv,labels,label)\n"
 "  put_incr64(data,ind,vals,boundscheck=0)\n"
 "  put_incr32(data,ind,vals,boundscheck=0)\n"
+"  put_trilinear = put_trilinear(data,npx,hkl)\n"
 "  nclusters = cluster1d(ar,order,tol,ids,avgs)\n"
 "  score_gvec_z(ubi,ub,gv,g0,g1,g2,e,recompute)\n"
 "  misori_cubic = misori_cubic(u1,u2)\n"
@@ -23,7 +23,8 @@
         double precision, intent(in):: omegasign, wvln, wedge, chi
         double precision, intent(in):: t(3)
         double precision, intent(inout):: gv(ng,3)
-        ! NOT threadsafe since gv may be shared
+        ! threadsafe if each thread has its own gv
+        threadsafe
     end subroutine compute_gv
 F2PY_WRAPPER_END */
 void compute_gv(double xlylzl[][3], double omega[], double omegasign,
@@ -2,6 +2,7 @@
 /* Various utility things that do not belong elsewhere */
 
 #include "cImageD11.h"
+#include <stdlib.h>
 
 #ifdef _OPENMP
 
@@ -44,6 +45,92 @@ F2PY_WRAPPER_END */
     end function cImaged11_omp_get_max_threads
 F2PY_WRAPPER_END */
 
+/* F2PY_WRAPPER_START
+    function parse_float_columns( buf, nb, cols, ncols, nrows, row0 )
+!DOC parse_float_columns reads lines of whitespace separated numbers
+!DOC from the text in buf (int8, must end with a newline) into the
+!DOC columns cols[ncols, nrows] starting at row row0.
+!DOC Returns the number of rows read. This stops early at the end of
+!DOC cols or at the first line which does not hold ncols numbers.
+!DOC threadsafe if each thread fills different rows
+        intent(c) parse_float_columns
+        intent(c)
+        integer :: parse_float_columns
+        integer*1, intent(in), dimension(nb) :: buf
+        integer, intent(hide), depend(buf) :: nb=shape(buf,0)
+        double precision, intent(inout), dimension(ncols, nrows) :: cols
+        integer, intent(hide), depend(cols) :: ncols=shape(cols,0)
+        integer*8, intent(hide), depend(cols) :: nrows=shape(cols,1)
+        integer*8, intent(in) :: row0
+        threadsafe
+    end function parse_float_columns
+F2PY_WRAPPER_END */
+static const double exact_powers_of_ten[] = {
+    1e0,  1e1,  1e2,  1e3,  1e4,  1e5,  1e6,  1e7,  1e8,  1e9,  1e10, 1e11,
+    1e12, 1e13, 1e14, 1e15, 1e16, 1e17, 1e18, 1e19, 1e20, 1e21, 1e22};
+
+/* Reads a number starting at p. Plain decimals with up to 15 digits
+ * and no exponent are exact as (double) digits / 10^n (both are exactly
+ * representable), anything else goes to strtod */
+static inline double read_double(char *p, char **e) {
+    char *q = p;
+    int64_t m = 0;
+    int nd = 0, nf = 0, neg = 0;
+    if (*q == '-' || *q == '+') {
+        neg = (*q == '-');
+        q++;
+    }
+    while (*q >= '0' && *q <= '9') {
+        if (nd < 16) /* more than 15 goes to strtod, no overflow */
+            m = m * 10 + (*q - '0');
+        q++;
+        nd++;
+    }
+    if (*q == '.') {
+        q++;
+        while (*q >= '0' && *q <= '9') {
+            if (nd < 16)
+                m = m * 10 + (*q - '0');
+            q++;
+            nd++;
+            nf++;
+        }
+    }
+    /* exponents, nan, inf, etc */
+    if (nd == 0 || nd > 15 || ((*q | 0x20) >= 'a' && (*q | 0x20) <= 'z'))
+        return strtod(p, e);
+    *e = q;
+    return neg ? -(m / exact_powers_of_ten[nf]) : m / exact_powers_of_ten[nf];
+}
+
+int parse_float_columns(char buf[], int nb, double cols[], int ncols,
+                        int64_t nrows, int64_t row0) {
+    char *p, *end, *e;
+    int64_t row;
+    int j;
+    p = buf;
+    end = buf + nb;
+    for (row = row0; row < nrows && p < end; row++) {
+        for (j = 0;; j++) {
+            /* skip blanks but not the newline (strtod would) */
+            while (p < end && (*p == ' ' || *p == '\t' || *p == '\r'))
+                p++;
+            if (p >= end || *p == '\n')
+                break;
+            if (j == ncols)
+                return (int)(row - row0); /* too many values */
+            cols[j * nrows + row] = read_double(p, &e);
+            if (e == p)
+                return (int)(row - row0); /* not a number */
+            p = e;
+        }
+        if (j != ncols)
+            return (int)(row - row0); /* short or blank line */
+        p++; /* the newline */
+    }
+    return (int)(row - row0);
+}
+
 #if defined(_MSC_VER) || defined(__MINGW32__)
 
 #include <windows.h>
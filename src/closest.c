@@ -359,7 +359,8 @@ void score_and_refine(vec ubi[3], vec gv[], double tol, int *n_arg,
         double precision, intent(inout) :: drlv2(ng)
         integer*4, intent(inout) :: labels(ng)
         integer, intent(in) :: label
-        ! NOT threadsafe - labels will be shared
+        ! threadsafe if each thread has its own drlv2 and labels
+        threadsafe
     end function score_and_assign
 F2PY_WRAPPER_END */
 int score_and_assign(vec *restrict ubi, vec *restrict gv, double tol,
@@ -536,6 +537,59 @@ void put_incr32(float data[], int32_t ind[], float vals[], int boundscheck,
     }
 }
 
+/* F2PY_WRAPPER_START
+
+    function put_trilinear( data, npx, hkl, n, m )
+!DOC put_trilinear spreads each point hkl[i] over the 8 surrounding
+!DOC grid points of data[npx,npx,npx] with trilinear weights.
+!DOC Indices wrap periodically. Threaded using atomic updates.
+!DOC Returns 0, or -1 if data does not have npx**3 elements
+        intent(c) put_trilinear
+        intent(c)
+        integer put_trilinear
+        real, intent(inout) :: data(m)
+        integer, intent(in) :: npx
+        double precision, intent(in) :: hkl(n,3)
+        integer, intent(hide), depend( data ) :: m
+        integer, intent(hide), depend( hkl ) :: n
+        ! threadsafe: updates of data are atomic
+        threadsafe
+    end function put_trilinear
+
+F2PY_WRAPPER_END */
+int put_trilinear(float data[], int npx, double hkl[], int n, int m) {
+    int64_t k, p;
+    if ((npx < 1) || ((int64_t)npx * npx * npx != (int64_t)m)) {
+        return -1; /* data has m elements, not npx**3 */
+    }
+    p = npx;
+#pragma omp parallel for schedule(static, 4096)
+    for (k = 0; k < n; k++) {
+        int64_t ix[3][2], adr;
+        double f[3][2], fl;
+        float w;
+        int j, a, b, c;
+        for (j = 0; j < 3; j++) {
+            fl = floor(hkl[k * 3 + j]);
+            f[j][1] = hkl[k * 3 + j] - fl;
+            f[j][0] = 1. - f[j][1];
+            ix[j][0] = ((int64_t)fl) % p;
+            if (ix[j][0] < 0)
+                ix[j][0] += p;
+            ix[j][1] = (ix[j][0] + 1 == p) ? 0 : ix[j][0] + 1;
+        }
+        for (a = 0; a < 2; a++)
+            for (b = 0; b < 2; b++)
+                for (c = 0; c < 2; c++) {
+                    w = (float)(f[0][a] * f[1][b] * f[2][c]);
+                    adr = (ix[0][a] * p + ix[1][b]) * p + ix[2][c];
+#pragma omp atomic
+                    data[adr] += w;
+                }
+    }
+    return 0;
+}
+
 /* F2PY_WRAPPER_START
 
     subroutine cluster1d( ar, n, order, tol, nclusters, ids, avgs)
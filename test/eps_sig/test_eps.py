@@ -60,6 +60,43 @@ class test_eps_grain( unittest.TestCase):
             self.assertTrue( ok )
 
 
+class test_eps_sig_solver( unittest.TestCase ):
+    """ The batched solver against the reference output in test.out """
+
+    def setUp(self):
+        from ImageD11 import eps_sig_solver
+        pth = os.path.split(__file__)[0]
+        self.testdata = np.loadtxt(os.path.join(pth,"test.out"), skiprows = 30)
+        self.s = eps_sig_solver.solver()
+        self.s.loadmap( os.path.join(pth, "CuAlBe_scan10.map") )
+        self.s.loadpars( os.path.join(pth, "mypar.par") )
+        self.s.updateparameters()
+        self.titles = eps_sig_solver.EPS_SIG_TITLES
+        self.c = self.s.compute_eps_sig()
+
+    def test_strain(self):
+        self.assertEqual( self.c.nrows, len(self.testdata) )
+        for i, t in enumerate( self.titles[:27] ):
+            self.assertTrue( np.allclose( self.c.getcolumn(t),
+                                          self.testdata[:,i], atol=1e-5 ), t )
+
+    def test_u_and_eps(self):
+        from xfab.tools import ubi_to_u_and_eps
+        from ImageD11.eps_sig_solver import ubis_to_u_and_eps
+        U, eps = ubis_to_u_and_eps( self.s.ubis, self.s.unitcell() )
+        for i, ubi in enumerate( self.s.ubis ):
+            u, e = ubi_to_u_and_eps( ubi, self.s.unitcell() )
+            self.assertTrue( np.allclose( u, U[i] ) )
+            self.assertTrue( np.allclose( e, eps[i][[0,0,0,1,1,2],[0,1,2,1,2,2]] ) )
+
+    def test_stress(self):
+        if "sig11_c" not in self.c.titles:
+            self.skipTest("needs FitAllB for the stiffness")
+        for i, t in enumerate( self.titles ):
+            if t.startswith("sig"):
+                self.assertTrue( np.allclose( self.c.getcolumn(t),
+                                              self.testdata[:,i], atol=0.01 ), t )
+
 
 if __name__=="__main__":
     unittest.main()
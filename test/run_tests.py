@@ -32,6 +32,14 @@ modules = [
     "test_compress_duplicates",
     "eps_sig.test_eps",
     "test_finite_strain",
+    "test_grid_index_parallel",
+    "test_fft_index",
+    "test_lattice_reduction",
+    "test_vote_indexer",
+    "test_refinegrains",
+    "test_graincollection",
+    "test_sinograms",
+    "test_peakmerge",
 ]
 
 if "all" in sys.argv:
@@ -0,0 +1,39 @@
+from __future__ import print_function
+import unittest
+import numpy as np
+from ImageD11 import fft_index_refac
+
+
+class testfftgrid( unittest.TestCase ):
+    def setUp(self):
+        # g-vectors from a cubic cell of 4 Angstrom, 8 grid points
+        h = np.mgrid[-4:5, -4:5, -4:5].reshape( 3, -1 ).T
+        self.gv = h / 4.
+        self.g = fft_index_refac.grid( npx = 64, mr = 1.0, nsig = 5 )
+        self.g.gv_to_grid_new( self.gv )
+        self.g.fft()
+        self.g.props()
+
+    def test_props_match_full_fft(self):
+        full = abs( np.fft.fftn( self.g.grid ) )
+        self.assertAlmostEqual( self.g.mean / full.mean(), 1, 5 )
+        self.assertAlmostEqual( self.g.sigma / full.std( ddof = 1 ), 1, 4 )
+
+    def test_finds_lattice(self):
+        self.g.peaksearch()
+        self.g.read_peaks()
+        v = self.g.UBIALL
+        lv = np.sqrt( ( v * v ).sum( axis = 1 ) )
+        # lattice vectors of length 4
+        self.assertTrue( ( abs( lv - 4 ) < 0.01 ).sum() >= 3 )
+        hr = np.dot( v, self.gv.T )
+        self.assertTrue( np.allclose( hr, np.round( hr ), atol = 1e-3 ) )
+
+    def test_reuse(self):
+        before = self.g.grid.copy()
+        self.g.gv_to_grid_new( self.gv )
+        self.assertTrue( ( self.g.grid == before ).all() )
+
+
+if __name__ == "__main__":
+    unittest.main()
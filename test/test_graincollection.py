@@ -0,0 +1,108 @@
+from __future__ import print_function
+
+import unittest, os
+import numpy as np
+from ImageD11.grain import read_grain_file, write_grain_file, \
+    GrainCollection, read_grain_file_h5, iter_grain_file_h5, \
+    read_grain_collection
+
+
+class test_graincollection(unittest.TestCase):
+    """ Arrays for many grains should match the grain objects """
+
+    def setUp(self):
+        pth = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           "eps_sig", "CuAlBe_scan10.map")
+        self.grains = read_grain_file(pth)
+        self.gc = GrainCollection.from_grains(self.grains)
+        self.dzero = (5.77, 5.77, 5.77, 90., 90., 90.)
+
+    def test_properties(self):
+        for name in ("UB", "B", "U", "Rod", "mt", "rmt", "unitcell"):
+            ref = np.array([getattr(g, name) for g in self.grains])
+            self.assertTrue(np.allclose(ref, getattr(self.gc, name)), name)
+        self.assertFalse(self.gc.U.flags.writeable)
+
+    def test_strain(self):
+        for m in (0.5, 1.0, 0.0):
+            e = np.array([g.eps_grain(self.dzero, m) for g in self.grains])
+            self.assertTrue(np.allclose(e, self.gc.eps_grain(self.dzero, m)))
+            e = np.array([g.eps_sample(self.dzero, m) for g in self.grains])
+            self.assertTrue(np.allclose(e, self.gc.eps_sample(self.dzero, m)))
+
+    def test_roundtrip(self):
+        self.grains[1].translation = None
+        gc = GrainCollection.from_grains(self.grains)
+        self.assertEqual(len(gc), len(self.grains))
+        for a, b in zip(self.grains, gc.to_grains()):
+            self.assertTrue((a.ubi == b.ubi).all())
+            if a.translation is None:
+                self.assertTrue(b.translation is None)
+            else:
+                self.assertTrue((a.translation == b.translation).all())
+            self.assertEqual(a.name, b.name)
+            self.assertEqual(a.npks, b.npks)
+            self.assertEqual(a.intensity_info, b.intensity_info)
+
+    def test_select(self):
+        sub = self.gc[self.gc.unitcell[:, 0] > 5.78]
+        self.assertTrue(0 < len(sub) < len(self.gc))
+        self.assertEqual(len(sub.name), len(sub))
+        self.assertEqual(self.gc[3].name, self.grains[3].name)
+
+
+class test_grain_file_h5(unittest.TestCase):
+    """ The hdf grain files hold the same as the text ones """
+
+    def setUp(self):
+        import tempfile
+        self.pth = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "eps_sig", "CuAlBe_scan10.map")
+        self.grains = read_grain_file(self.pth)
+        self.tmpdir = tempfile.mkdtemp()
+        self.h5 = os.path.join(self.tmpdir, "grains.h5")
+        write_grain_file(self.h5, self.grains)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+
+    def test_read_grain_file(self):
+        gl = read_grain_file(self.h5)
+        self.assertEqual(len(gl), len(self.grains))
+        for a, b in zip(self.grains, gl):
+            self.assertTrue((a.ubi == b.ubi).all())
+            self.assertTrue((a.translation == b.translation).all())
+            self.assertEqual(a.name.rstrip(), b.name)
+            self.assertEqual(int(a.npks), b.npks)
+            self.assertEqual(a.intensity_info.rstrip(), b.intensity_info)
+
+    def test_text_roundtrip(self):
+        # text -> hdf -> text gives the same file
+        txt = os.path.join(self.tmpdir, "grains.map")
+        write_grain_file(txt, read_grain_collection(self.h5))
+        txt0 = os.path.join(self.tmpdir, "grains0.map")
+        write_grain_file(txt0, self.grains)
+        self.assertEqual(open(txt).read(), open(txt0).read())
+
+    def test_rows(self):
+        gc = read_grain_collection(self.pth)
+        for rows in (slice(2, 5), [4, 1, 1, 0], gc.npks > 250):
+            sub = read_grain_file_h5(self.h5, rows)
+            ref = gc[rows]
+            self.assertTrue((sub.ubi == ref.ubi).all())
+            self.assertTrue((sub.npks == ref.npks).all())
+            self.assertEqual(list(sub.name), list(ref.name))
+        n = sum(len(c) for c in iter_grain_file_h5(self.h5, chunksize=3))
+        self.assertEqual(n, len(gc))
+
+    def test_mmap(self):
+        gc = read_grain_file_h5(self.h5, mmap=True)
+        self.assertTrue(isinstance(gc.ubi, np.memmap))
+        ref = read_grain_collection(self.pth)
+        self.assertTrue((gc.ubi == ref.ubi).all())
+        self.assertTrue(np.allclose(gc.U, ref.U))
+
+
+if __name__ == "__main__":
+    unittest.main()
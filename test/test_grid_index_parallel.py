@@ -0,0 +1,251 @@
+from __future__ import print_function
+import unittest, os, tempfile, shutil
+import numpy as np
+from ImageD11 import columnfile, parameters, grid_index_parallel, grain
+from ImageD11 import transform, unitcell
+import xfab.tools
+
+
+class testsharedpeaks( unittest.TestCase ):
+    def setUp(self):
+        np.random.seed(42)
+        self.c = columnfile.colfile_from_dict( {
+            'sc' : np.random.random( 100 ) * 2048,
+            'fc' : np.random.random( 100 ) * 2048,
+            'omega' : np.linspace( -90, 90, 100 ) } )
+        self.pars = parameters.parameters( wavelength = 0.2, distance = 1e5 )
+
+    def test_attach(self):
+        p = grid_index_parallel.sharedpeaks( self.c, self.pars, "tst" )
+        try:
+            c = p.attach()
+            self.assertEqual( c.nrows, 100 )
+            for t in self.c.titles:
+                self.assertTrue( (c.getcolumn(t) == self.c.getcolumn(t)).all() )
+            self.assertEqual( c.parameters.get('wavelength'), 0.2 )
+            self.assertFalse( c.sc.flags.writeable )
+        finally:
+            p.close()
+
+    def test_memmap(self):
+        shm = grid_index_parallel.shared_memory
+        grid_index_parallel.shared_memory = None
+        try:
+            p = grid_index_parallel.sharedpeaks( self.c, self.pars, "tst" )
+            self.assertTrue( os.path.exists( "tst_peaks.npy" ) )
+            c = p.attach()
+            self.assertTrue( (c.omega == self.c.omega).all() )
+            del c
+            p.close()
+            self.assertFalse( os.path.exists( "tst_peaks.npy" ) )
+        finally:
+            grid_index_parallel.shared_memory = shm
+
+
+def brute_force_uniq( ul, grains ):
+    """ The original loop over all accepted grains """
+    found = []
+    for gnew in grains:
+        for j, gold in enumerate(ul.uniqgrains):
+            dt = gnew.translation - gold.translation
+            if np.dot(dt, dt) > 50*50:
+                continue
+            aumis = np.dot(gold.asymusT, gnew.U)
+            arg = (aumis[:,0,0]+aumis[:,1,1]+aumis[:,2,2] - 1. )/2.
+            if np.arccos(np.clip(arg, -1, 1)).min() < np.radians(1.):
+                found.append( j )
+                break
+        else:
+            found.append( len(ul.uniqgrains) )
+            ul.append_uniq( gnew )
+    return found
+
+
+class testuniqgrainlist( unittest.TestCase ):
+    def test_matches_brute_force(self):
+        np.random.seed(42)
+        B = np.eye(3) / 4.05
+        grains = []
+        for i in range(100):
+            U = xfab.tools.rod_to_u( np.random.random(3) - 0.5 )
+            t = np.random.random(3) * 600 - 300
+            grains.append( ( U, t ) )
+        # re-find some with noise on orientation and translation
+        for i in np.random.randint( 0, 100, 300 ):
+            U, t = grains[i]
+            dU = xfab.tools.rod_to_u( ( np.random.random(3) - 0.5 ) * 0.02 )
+            grains.append( ( np.dot( dU, U ),
+                             t + ( np.random.random(3) - 0.5 ) * 80 ) )
+        gl = [ grain.grain( np.linalg.inv( np.dot( U, B ) ), t )
+               for U, t in grains ]
+        ul = grid_index_parallel.uniq_grain_list( "cubic", 50., 1. )
+        ul.add( gl[:150] )
+        ul.add( gl[150:] )
+        ref = grid_index_parallel.uniq_grain_list( "cubic", 50., 1. )
+        found = brute_force_uniq( ref, [ grain.grain( g.ubi, g.translation )
+                                         for g in gl ] )
+        self.assertEqual( len(ref.uniqgrains), len(ul.uniqgrains) )
+        for a, b in zip( ref.uniqgrains, ul.uniqgrains ):
+            self.assertTrue( np.allclose( a.ubi, b.ubi ) )
+        nfound = np.bincount( found )
+        self.assertTrue( ( nfound == [ g.nfound for g in ul.uniqgrains ] ).all() )
+
+
+class testprogress( unittest.TestCase ):
+    def test_resume(self):
+        tmp = "tstresume"
+        gl = [ grain.grain( np.eye(3)*4.05, (0,0,0) ),
+               grain.grain( np.eye(3)*4.05, (500,0,0) ) ]
+        grid_index_parallel.save_grains( "all%s.map"%(tmp), gl )
+        translations = [ (0,0,0), (0,0,50), (0,50,0), (50.,0,0) ]
+        with open( "%s_done.txt"%(tmp), "w" ) as f:
+            for t in translations[::2]:
+                f.write( grid_index_parallel.translation_key( t ) + "\n" )
+        ul = grid_index_parallel.uniq_grain_list( "cubic", 50., 1. )
+        done = grid_index_parallel.load_progress( tmp, ul )
+        self.assertEqual( len(ul.uniqgrains), 2 )
+        todo = [ t for t in translations
+                 if grid_index_parallel.translation_key( t ) not in done ]
+        self.assertEqual( todo, [ (0,0,50), (50.,0,0) ] )
+        os.remove( "all%s.map"%(tmp) )
+        os.remove( "%s_done.txt"%(tmp) )
+
+
+SIMPARS = { 'cell__a' : 4.05, 'cell__b' : 4.05, 'cell__c' : 4.05,
+            'cell_alpha' : 90., 'cell_beta' : 90., 'cell_gamma' : 90.,
+            'cell_lattice_[P,A,B,C,I,F,R]' : 'F',
+            'chi' : 0., 'wedge' : 0., 'omegasign' : 1.,
+            'distance' : 150000., 'wavelength' : 0.2,
+            'o11' : 1, 'o12' : 0, 'o21' : 0, 'o22' : -1,
+            'tilt_x' : 0., 'tilt_y' : 0., 'tilt_z' : 0.,
+            't_x' : 0., 't_y' : 0., 't_z' : 0.,
+            'y_center' : 1024., 'z_center' : 1024.,
+            'y_size' : 50., 'z_size' : 50. }
+
+
+def simulate_peaks( pars, grains, dsmax = 0.9 ):
+    """ sc, fc, omega of the peaks from grains landing on a 2048x2048 detector """
+    uc = unitcell.unitcell_from_parameters( pars )
+    uc.makerings( dsmax )
+    hkls = np.array( [ h for d in uc.ringds for h in uc.ringhkls[d] ], float ).T
+    sc, fc, om = [], [], []
+    for g in grains:
+        gv = np.dot( np.linalg.inv( g.ubi ), hkls )
+        tth, eta, omega = transform.uncompute_g_vectors( gv, pars.get('wavelength') )
+        p = dict( pars.parameters, t_x = g.translation[0],
+                  t_y = g.translation[1], t_z = g.translation[2] )
+        for e, o in zip( eta, omega ):
+            f, s = transform.compute_xyz_from_tth_eta( tth, e, o, **p )
+            m = ( tth > 0 ) & ( s > 0 ) & ( s < 2048 ) & ( f > 0 ) & ( f < 2048 )
+            sc.append( s[m] )
+            fc.append( f[m] )
+            om.append( o[m] )
+    return np.concatenate( sc ), np.concatenate( fc ), np.concatenate( om )
+
+
+class testadaptive( unittest.TestCase ):
+    def setUp(self):
+        np.random.seed(42)
+        self.pars = parameters.parameters( **SIMPARS )
+        B = unitcell.unitcell_from_parameters( self.pars ).B
+        self.grains = [ grain.grain( np.linalg.inv( np.dot( xfab.tools.rod_to_u( r ), B ) ), t )
+                        for r, t in ( ( ( 0.1, 0.2, 0.3 ), ( -100., 50., 0. ) ),
+                                      ( ( -0.2, 0.1, 0.05 ), ( 100., -50., 0. ) ) ) ]
+        self.npk = [ len( simulate_peaks( self.pars, [g] )[0] ) for g in self.grains ]
+        sc, fc, om = simulate_peaks( self.pars, self.grains )
+        # some peaks which nothing should index
+        self.nnoise = 40
+        sc = np.concatenate( ( sc, np.random.random( self.nnoise ) * 2048 ) )
+        fc = np.concatenate( ( fc, np.random.random( self.nnoise ) * 2048 ) )
+        om = np.concatenate( ( om, np.random.random( self.nnoise ) * 360 - 180 ) )
+        self.c = columnfile.colfile_from_dict( { 'sc' : sc, 'fc' : fc, 'omega' : om } )
+
+    def test_unindexed_peaks(self):
+        n0, n1 = self.npk
+        msk = grid_index_parallel.unindexed_peaks( self.c, self.pars.parameters,
+                                                   self.grains[:1], 0.01 )
+        self.assertFalse( msk[:n0].any() )
+        self.assertTrue( msk[n0:].all() )
+        msk = grid_index_parallel.unindexed_peaks( self.c, self.pars.parameters,
+                                                   self.grains, 0.01 )
+        self.assertFalse( msk[:n0+n1].any() )
+        self.assertTrue( msk[n0+n1:].sum() > self.nnoise - 5 )
+        # at the wrong translation the peaks are not indexed
+        g = grain.grain( self.grains[0].ubi, self.grains[1].translation )
+        msk = grid_index_parallel.unindexed_peaks( self.c, self.pars.parameters,
+                                                   [g], 0.01 )
+        self.assertTrue( msk[:n0].sum() > n0 / 2 )
+
+    def test_grid_index_adaptive(self):
+        self.run_adaptive()
+
+    def test_grid_index_adaptive_memmap(self):
+        shm = grid_index_parallel.shared_memory
+        grid_index_parallel.shared_memory = None
+        try:
+            self.run_adaptive()
+        finally:
+            grid_index_parallel.shared_memory = shm
+        self.assertEqual( [ f for f in os.listdir( "." )
+                            if f.startswith( "tstadaptive" ) ], [] )
+
+    def run_adaptive(self):
+        tmpdir = tempfile.mkdtemp()
+        tmp = "tstadaptive"
+        fltfile = os.path.join( tmpdir, "peaks.flt" )
+        parfile = os.path.join( tmpdir, "pars.par" )
+        self.c.writefile( fltfile )
+        self.pars.saveparameters( parfile )
+        gridpars = { 'DSTOL' : 0.004, 'OMEGAFLOAT' : 0.13, 'COSTOL' : 0.002,
+                     'NPKS' : 30, 'TOLSEQ' : [ 0.02, 0.01 ], 'SYMMETRY' : "cubic",
+                     'RING1' : [1], 'RING2' : [0, 1], 'NUL' : True, 'FITPOS' : True,
+                     'tolangle' : 0.25, 'toldist' : 100., 'NPROC' : 1,
+                     'NLEVELS' : 1, 'RESUME' : False }
+        masks = []
+        unindexed_peaks = grid_index_parallel.unindexed_peaks
+        def record( *args ):
+            msk = unindexed_peaks( *args )
+            masks.append( msk )
+            return msk
+        grid_index_parallel.unindexed_peaks = record
+        try:
+            grid_index_parallel.grid_index_adaptive(
+                fltfile, parfile, tmp, gridpars,
+                [ tuple( g.translation ) for g in self.grains ], 100. )
+            found = grain.read_grain_file( "all%s.map"%(tmp) )
+            with open( "%s_done.txt"%(tmp) ) as f:
+                ndone = len( f.readlines() )
+        finally:
+            grid_index_parallel.unindexed_peaks = unindexed_peaks
+            for name in ( "all%s.map"%(tmp), "%s_done.txt"%(tmp) ):
+                if os.path.exists( name ):
+                    os.remove( name )
+            shutil.rmtree( tmpdir )
+        # both grains at their own translation
+        i0 = 0
+        for g, n in zip( self.grains, self.npk ):
+            dt = [ np.linalg.norm( f.translation - g.translation ) for f in found ]
+            self.assertTrue( min( dt ) < 5 )
+            f = found[ np.argmin( dt ) ]
+            msk = grid_index_parallel.unindexed_peaks( self.c, self.pars.parameters,
+                                                       [f], 0.01 )
+            self.assertFalse( msk[i0:i0+n].any() )
+            i0 += n
+        # all the grain peaks were removed before the finer level
+        self.assertEqual( len( masks ), 1 )
+        self.assertFalse( masks[0][:i0].any() )
+        self.assertTrue( masks[0][i0:].sum() > self.nnoise - 5 )
+        # the finer level was searched using the peaks that were left
+        self.assertTrue( ndone > len( self.grains ) )
+
+    def test_finer_translations(self):
+        pts = grid_index_parallel.finer_translations( [ (0,0,0) ], 50. )
+        self.assertEqual( len(pts), 26 )
+        self.assertFalse( (0,0,0) in pts )
+        # neighbours of two hits share points
+        pts = grid_index_parallel.finer_translations( [ (0,0,0), (100,0,0) ], 50. )
+        self.assertEqual( len(pts), 26*2 - 9 )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,7 +1,8 @@
 
 from __future__ import print_function
 
-from ImageD11.indexing import ubi_fit_2pks
+from ImageD11.indexing import ubi_fit_2pks, friedel_pairs
+from ImageD11 import transform
 from ImageD11.unitcell import unitcell
 import numpy as np
 import time
@@ -77,6 +78,26 @@ class test_2pks( unittest.TestCase ):
         
         
 
+class test_friedel( unittest.TestCase ):
+    def test_pairs(self):
+        np.random.seed(42)
+        n = 1000
+        tth = np.random.uniform( 3, 20, n )
+        eta = np.random.uniform( -180, 180, n )
+        omega = np.random.uniform( -180, 180, n )
+        # mates with some noise, then unpaired peaks at the end
+        t = np.concatenate( ( tth, tth + 0.01, np.random.uniform( 3, 20, 10 ) ) )
+        e = np.concatenate( ( eta, 180 - eta + 0.1, np.random.uniform( -180, 180, 10 ) ) )
+        o = np.concatenate( ( omega, omega + 180.1, np.random.uniform( -180, 180, 10 ) ) )
+        i, j = friedel_pairs( t, e, o, tth_tol=0.05, eta_tol=0.5, omega_tol=0.5 )
+        self.assertTrue( (i < j).all() )
+        self.assertTrue( len(i) > 0.99 * n )
+        self.assertTrue( ( j - i == n ).mean() > 0.99 )
+        # the pairs are g, -g
+        g = transform.compute_g_vectors( t, e, o, 0.3 )
+        s = g[:,i] + g[:,j]
+        self.assertTrue( np.sqrt( (s*s).sum(axis=0) ).max() < 0.01 )
+
 
 if __name__=="__main__":
     unittest.main()
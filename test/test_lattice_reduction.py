@@ -0,0 +1,66 @@
+from __future__ import print_function
+
+import unittest
+import numpy as np
+from ImageD11 import lattice_reduction
+from ImageD11.rc_array import rc_array
+
+
+class testbatched(unittest.TestCase):
+    """ The vectorised code should agree with the lattice class """
+
+    def setUp(self):
+        rng = np.random.RandomState(42)
+        self.ubi = np.array([[4.1, 0.3, 0.2],
+                             [0.1, 5.3, -0.4],
+                             [0.2, 0.1, 7.2]])
+        hkl = rng.randint(-2, 3, size=(3, 400))
+        gv = np.dot(np.linalg.inv(self.ubi), hkl).T
+        gv += rng.normal(size=gv.shape) * 0.002
+        noise = rng.uniform(-0.8, 0.8, size=(10, 3))
+        self.gv = np.concatenate((noise, gv))
+        self.rng = rng
+
+    def test_reduce_many(self):
+        v = self.rng.normal(size=(100, 3, 3)) * 3
+        v[0, 2] = v[0, 0] + v[0, 1]  # coplanar
+        bases, ok = lattice_reduction.reduce_many(v, 1e-3)
+        self.assertFalse(ok[0])
+        for b, good, vi in zip(bases, ok, v):
+            try:
+                r = lattice_reduction.reduce(vi[0], vi[1], vi[2], 1e-3)
+            except Exception:
+                self.assertFalse(good)
+                continue
+            self.assertTrue(good)
+            self.assertTrue(np.allclose(r, b))
+
+    def test_score_many(self):
+        g = rc_array(self.gv, direction='row')
+        ijk = np.array([self.rng.choice(len(self.gv), 3, replace=False)
+                        for i in range(50)])
+        bases, ok = lattice_reduction.reduce_many(self.gv[ijk], 1e-4)
+        scores = lattice_reduction.score_many(bases[ok], g, 0.1, 'row')
+        for (i, j, k), s in zip(ijk[ok], scores):
+            l = lattice_reduction.lattice(g[i], g[j], g[k],
+                                          direction='row', min_vec2=1e-4)
+            self.assertEqual(l.score(g, 0.1), s)
+
+    def test_find_lattice(self):
+        g = rc_array(self.gv, direction='row')
+        l = lattice_reduction.find_lattice(g, min_vec2=1e-4, n_try=40,
+                                           fraction_indexed=0.9)
+        self.assertFalse(l is None)
+        # Same lattice as the one used to make the peaks
+        m = np.dot(l.r2c, np.linalg.inv(self.ubi))
+        self.assertTrue(np.allclose(m, np.round(m), atol=0.05))
+        self.assertAlmostEqual(abs(np.linalg.det(m)), 1, 1)
+
+    def test_iter3d_batches(self):
+        ref = list(lattice_reduction.iter3d(12))
+        got = np.concatenate(list(lattice_reduction.iter3d_batches(12, 7)))
+        self.assertEqual(ref, [tuple(t) for t in got])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,40 @@
+from __future__ import print_function
+import unittest, os, tempfile, shutil
+import numpy as np
+from ImageD11 import peakmerge, columnfile
+
+
+class testsavepeaks( unittest.TestCase ):
+    """ savepeaks keeps the %f text format and can write hdf """
+    def setUp(self):
+        rng = np.random.RandomState( 42 )
+        self.p = peakmerge.peakmerger()
+        self.p.finalpeaks = rng.uniform( -180, 180, ( 10, 7 ) )
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree( self.tmpdir )
+
+    def test_text(self):
+        fname = os.path.join( self.tmpdir, "pks.flt" )
+        self.p.savepeaks( fname )
+        with open( fname ) as f:
+            lines = f.readlines()
+        self.assertEqual( lines[0].split(), [ "#", "xc", "yc", "omega", "npixels",
+            "avg_intensity", "x_raw", "y_raw", "sigx", "sigy", "covxy" ] )
+        omega = lines[1].split()[2]
+        self.assertEqual( omega, "%f"%( self.p.finalpeaks[2, 0] ) )
+        c = columnfile.columnfile( fname )
+        self.assertEqual( c.nrows, 7 )
+        self.assertTrue( np.allclose( c.omega, self.p.finalpeaks[2], atol = 1e-6 ) )
+
+    def test_hdf(self):
+        fname = os.path.join( self.tmpdir, "pks.h5" )
+        self.p.savepeaks( fname )
+        c = columnfile.columnfile( fname )
+        self.assertEqual( c.nrows, 7 )
+        self.assertTrue( np.allclose( c.omega, self.p.finalpeaks[2], atol = 1e-4 ) )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -33,6 +33,40 @@ class test1(unittest.TestCase):
         assert ( np.ravel(data)[49] == 0 )
         assert ( np.ravel(data)[51] == 0 )
 
+    def test_trilinear_point(self):
+        npx = 8
+        data = np.zeros( npx**3, np.float32 )
+        hkl = np.array( [[ 1.25, 2.5, -1.0 ]] )
+        cImageD11.put_trilinear( data, npx, hkl )
+        grid = data.reshape( npx, npx, npx )
+        assert np.allclose( grid.sum(), 1 )
+        assert np.allclose( grid[1,2,7], 0.75*0.5 )
+        assert np.allclose( grid[2,3,7], 0.25*0.5 )
+        assert grid[:,:,0].sum() == 0
+
+    def test_trilinear_wrap(self):
+        npx = 6
+        rng = np.random.RandomState( 42 )
+        hkl = rng.uniform( -20, 20, ( 1000, 3 ) )
+        data = np.zeros( npx**3, np.float32 )
+        cImageD11.put_trilinear( data, npx, hkl )
+        ref = np.zeros( npx**3, float )
+        h0 = np.floor( hkl )
+        rem = hkl - h0
+        for cor in np.ndindex( 2, 2, 2 ):
+            w = np.prod( 1 - abs( rem - cor ), axis=1 )
+            ih = ( h0.astype(int) + cor ) % npx
+            np.add.at( ref, ( ih[:,0]*npx + ih[:,1] )*npx + ih[:,2], w )
+        assert np.allclose( data, ref, atol=1e-4 )
+
+    def test_trilinear_size(self):
+        hkl = np.array( [[ 1.25, 2.5, -1.0 ]] )
+        data = np.zeros( 4**3 + 1, np.float32 )
+        assert cImageD11.put_trilinear( data, 4, hkl ) == -1
+        assert ( data == 0 ).all()
+        assert cImageD11.put_trilinear( data[:4**3], 4, hkl ) == 0
+        assert np.allclose( data.sum(), 1 )
+
 if __name__=="__main__":
     unittest.main()
         
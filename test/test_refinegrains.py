@@ -0,0 +1,163 @@
+from __future__ import print_function
+
+import unittest, os
+import numpy as np
+from ImageD11 import cImageD11
+from ImageD11.refinegrains import assign_best_grain, refinegrains, \
+    assign_threads
+
+
+class test_assign_best_grain(unittest.TestCase):
+    """ Threaded assignment must give the same answer as the serial loop """
+
+    def setUp(self):
+        rng = np.random.RandomState(42)
+        n = 20000
+        self.xyz = np.column_stack((np.full(n, 1e5),
+                                    rng.uniform(-5e4, 5e4, (n, 2))))
+        self.om = rng.uniform(-180, 180, n)
+        grains = []
+        for i in range(30):
+            u = np.linalg.qr(rng.normal(size=(3, 3)))[0] * 4.05
+            grains.append((i, rng.uniform(-200, 200, 3), u))
+        # identical grains give ties which go to the first one
+        grains += [(30 + i, t.copy(), u.copy()) for i, t, u in grains[:5]]
+        self.grains = grains
+        self.pars = (1.0, 0.2, 0.0, 0.0)
+
+    def serial(self, tol):
+        n = len(self.om)
+        gv = np.zeros((n, 3))
+        drlv2 = np.ones(n)
+        labels = np.zeros(n, np.int32) - 1
+        for label, t, ubi in self.grains:
+            cImageD11.compute_gv(self.xyz, self.om, 1.0, 0.2, 0.0, 0.0, t, gv)
+            cImageD11.score_and_assign(ubi, gv, tol, drlv2, labels, label)
+        return drlv2, labels, gv
+
+    def test_same_as_serial(self):
+        d0, l0, g0 = self.serial(0.25)
+        self.assertTrue((l0 >= 0).sum() > 0)
+        self.assertFalse((l0 >= 30).any())
+        for nthreads in (1, 2, 3, 7):
+            d, l, g = assign_best_grain(self.xyz, self.om, self.pars, 0.25,
+                                        self.grains, nthreads)
+            self.assertTrue((d == d0).all())
+            self.assertTrue((l == l0).all())
+            self.assertTrue((g == g0).all())
+
+
+class test_assign_threads(unittest.TestCase):
+    """ The default thread count is limited by memory and grains """
+
+    def test_limits(self):
+        nomp = cImageD11.cimaged11_omp_get_max_threads()
+        self.assertEqual(assign_threads(1000, 10000), nomp)
+        self.assertEqual(assign_threads(10**7, 10000, memory=36 * 10**7 * 2),
+                         min(2, nomp))
+        self.assertEqual(assign_threads(10**8, 10000), 1)
+        self.assertEqual(assign_threads(1000, 3), 1)
+
+
+class test_refinepositions(unittest.TestCase):
+    """ Grains refined in worker processes match the serial loop """
+
+    def fit(self, nproc, method="simplex", maxiters=20, OmFloat=True):
+        here = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            "makemap")
+        o = refinegrains(tolerance=0.05, OmFloat=OmFloat)
+        o.loadparameters(os.path.join(here, "test.prm"))
+        o.readubis(os.path.join(here, "map.ubi"))
+        o.loadfiltered(os.path.join(here, "test.flt"))
+        o.generate_grains()
+        for key in list(o.grains.keys())[5:]:
+            o.grains.pop(key)
+        o.grainnames = sorted(set(k[0] for k in o.grains))
+        o.refinepositions(maxiters=maxiters, nproc=nproc, method=method)
+        ks = sorted(o.grains.keys())
+        return (np.array([o.grains[k].translation for k in ks]),
+                np.array([o.grains[k].ubi for k in ks]))
+
+    def test_nproc(self):
+        t1, u1 = self.fit(1)
+        t2, u2 = self.fit(2)
+        self.assertTrue(np.allclose(t1, t2))
+        self.assertTrue(np.allclose(u1, u2))
+
+    def test_lsq(self):
+        t1, u1 = self.fit(1, maxiters=100, OmFloat=False)
+        t2, u2 = self.fit(1, "lsq", OmFloat=False)
+        self.assertTrue(np.allclose(t1, t2, atol=5))
+        self.assertTrue(np.allclose(u1, u2, atol=1e-3))
+        t3, u3 = self.fit(2, "lsq", OmFloat=False)
+        self.assertTrue(np.allclose(t2, t3))
+
+    def test_lsq_omfloat(self):
+        t1, u1 = self.fit(1, maxiters=100)
+        t2, u2 = self.fit(1, "lsq")
+        self.assertTrue(np.allclose(t1, t2, atol=5))
+        self.assertTrue(np.allclose(u1, u2, atol=1e-3))
+
+
+class test_refine_cache(unittest.TestCase):
+    """ Grains with unchanged peaks and inputs are not refined again """
+
+    def setUp(self):
+        here = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            "makemap")
+        o = refinegrains(tolerance=0.05, OmFloat=False)
+        o.loadparameters(os.path.join(here, "test.prm"))
+        o.readubis(os.path.join(here, "map.ubi"))
+        o.loadfiltered(os.path.join(here, "test.flt"))
+        o.generate_grains()
+        for key in list(o.grains.keys())[3:]:
+            o.grains.pop(key)
+        o.grainnames = sorted(set(k[0] for k in o.grains))
+        self.o = o
+        self.t0 = dict((k, o.grains[k].translation.copy()) for k in o.grains)
+
+    def reset(self):
+        # back to the grains as read in
+        for k in self.o.grains:
+            self.o.grains[k].translation[:] = self.t0[k]
+            self.o.grains[k].set_ubi(self.o.ubisread[k[0]])
+
+    def test_reuse(self):
+        o = self.o
+        o.refinepositions(maxiters=20)
+        self.assertEqual(len(o.refine_cache), 3)
+        t1 = dict((k, o.grains[k].translation.copy()) for k in o.grains)
+        fps = set(o.refine_cache.keys())
+        self.reset()
+        o.refinepositions(maxiters=20)
+        self.assertEqual(set(o.refine_cache.keys()), fps)
+        for k in o.grains:
+            self.assertTrue((o.grains[k].translation == t1[k]).all())
+        # changing the geometry changes the fingerprints
+        o.parameterobj.parameters['distance'] *= 1.0001
+        self.reset()
+        o.refinepositions(maxiters=20)
+        self.assertEqual(len(o.refine_cache), 6)
+
+    def test_save_load(self):
+        import tempfile, shutil
+        o = self.o
+        o.refinepositions(maxiters=20, method="lsq")
+        d = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(d, "cache.npz")
+            o.save_refine_cache(fname)
+            c = o.refine_cache
+            o.refine_cache = {}
+            o.load_refine_cache(fname)
+        finally:
+            shutil.rmtree(d)
+        self.assertEqual(set(c.keys()), set(o.refine_cache.keys()))
+        for fp in c:
+            for name in c[fp]:
+                self.assertTrue(np.allclose(c[fp][name],
+                                            o.refine_cache[fp][name]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,193 @@
+from __future__ import print_function
+
+import unittest, os, tempfile, shutil
+import numpy as np
+
+try:
+    import h5py
+    from ImageD11.sinograms import dataset
+except ImportError:
+    dataset = None
+
+
+def make_bliss( dataroot, sample, dset, nscans=5, npts=6, frames_per_file=4 ):
+    """ A small master file with virtual datasets pointing at lima files """
+    dsname = sample + "_" + dset
+    datapath = os.path.join( dataroot, sample, dsname )
+    os.makedirs( datapath )
+    with h5py.File( os.path.join( datapath, dsname + ".h5" ), "w" ) as master:
+        for i in range( nscans ):
+            scan = "%d.1"%( i + 1 )
+            layout = h5py.VirtualLayout( shape=( npts, 4, 5 ), dtype=np.uint16 )
+            for j, start in enumerate( range( 0, npts, frames_per_file ) ):
+                n = min( frames_per_file, npts - start )
+                limaname = "scan%04d/eiger_%04d.h5"%( i + 1, j )
+                if not os.path.exists( os.path.join( datapath, "scan%04d"%( i + 1 ) ) ):
+                    os.makedirs( os.path.join( datapath, "scan%04d"%( i + 1 ) ) )
+                with h5py.File( os.path.join( datapath, limaname ), "w" ) as lima:
+                    lima["/entry_0000/measurement/data"] = np.zeros( ( n, 4, 5 ), np.uint16 )
+                # sliced so the source space keeps its shape
+                layout[start:start+n] = h5py.VirtualSource( limaname,
+                    "/entry_0000/measurement/data", shape=( n, 4, 5 ) )[0:n]
+            master.create_virtual_dataset( scan + "/measurement/eiger", layout )
+            master[scan + "/measurement/rot_center"] = np.linspace( 0, 180, npts )
+            master[scan + "/instrument/positioners/dty"] = i * 0.5 - 1
+        # not a scan we want
+        master["1.2/measurement/rot_center"] = np.zeros( npts )
+
+
+@unittest.skipIf( dataset is None, "needs h5py and fast_histogram" )
+class test_import(unittest.TestCase):
+    """ Parallel and cached metadata import match the serial one """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.dataroot = os.path.join( self.tmpdir, "raw" )
+        self.analysisroot = os.path.join( self.tmpdir, "analysis" )
+        make_bliss( self.dataroot, "sample", "z0" )
+
+    def tearDown(self):
+        shutil.rmtree( self.tmpdir )
+
+    def dataset(self):
+        return dataset.DataSet( dataroot=self.dataroot,
+                                analysisroot=self.analysisroot,
+                                sample="sample", dset="z0" )
+
+    def check(self, ds, ref):
+        self.assertEqual( ds.scans, ref.scans )
+        self.assertEqual( tuple( ds.shape ), tuple( ref.shape ) )
+        self.assertEqual( ds.imagefiles, ref.imagefiles )
+        self.assertEqual( ds.sparsefiles, ref.sparsefiles )
+        self.assertEqual( ds.limapath, ref.limapath )
+        self.assertTrue( ( ds.frames_per_file == ref.frames_per_file ).all() )
+        self.assertTrue( ( ds.omega == ref.omega ).all() )
+        self.assertTrue( ( ds.dty == ref.dty ).all() )
+
+    def test_parallel(self):
+        ref = self.dataset()
+        ref.import_scans()
+        ref.import_imagefiles()
+        ref.import_motors_from_master()
+        self.assertEqual( tuple( ref.shape ), ( 5, 6 ) )
+        self.assertEqual( len( ref.imagefiles ), 10 )
+        for nproc in ( 1, 2 ):
+            ds = self.dataset()
+            ds.import_scans()
+            ds.import_metadata( nproc=nproc, scans_per_job=2 )
+            self.check( ds, ref )
+
+    def test_cache(self):
+        ref = self.dataset()
+        ref.import_all( nproc=1 )
+        self.assertTrue( os.path.exists( ref.cachefile ) )
+        ds = self.dataset()
+        self.assertTrue( ds.load_cache() )
+        self.check( ds, ref )
+        # a new master file means reading it again
+        st = os.stat( ref.masterfile )
+        os.utime( ref.masterfile, ( st.st_atime, st.st_mtime + 10 ) )
+        self.assertFalse( self.dataset().load_cache() )
+        ds = self.dataset()
+        ds.import_all( nproc=1 )
+        self.check( ds, ref )
+        self.assertTrue( self.dataset().load_cache() )
+
+    def test_cache_moved(self):
+        """ A copied cache gives the metadata but not the old paths """
+        ref = self.dataset()
+        ref.import_all( nproc=1 )
+        ds = dataset.DataSet( dataroot=self.dataroot,
+                              analysisroot=os.path.join( self.tmpdir, "moved" ),
+                              sample="sample", dset="z0" )
+        os.makedirs( ds.analysispath )
+        shutil.copy( ref.cachefile, ds.cachefile )
+        self.assertTrue( ds.load_cache() )
+        self.check( ds, ref )
+        self.assertEqual( ds.analysisroot, os.path.join( self.tmpdir, "moved" ) )
+        self.assertNotEqual( ds.analysispath, ref.analysispath )
+
+
+def make_sparse( ds, seed=42 ):
+    """ Random sparse files for the frames of ds, returns the pixels """
+    rng = np.random.RandomState( seed )
+    os.makedirs( ds.analysispath )
+    pixels = []
+    for spname, nframes in zip( ds.sparsefiles, ds.frames_per_file ):
+        nnz = rng.randint( 0, 20, nframes )
+        npx = nnz.sum()
+        row = rng.randint( 0, 4, npx ).astype( np.uint16 )
+        col = rng.randint( 0, 5, npx ).astype( np.uint16 )
+        sig = rng.randint( 1, 100, npx ).astype( np.uint16 )
+        lab = rng.randint( -1, 3, npx ).astype( np.int32 )
+        with h5py.File( os.path.join( ds.analysispath, spname ), "w" ) as hout:
+            g = hout.require_group( ds.limapath )
+            g["nnz"] = nnz.astype( np.uint32 )
+            g["row"] = row
+            g["col"] = col
+            g["intensity"] = sig
+            g["labels"] = lab
+        frames = np.repeat( np.arange( nframes ), nnz )
+        pixels.append( ( frames, row, col, sig, lab ) )
+    return pixels
+
+
+@unittest.skipIf( dataset is None, "needs h5py and fast_histogram" )
+class test_sparse_sinogram(unittest.TestCase):
+    """ Streaming the sparse files gives the same as binning in memory """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        make_bliss( os.path.join( self.tmpdir, "raw" ), "sample", "z0" )
+        self.ds = dataset.DataSet( dataroot=os.path.join( self.tmpdir, "raw" ),
+                                   analysisroot=os.path.join( self.tmpdir, "analysis" ),
+                                   sample="sample", dset="z0" )
+        self.ds.import_all( nproc=1, cache=False )
+        self.pixels = make_sparse( self.ds )
+        self.ds.import_nnz()
+
+    def tearDown(self):
+        shutil.rmtree( self.tmpdir )
+
+    def test_counts(self):
+        ds = self.ds
+        self.assertTrue( ( ds.nnz.sum() ) > 0 )
+        ref = ds.sinohist( weights = ds.nnz.astype( float ), method = 'numpy' )
+        for nproc in ( 1, 2 ):
+            h = ds.sparse_sinogram( weights = None, nproc = nproc )
+            self.assertTrue( np.allclose( h, ref ) )
+
+    def test_labels(self):
+        ds = self.ds
+        n = ds.shape[0] * ds.shape[1]
+        sig = np.zeros( n )
+        rings = np.zeros( ( 2, n ) )
+        labs = np.zeros( ( 3, n ) )
+        ring_image = dataset.ring_labels( np.arange( 20. ).reshape( 4, 5 ),
+                                          [ ( 2, 5 ), ( 10, 12 ) ] )
+        i0 = 0
+        for nframes, ( frames, row, col, s, lab ) in zip( ds.frames_per_file,
+                                                         self.pixels ):
+            f = frames + i0
+            np.add.at( sig, f, s )
+            r = ring_image[ row, col ]
+            for i in range( 2 ):
+                np.add.at( rings[i], f[r == i], s[r == i] )
+            for i in range( 3 ):
+                np.add.at( labs[i], f[lab == i], s[lab == i] )
+            i0 += nframes
+        h = ds.sparse_sinogram( nproc = 1, chunksize = 7 )
+        self.assertTrue( np.allclose( h, ds.sinohist( weights = sig, method = 'numpy' ) ) )
+        h = ds.sparse_sinogram( image_labels = ring_image, nproc = 2, chunksize = 7 )
+        self.assertEqual( h.shape, ( 2, ) + tuple( ds.shape )[::-1] )
+        for i in range( 2 ):
+            self.assertTrue( np.allclose( h[i], ds.sinohist( weights = rings[i],
+                                                             method = 'numpy' ) ) )
+        h = ds.sparse_sinogram( pixel_labels = "labels", nlabels = 3, nproc = 1 )
+        for i in range( 3 ):
+            self.assertTrue( np.allclose( h[i], ds.sinohist( weights = labs[i],
+                                                             method = 'numpy' ) ) )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+from __future__ import print_function
+import unittest
+import numpy as np
+from ImageD11 import unitcell, indexing, vote_indexer, sym_u
+
+
+def random_rotation(rng):
+    q = rng.normal(size=4)
+    return vote_indexer.quat_to_matrix(q / np.sqrt((q*q).sum()))
+
+
+class testquaternions(unittest.TestCase):
+
+    def test_roundtrip(self):
+        rng = np.random.RandomState(11)
+        for i in range(50):
+            m = random_rotation(rng)
+            q = vote_indexer.matrix_to_quat(m)
+            self.assertTrue(np.allclose(vote_indexer.quat_to_matrix(q), m))
+        for m in (np.eye(3), np.diag((1., -1, -1)), np.diag((-1., 1, -1)),
+                  np.diag((-1., -1, 1))):
+            q = vote_indexer.matrix_to_quat(m)
+            self.assertTrue(np.allclose(vote_indexer.quat_to_matrix(q), m))
+
+    def test_fibre(self):
+        rng = np.random.RandomState(12)
+        b = np.array((1., 2, 3))
+        g = rng.normal(size=(10, 3))
+        g[0] = -b
+        m = vote_indexer.quat_to_matrix(
+            vote_indexer.fibre(b, g, np.linspace(0, 6, 7)))
+        bb = b / np.sqrt((b*b).sum())
+        gg = g / np.sqrt((g*g).sum(axis=1))[:, np.newaxis]
+        self.assertTrue(np.allclose(np.einsum('nmij,j->nmi', m, bb),
+                                    gg[:, np.newaxis, :]))
+
+    def test_fundamental_zone(self):
+        rng = np.random.RandomState(13)
+        uc = unitcell.unitcell([3.2, 3.2, 5.2, 90, 90, 120.], "P")
+        symq = vote_indexer.symmetry_quaternions(sym_u.hexagonal(), uc.B)
+        q = vote_indexer.matrix_to_quat(random_rotation(rng))
+        equiv = vote_indexer.qmul(q[np.newaxis], symq)
+        fz = vote_indexer.fundamental_zone(equiv, symq)
+        self.assertTrue(np.allclose(fz, fz[0]))
+
+
+class testvoting(unittest.TestCase):
+
+    def test_find_grains(self):
+        rng = np.random.RandomState(42)
+        uc = unitcell.unitcell([4.05, 4.05, 4.05, 90., 90., 90.], "F")
+        uc.makerings(1.0, tol=0.001)
+        hkls = np.array([h for ds in uc.ringds for h in uc.ringhkls[ds]],
+                        float)
+        us = [random_rotation(rng) for i in range(10)]
+        gv = []
+        for u in us:
+            g = np.dot(np.dot(u, uc.B), hkls.T).T
+            keep = rng.random_sample(len(g)) < 0.6
+            gv.append(g[keep] + rng.normal(size=(keep.sum(), 3)) * 1e-4)
+        gv = np.concatenate(gv)
+        ind = indexing.indexer(unitcell=uc, gv=gv, ds_tol=0.005,
+                               hkl_tol=0.02, minpks=15)
+        ind.assigntorings()
+        ind.votethem(symmetry="cubic", ang_step=1.0)
+        self.assertEqual(len(ind.ubis), len(us))
+        for u in us:
+            found = False
+            for ubi in ind.ubis:
+                m = np.dot(np.dot(ubi, u), uc.B)
+                if np.allclose(m, np.round(m), atol=0.02):
+                    found = True
+            self.assertTrue(found)
+
+
+if __name__ == "__main__":
+    unittest.main()
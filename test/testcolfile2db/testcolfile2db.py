@@ -31,6 +31,43 @@ class t1(unittest.TestCase):
                self.assertEqual(i, item)
 import os, time
 
+class t3(unittest.TestCase):
+    """ colfile_from_db reads back what colfile2db wrote """
+    def setUp(self):
+        import numpy as np
+        rng = np.random.RandomState(42)
+        self.c = columnfile.colfile_from_dict( {
+            "omega" : rng.uniform(-180, 180, 1000),
+            "labels" : rng.randint(-1, 20, 1000).astype(np.int32) } )
+        self.c.parameters.set("distance", 1234.)
+        if os.path.exists("test.db"):
+            os.remove("test.db")
+        columnfile.colfile2db( self.c, "test.db", batch=300 )
+
+    def tearDown(self):
+        os.remove("test.db")
+
+    def test_roundtrip(self):
+        r = columnfile.colfile_from_db( "test.db" )
+        self.assertEqual( r.nrows, 1000 )
+        self.assertEqual( r.labels.dtype, self.c.labels.dtype )
+        self.assertTrue( (r.labels == self.c.labels).all() )
+        self.assertTrue( (r.omega == self.c.omega).all() )
+        self.assertEqual( r.parameters.get("distance"), 1234. )
+
+    def test_where(self):
+        r = columnfile.colfile_from_db( "test.db", "labels = ? and omega > ?",
+                                        (3, 0.), titles=["omega",] )
+        m = (self.c.labels == 3) & (self.c.omega > 0)
+        self.assertEqual( r.titles, ["omega",] )
+        self.assertTrue( (r.omega == self.c.omega[m]).all() )
+        con = sqlite3.connect("test.db")
+        names = [ row[0] for row in con.execute(
+            "select name from sqlite_master where type='index'"
+            " and tbl_name='peaks'") ]
+        con.close()
+        self.assertEqual( sorted(names), ["peaks_labels", "peaks_omega"] )
+
 class t2(unittest.TestCase):
     def setUp(self):
         if os.path.exists("nac.db"):
@@ -39,6 +39,52 @@ class testgeom( unittest.TestCase ):
         c  = columnfile.columnfile("testgeom.flt")
         c.updateGeometry( )
 
+    def test_incremental( self ):
+        """ Only the steps which changed are redone, same answer """
+        import numpy as np
+        c  = columnfile.columnfile("testgeom.flt")
+        c.updateGeometry( )
+        xl, tth, gx = c.xl, c.tth, c.gx
+        c.updateGeometry( )
+        self.assertTrue( c.xl is xl and c.tth is tth and c.gx is gx )
+        for name, value, same in ( ( "wavelength", 0.3, ( "xl", "tth" ) ),
+                                   ( "t_x", 10., ( "xl", ) ),
+                                   ( "distance", 5000., () ) ):
+            c.parameters.set( name, value )
+            old = dict( [ ( t, c.getcolumn( t ) ) for t in
+                          ( "xl", "tth", "gx" ) ] )
+            c.updateGeometry( )
+            for t in old:
+                self.assertEqual( t in same, c.getcolumn( t ) is old[t] )
+            d = columnfile.columnfile("testgeom.flt")
+            d.setparameters( c.parameters )
+            d.updateGeometry( )
+            for t in ( "xl", "zl", "tth", "eta", "gx", "gy", "gz", "ds" ):
+                self.assertTrue( np.allclose( c.getcolumn( t ),
+                                              d.getcolumn( t ) ) )
+        xl = c.xl
+        c.addcolumn( c.omega + 1, "omega" )
+        c.updateGeometry( )
+        self.assertTrue( c.xl is xl )
+        d.addcolumn( d.omega + 1, "omega" )
+        d.updateGeometry( force = True )
+        self.assertTrue( np.allclose( c.gx, d.gx ) )
+
+    def test_reorder_wavelength( self ):
+        """ Cached geometry follows the rows after reorder """
+        import numpy as np
+        c = columnfile.columnfile( "testgeom.flt" )
+        c.updateGeometry( )
+        c.reorder( np.array( [ 3, 1, 4, 0, 2 ] ) )
+        c.parameters.set( "wavelength", 0.3 )
+        c.updateGeometry( )
+        d = columnfile.columnfile( "testgeom.flt" )
+        d.reorder( np.array( [ 3, 1, 4, 0, 2 ] ) )
+        d.setparameters( c.parameters )
+        d.updateGeometry( )
+        for t in ( "tth", "gx", "gy", "gz", "ds" ):
+            self.assertTrue( np.allclose( c.getcolumn( t ), d.getcolumn( t ) ) )
+
     def testfilter(self):
         c = columnfile.columnfile("testgeom.flt")
         d = c.copy()
@@ -151,6 +197,311 @@ class test1( unittest.TestCase ):
             e = True
         assert( e )
 
-        
+
+class testreadfile( unittest.TestCase ):
+    """ The block parser must give what python float() gives """
+    def setUp( self ):
+        import numpy as np
+        rng = np.random.RandomState( 42 )
+        self.data = rng.normal( size=(1000, 4) ) * 1000
+        with open( "testread.flt", "w" ) as f:
+            f.write( "# distance = 5881.1\n#  sc  fc  omega  Number_of_pixels\n" )
+            for row in self.data:
+                f.write( "%.4f %.17g %r %.3e\n"%tuple( row ) )
+            f.write( "1 2" ) # unfinished last row
+        with open( "testread.flt" ) as f:
+            lines = f.readlines()[2:-1]
+        self.ref = [ [ float( v ) for v in line.split() ] for line in lines ]
+
+    def tearDown( self ):
+        import os
+        os.remove( "testread.flt" )
+
+    def test_blocks( self ):
+        import numpy as np
+        for blocksize in ( 10, 1000, 1<<20 ):
+            for nthreads in ( 1, 2, 5 ):
+                with open( "testread.flt", "rb" ) as f:
+                    f.readline()
+                    f.readline()
+                    cols = columnfile.read_float_columns( f, 4, nthreads,
+                                                          blocksize )
+                self.assertTrue( ( np.array( cols ).T == self.ref ).all() )
+
+    def test_readfile( self ):
+        c = columnfile.columnfile( "testread.flt" )
+        self.assertEqual( c.nrows, 1000 )
+        self.assertEqual( c.parameters.get( "distance" ), 5881.1 )
+        self.assertEqual( list( c.omega ), [ r[2] for r in self.ref ] )
+
+    def test_long_numbers( self ):
+        """ Many digits go to strtod and not into an overflowing integer """
+        import numpy as np
+        from ImageD11 import cImageD11
+        text = b"123456789012345678901234 -0.0000000000000000000012345\n" \
+               b"99999999999999999999.5 1234567890.12345678\n"
+        cols = np.zeros( ( 2, 2 ) )
+        n = cImageD11.parse_float_columns( np.frombuffer( text, np.int8 ),
+                                           cols, 0 )
+        self.assertEqual( n, 2 )
+        ref = [ [ float( v ) for v in line.split() ]
+                for line in text.decode().splitlines() ]
+        self.assertTrue( ( cols.T == ref ).all() )
+
+    def test_bad_line( self ):
+        with open( "testread.flt", "a" ) as f:
+            f.write( " 3 4\n5 6 7 8\n" )
+        with open( "testread.flt", "r" ) as f:
+            lines = f.readlines()
+        lines[10] = "1 2 x 3\n"
+        with open( "testread.flt", "w" ) as f:
+            f.writelines( lines )
+        self.assertRaises( Exception, columnfile.columnfile, "testread.flt" )
+
+
+class testlazy( unittest.TestCase ):
+    """ lazycolumnfile reads only the columns that are used """
+    def setUp( self ):
+        import numpy as np, tempfile, os
+        rng = np.random.RandomState( 42 )
+        self.c = columnfile.colfile_from_dict( {
+            "sc" : rng.uniform( 0, 2048, 100 ),
+            "fc" : rng.uniform( 0, 2048, 100 ),
+            "omega" : rng.uniform( -180, 180, 100 ) } )
+        self.c.parameters.set( "distance", 1234. )
+        self.tmpdir = tempfile.mkdtemp()
+        self.h5 = os.path.join( self.tmpdir, "pks.h5" )
+        columnfile.colfile_to_hdf( self.c, self.h5, name="peaks" )
+        self.npy = os.path.join( self.tmpdir, "pks" )
+        columnfile.colfile_to_npy( self.c, self.npy )
+
+    def tearDown( self ):
+        import shutil
+        shutil.rmtree( self.tmpdir )
+
+    def test_lazy( self ):
+        import numpy as np
+        for src in ( self.h5, self.npy ):
+            ref = self.c.copy()
+            l = columnfile.lazycolumnfile( src )
+            self.assertEqual( l.titles, [ "sc", "fc", "omega" ] )
+            self.assertEqual( l.loaded(), [] )
+            l.filter( l.sc > 1000 )
+            ref.filter( ref.sc > 1000 )
+            d = l.copyrows( [ 3, 1, 2 ] )
+            l.sortby( "omega" )
+            ref.sortby( "omega" )
+            self.assertEqual( l.loaded(), [ "sc", "omega" ] )
+            self.assertEqual( l.nrows, ref.nrows )
+            for t in ref.titles:
+                self.assertTrue( np.allclose( l.getcolumn( t ),
+                                              ref.getcolumn( t ) ) )
+            self.assertTrue( np.allclose( d.fc,
+                                          self.c.fc[ self.c.sc > 1000 ][[3,1,2]] ) )
+        self.assertEqual( l.parameters.get( "distance" ), 1234. )
+
+    def test_mmap( self ):
+        import numpy as np
+        l = columnfile.colfile_from_hdf( self.h5, lazy=True )
+        self.assertTrue( isinstance( l.fc, np.memmap ) )
+        l.fc[:] = 0 # copy on write
+        l = columnfile.lazycolumnfile( self.h5 )
+        self.assertTrue( np.allclose( l.fc, self.c.fc ) )
+
+
+class testwriter( unittest.TestCase ):
+    """ columnfile_writer gives the same as writefile, a block at a time """
+    def setUp( self ):
+        import numpy as np, tempfile
+        rng = np.random.RandomState( 42 )
+        self.c = columnfile.colfile_from_dict( {
+            "sc" : rng.uniform( 0, 2048, 100 ),
+            "omega" : rng.uniform( -180, 180, 100 ),
+            "spot3d_id" : np.arange( 100 ) } )
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown( self ):
+        import shutil
+        shutil.rmtree( self.tmpdir )
+
+    def test_write( self ):
+        import numpy as np, os
+        for fname in ( "pks.flt", "pks.h5" ):
+            fname = os.path.join( self.tmpdir, fname )
+            pars = columnfile.parameters.parameters( distance = 1234. )
+            w = columnfile.columnfile_writer( fname, self.c.titles, pars,
+                                              chunksize = 16 )
+            for i in range( 0, 100, 30 ):
+                w.write( self.c.copyrows( slice( i, i+30 ) ) )
+                # can be read while writing
+                self.assertEqual( columnfile.columnfile( fname ).nrows, w.nrows )
+            w.parameters.set( "wavelength", 0.3 )
+            w.close()
+            r = columnfile.columnfile( fname )
+            self.assertEqual( r.nrows, 100 )
+            self.assertEqual( r.parameters.get( "distance" ), 1234. )
+            for t in self.c.titles:
+                self.assertTrue( np.allclose( r.getcolumn( t ),
+                                              self.c.getcolumn( t ),
+                                              atol = 1e-3 ) )
+        # hdf files get the parameters at the end
+        self.assertEqual( r.parameters.get( "wavelength" ), 0.3 )
+
+    def test_dtypes( self ):
+        import numpy as np, os
+        dtypes = { "sc" : np.float64, "spot3d_id" : np.int64 }
+        for fname in ( "pks.flt", "pks.h5" ):
+            fname = os.path.join( self.tmpdir, fname )
+            with columnfile.columnfile_writer( fname, self.c.titles,
+                                               dtypes = dtypes ) as w:
+                w.write( self.c )
+            r = columnfile.columnfile( fname )
+            self.assertEqual( r.getcolumn( "sc" ).dtype, np.float64 )
+            self.assertEqual( r.getcolumn( "spot3d_id" ).dtype, np.int64 )
+            self.assertTrue( ( r.spot3d_id == self.c.spot3d_id ).all() )
+        # the text file says which types were declared
+        with open( fname.replace( ".h5", ".flt" ) ) as f:
+            self.assertTrue( "# dtypes = sc:float64 spot3d_id:int64\n" in f.readlines() )
+        # hdf keeps the usual float32 for the rest
+        r = columnfile.columnfile( fname )
+        self.assertEqual( r.getcolumn( "omega" ).dtype, np.float32 )
+
+    def test_other_process( self ):
+        """ A second process can read the hdf file while it is written """
+        import os, sys, subprocess
+        fname = os.path.join( self.tmpdir, "pks.h5" )
+        here = os.path.dirname( os.path.dirname( os.path.abspath( columnfile.__file__ ) ) )
+        code = "from ImageD11 import columnfile\n" \
+               "print( columnfile.columnfile( %r ).nrows )"%( fname )
+        env = dict( os.environ )
+        env["PYTHONPATH"] = os.pathsep.join( [ here, env.get( "PYTHONPATH", "" ) ] )
+        with columnfile.columnfile_writer( fname, self.c.titles,
+                                           chunksize = 16 ) as w:
+            for i in range( 0, 100, 30 ):
+                w.write( self.c.copyrows( slice( i, i+30 ) ) )
+                out = subprocess.check_output( [ sys.executable, "-c", code ],
+                                               env = env )
+                self.assertEqual( int( out.split()[-1] ), w.nrows )
+        self.assertEqual( columnfile.columnfile( fname ).nrows, 100 )
+
+
+class testindex( unittest.TestCase ):
+    """ Index lookups give the same rows as masks """
+    def setUp( self ):
+        import numpy as np
+        rng = np.random.RandomState( 42 )
+        self.c = columnfile.colfile_from_dict( {
+            "omega" : rng.uniform( -180, 180, 1000 ).round( 1 ),
+            "labels" : rng.randint( -1, 20, 1000 ) } )
+
+    def test_lookups( self ):
+        import numpy as np
+        c = self.c
+        idx = c.index( "omega" )
+        self.assertTrue( c.index( "omega" ) is idx )
+        for lo, hi in ( ( -10, 10 ), ( 0.5, 0.5 ), ( 170, 200 ) ):
+            m = ( c.omega >= lo ) & ( c.omega < hi )
+            self.assertTrue( ( idx.between( lo, hi ) == np.nonzero( m )[0] ).all() )
+            self.assertEqual( idx.count( lo, hi ), m.sum() )
+            m = ( c.omega >= lo ) & ( c.omega <= hi )
+            self.assertTrue( ( idx.between( lo, hi, inclusive=True ) ==
+                               np.nonzero( m )[0] ).all() )
+        for g in ( -1, 3, 25 ):
+            rows = c.index( "labels" ).equal( g )
+            self.assertTrue( ( rows == np.nonzero( c.labels == g )[0] ).all() )
+        d = c.select( "labels", 3 )
+        self.assertEqual( d.nrows, ( c.labels == 3 ).sum() )
+        self.assertTrue( ( d.omega == c.omega[ c.labels == 3 ] ).all() )
+
+    def test_invalidate( self ):
+        import numpy as np
+        c = self.c
+        idx = c.index( "omega" )
+        c.sortby( "labels" )
+        self.assertFalse( c.index( "omega" ) is idx )
+        idx = c.index( "omega" )
+        c.filter( c.labels > 0 )
+        rows = c.index( "omega" ).between( -10, 10 )
+        m = ( c.omega >= -10 ) & ( c.omega < 10 )
+        self.assertTrue( ( rows == np.nonzero( m )[0] ).all() )
+        idx = c.index( "omega" )
+        c.addcolumn( -c.omega, "omega" )
+        self.assertFalse( c.index( "omega" ) is idx )
+        idx = c.index( "labels" )
+        c.labels = c.labels + 1
+        self.assertTrue( ( c.index( "labels" ).equal( 1 ) ==
+                           np.nonzero( c.labels == 1 )[0] ).all() )
+
+class testdtypes( unittest.TestCase ):
+    """ Integer and float32 columns survive writefile and hdf """
+    def setUp( self ):
+        import numpy as np, tempfile
+        rng = np.random.RandomState( 42 )
+        self.c = columnfile.colfile_from_dict( {
+            "sc" : rng.uniform( 0, 2048, 100 ),
+            "Number_of_pixels" : rng.randint( 1, 100, 100 ),
+            "spot3d_id" : np.arange( 100 ) } )
+        self.c.dtypes["sc"] = np.float32
+        self.c.addcolumn( self.c.sc, "sc" )
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown( self ):
+        import shutil
+        shutil.rmtree( self.tmpdir )
+
+    def test_writefile( self ):
+        import numpy as np, os
+        fname = os.path.join( self.tmpdir, "pks.flt" )
+        self.c.writefile( fname )
+        r = columnfile.columnfile( fname )
+        self.assertEqual( r.sc.dtype, np.float32 )
+        self.assertTrue( np.allclose( r.sc, self.c.sc, atol = 1e-3 ) )
+        self.assertFalse( "dtypes" in r.parameters.get_parameters() )
+        # nothing declared means float64, also for the INTS titles
+        self.assertEqual( r.Number_of_pixels.dtype, np.float64 )
+        self.assertEqual( r.spot3d_id.dtype, np.float64 )
+        self.assertTrue( ( r.spot3d_id == self.c.spot3d_id ).all() )
+        # declared in the file header
+        self.c.dtypes["Number_of_pixels"] = np.int32
+        self.c.writefile( fname )
+        r = columnfile.columnfile( fname )
+        self.assertEqual( r.Number_of_pixels.dtype, np.int32 )
+        self.assertTrue( ( r.Number_of_pixels == self.c.Number_of_pixels ).all() )
+        # and kept when written again
+        r.writefile( fname )
+        self.assertEqual( columnfile.columnfile( fname ).Number_of_pixels.dtype,
+                          np.int32 )
+        # declared types override the file
+        r = columnfile.columnfile( fname, dtypes = { "sc" : np.float64 } )
+        self.assertEqual( r.sc.dtype, np.float64 )
+        self.assertEqual( r.copy().sc.dtype, np.float64 )
+
+    def test_not_integers( self ):
+        import numpy as np, os
+        fname = os.path.join( self.tmpdir, "pks.flt" )
+        with open( fname, "w" ) as f:
+            f.write( "#  h  k  l  sc\n" )
+            f.write( "1 2 3 4.5\n0 0.5 nan 1\n" )
+        r = columnfile.columnfile( fname )
+        self.assertEqual( r.h.dtype, np.float64 )
+        r = columnfile.columnfile( fname, dtypes = { "h" : np.int32,
+                                                     "k" : np.int32,
+                                                     "l" : np.int32 } )
+        self.assertEqual( r.h.dtype, np.int32 )
+        self.assertEqual( r.k.dtype, np.float64 )
+        self.assertEqual( r.k[1], 0.5 )
+        self.assertTrue( np.isnan( r.l[1] ) )
+
+    def test_hdf( self ):
+        import numpy as np, os
+        fname = os.path.join( self.tmpdir, "pks.h5" )
+        columnfile.colfile_to_hdf( self.c, fname )
+        r = columnfile.columnfile( fname )
+        self.assertEqual( r.sc.dtype, np.float32 )
+        # INTS titles are int32 in hdf, as before
+        self.assertEqual( r.Number_of_pixels.dtype, np.int32 )
+        self.assertTrue( ( r.Number_of_pixels == self.c.Number_of_pixels ).all() )
+
+
 if __name__ == '__main__':
     unittest.main()
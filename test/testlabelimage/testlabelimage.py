@@ -153,21 +153,13 @@ class test_labelimage(unittest.TestCase):
         self.data5 = np.zeros(self.dims, np.float32)
         self.outfile = "l2.out"
 
+    def tearDown(self):
+        for f in ("l2.out", "l2.h5"):
+            if os.path.exists(f):
+                os.remove(f)
 
-    def test_1(self):
-        self.data1[20:41,120:141] = 1.
-        self.data2[20:41,120:141] = 1.
-        self.data3[20:41,120:141] = 1.
-        self.data4[20:41,120:141] = 1.
-        self.data5[20:41,120:141] = 1.
-        self.data3[30,130] = 2. # in the middle
-        self.data1[55,65] = 1.
-        self.data2[55,65] = 2.
-        self.data3[55,65] = 3.
-        self.data4[55,65] = 2.
-        self.data5[55,65] = 1.
-
-        lio = labelimage.labelimage(self.dims , self.outfile)
+    def search(self, outfile):
+        lio = labelimage.labelimage(self.dims , outfile)
         lio.peaksearch(self.data1, 0.1, 1.)
         lio.mergelast()
         lio.peaksearch(self.data2, 0.1, 2.)
@@ -180,8 +172,36 @@ class test_labelimage(unittest.TestCase):
         lio.mergelast()
         lio.finalise()
         lio.outfile.close()
+        return columnfile.columnfile(outfile)
+
+    def test_hdf(self):
+        self.data1[20:41,120:141] = 1.
+        self.data2[20:41,120:141] = 1.
+        self.data2[55,65] = 2.
+        self.data3[100:110,10:12] = 3.
+        self.data5[55,65] = 1.
+        co = self.search(self.outfile)
+        ch = self.search("l2.h5")
+        self.assertEqual(sorted(co.titles), sorted(ch.titles))
+        self.assertEqual(co.nrows, 4)
+        for t in co.titles:
+            self.assertTrue(np.allclose(co.getcolumn(t), ch.getcolumn(t),
+                                        rtol=1e-6, atol=1e-4), t)
+
+    def test_1(self):
+        self.data1[20:41,120:141] = 1.
+        self.data2[20:41,120:141] = 1.
+        self.data3[20:41,120:141] = 1.
+        self.data4[20:41,120:141] = 1.
+        self.data5[20:41,120:141] = 1.
+        self.data3[30,130] = 2. # in the middle
+        self.data1[55,65] = 1.
+        self.data2[55,65] = 2.
+        self.data3[55,65] = 3.
+        self.data4[55,65] = 2.
+        self.data5[55,65] = 1.
 
-        co = columnfile.columnfile(self.outfile)
+        co = self.search(self.outfile)
 
 
 